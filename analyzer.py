@@ -1,40 +1,54 @@
-import pandas as pd
 import os
-from typing import Dict, Any
-from notifications import send_push_notification
-import csv
+from typing import Dict, Any, Tuple
+from notifications import load_env, send_push_notification
+
+# .env - до модулей, которые читают настройки при импорте (data_store, server)
+load_env()
+from data_store import DATA_DIRECTORY, ClientDataStore, get_store
+from features import ClientFeatures
+from rules import FeatureMatrix, RuleSet, load_rules
+from metrics import METRICS, configure_profiling, profiled, timed, timer
+from result_sink import ResultSink, close_sink, get_sink, open_sink
 from pathlib import Path
 
 
-def write_to_csv(row: Dict, filename: str):
-    out_path = Path(filename)
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    file_exists = out_path.exists()
-    
-
-    with out_path.open("a", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=row.keys())
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(row)
+@timed('write_to_csv')
+def write_to_csv(row: Dict, filename: str, flush: bool = True):
+    """
+    Записывает строку через общий приёмник файла: буфер, одна строка на
+    client_code (повторный запуск обновляет её, а не дописывает дубликат).
+    flush=False - только в буфер, без дисковых операций (для event loop).
+    """
+    get_sink(filename).write(row, flush)
 
 class ClientAnalyzer:
 
-    def __init__(self, client_id: int, output_filename: str):
-        self.DATA_DIRECTORY = 'case1'
+    def __init__(self, client_id: int, output_filename: str, store: ClientDataStore = None,
+                 features: ClientFeatures = None):
+        self.DATA_DIRECTORY = DATA_DIRECTORY
         self.CLIENT_PROFILES_PATH = os.path.join(self.DATA_DIRECTORY, 'clients.csv')
         self.client_id = client_id
         self.output_filename = output_filename 
+        # Общее хранилище: CSV читаются один раз на процесс, а не на каждый запрос
+        self.store = store if store is not None else get_store(self.DATA_DIRECTORY)
         
         try:
-            self.all_profiles = pd.read_csv(self.CLIENT_PROFILES_PATH).set_index('client_code')
+            self.all_profiles = self.store.get_profiles()
         except FileNotFoundError:
             print(f"Критическая ошибка: Файл профилей {self.CLIENT_PROFILES_PATH} не найден.")
             raise
 
-        self.load_client_data()
+        self._scores = None
+        if features is None:
+            self.load_client_data()
+        else:
+            # Готовые агрегаты (например, из incremental.py) - транзакции не читаются
+            self.client_profile = self.all_profiles.loc[self.client_id]
+            self.transactions_df = self.transfers_df = None
+            self._features = features
     
 
+    @timed('load_client_data')
     def load_client_data(self) -> Dict[str, Any]:
         """
         Загружает все данные (профиль, транзакции, переводы) для одного клиента по его ID.
@@ -42,13 +56,15 @@ class ClientAnalyzer:
         print(f"Загрузка данных для клиента ID: {self.client_id}...")
         try:
             self.client_profile = self.all_profiles.loc[self.client_id]
-            transactions_path = os.path.join(self.DATA_DIRECTORY, f'client_{self.client_id}_transactions_3m.csv')
-            
-
-            transfers_path = os.path.join(self.DATA_DIRECTORY, f'client_{self.client_id}_transfers_3m.csv')
-
-            self.transactions_df = pd.read_csv(transactions_path)
-            self.transfers_df = pd.read_csv(transfers_path)
+            if self.store.compact:
+                # Агрегаты прямо по компактным таблицам хранилища, без DataFrame клиента
+                self.transactions_df = self.transfers_df = None
+                with timer('features'):
+                    self._features = self.store.get_client_features(self.client_id)
+            else:
+                self.transactions_df, self.transfers_df = self.store.get_client_frames(self.client_id)
+                self._features = None
+            self._scores = None
             # print(self.client_profile)
             print("Данные успешно загружены.\n")
             
@@ -56,60 +72,56 @@ class ClientAnalyzer:
             print(f"ОШИБКА: Не удалось загрузить все данные для клиента {self.client_id}. {e}")
             return {}
         
-    def calculate_travel_card_cashback(self) -> float:
+    @property
+    def features(self) -> ClientFeatures:
+        """
+        Агрегаты клиента: считаются один раз при первом обращении любого скорера.
         """
-        Рассчитывает долю расходов, релевантных для "Карты для путешествий",
-        от общей суммы трат клиента.
+        if self._features is None:
+            with timer('features'):
+                self._features = ClientFeatures(self.transactions_df, self.transfers_df)
+        return self._features
 
-        Args:
-            transactions_df: DataFrame с транзакциями клиента.
+    @property
+    def rules(self) -> RuleSet:
+        return load_rules()
 
-        Returns:
-            float: Соотношение (доля) от 0.0 до 1.0.
+    @timed('rules.score')
+    def product_scores(self) -> Dict[str, Any]:
+        """
+        Скоры всех продуктов из product_rules.json за один вызов правил.
+        """
+        if self._scores is None:
+            # Время каждого продукта пишется в этап scorer.<скорер> (RuleSet.score)
+            self._scores = self.rules.score(self.feature_matrix())
+        return self._scores
+
+    def feature_matrix(self) -> FeatureMatrix:
         """
-        if self.transactions_df.empty:
-            return 0.0
+        Матрица агрегатов клиента (одна строка) для правил продуктов.
+        """
+        balance = self.client_profile['avg_monthly_balance_KZT']
+        return FeatureMatrix.from_features(self.client_id, self.features, balance,
+                                           self.get_balance_statistics()['mean'])
 
-        total_spend = self.transactions_df['amount'].sum()
-        if total_spend == 0:
-            return 0.0
+    def product_score(self, product: str):
+        return self.rules.products[product].cast(self.product_scores()[product][0])
 
-        is_travel_category = self.transactions_df['category'].isin(['Такси', 'Путешествия', 'Отели'])
-        # is_fx_currency = transactions_df['currency'].isin(['USD', 'EUR'])
-        relevant_spend = self.transactions_df[is_travel_category]['amount'].sum()
-        # ratio = relevant_spend / total_spend
-        return relevant_spend * 0.04 #сколько денег можно вернуть кэшбеком
+    def calculate_travel_card_cashback(self):
+        """
+        Кэшбэк "Карты для путешествий": сколько денег клиент вернул бы с
+        трат на такси, путешествия и отели (категории и ставка - в product_rules.json).
 
+        Returns:
+            float: Сумма кэшбэка в тенге.
+        """
+        return self.product_score('КАРТА ДЛЯ ПУТЕШЕСТВИЙ')
 
     def calculate_premium_card_cashback(self):
-        MAX_CASHBACK = 100_000 * 3
-        avg_balance = int(self.client_profile.get('avg_monthly_balance_KZT'))
-        avg_balance_cashback = 0
-        if avg_balance < 1_000_000:
-            tier_cashback_rate = 0.02
-        elif 1_000_000 <= avg_balance and avg_balance < 6_000_000:
-            tier_cashback_rate = 0.03
-        else:
-            tier_cashback_rate = 0.04
-        avg_balance *= tier_cashback_rate
-        premium_expenses_cashback = 0.04 * self.transactions_df[self.transactions_df['category'].isin(['Ювелирные украшения', 'Косметика и Парфюмерия', 'Кафе и рестораны'])]['amount'].sum()
-        # print(tier_cashback_rate)
-        return min(avg_balance + premium_expenses_cashback, MAX_CASHBACK)
+        return self.product_score('ПРЕМИАЛЬНАЯ КАРТА')
 
     def calculate_credit_card_cashback(self):
-
-        spend_by_category = self.transactions_df.groupby('category')['amount'].sum()
-        online_categories = {'Играем дома', 'Едим дома', 'Смотрим дома'}
-        top_3_categories = spend_by_category.nlargest(3)
-
-        # all_relevant_categories = set(top_3_categories.index).union(online_categories)
-        all_relevant_categories = online_categories
-        # 5. Считаем итоговую сумму по уникальному списку категорий
-        final_sum = spend_by_category[spend_by_category.index.isin(all_relevant_categories)].sum()
-        
-        # print(final_sum, list(all_relevant_categories), top_3_categories)
-
-        return final_sum * 0.1
+        return self.product_score('КРЕДИТНАЯ КАРТА')
     # def calculate_credit_card_cashback(self):
     #     """
     #     ИСПРАВЛЕНО: Считает кешбэк для Кредитной карты, выбирая топ-3
@@ -141,56 +153,24 @@ class ClientAnalyzer:
     #     return total_cashback_spend * 0.1
 
     def calculate_currency_exchange_ratio(self):
-        if self.transfers_df.empty:
-            return 0.0
-
-        total_spend = self.transfers_df['amount'].sum()
-        if total_spend == 0:
-            return 0.0
-
-        is_travel_category = self.transfers_df['type'].isin(['fx_sell', 'fx_buy'])
-        # is_fx_currency = transactions_df['currency'].isin(['USD', 'EUR'])
-        relevant_spend = self.transfers_df[is_travel_category]['amount'].sum()
-        # ratio = relevant_spend / total_spend
-        return relevant_spend/total_spend #сколько денег можно вернуть кэшбеком
+        return self.product_score('Обмен валют')
 
 
 
 
     def calculate_gold_ratio(self):
-        if self.transfers_df.empty:
-            return 0.0
-
-        total_spend = self.transfers_df['amount'].sum()
-        if total_spend == 0:
-            return 0.0
-
-        is_travel_category = self.transfers_df['type'].isin(['gold_buy_out', 'gold_sell_in'])
-        # is_fx_currency = transactions_df['currency'].isin(['USD', 'EUR'])
-        relevant_spend = self.transfers_df[is_travel_category]['amount'].sum()
-        # ratio = relevant_spend / total_spend
-        return relevant_spend/total_spend #сколько денег можно вернуть кэшбеком
+        return self.product_score('Золотые слитки')
 
     def calculate_invest_ratio(self):
-        if self.transfers_df.empty:
-            return 0.0
-
-        total_spend = self.transfers_df['amount'].sum()
-        if total_spend == 0:
-            return 0.0
-
-        is_travel_category = self.transfers_df['type'].isin(['invest_out', 'invest_in'])
-        # is_fx_currency = transactions_df['currency'].isin(['USD', 'EUR'])
-        relevant_spend = self.transfers_df[is_travel_category]['amount'].sum()
-        # ratio = relevant_spend / total_spend
-        return relevant_spend/total_spend #сколько денег можно вернуть кэшбеком
+        return self.product_score('Инвестиции')
     
+    @timed('scorer.calculate_dep_savings_score')
     def calculate_dep_savings_score(self):
         INTEREST_RATE = 0.165
         k = 0.8 # коэффицент строгости для is_stable_expenses: чем ниже - тем строже
         balance_stats = self.get_balance_statistics()
         is_high_balance = self.client_profile['avg_monthly_balance_KZT'] > balance_stats['mean']
-        is_stable_expenses = self.transactions_df['amount'].std() < (self.transactions_df['amount'].mean() * k)
+        is_stable_expenses = self.features.amount_std < (self.features.amount_mean * k)
 
         # print(self.get_balance_statistics())
         # print(is_high_balance, is_stable_expenses)
@@ -200,117 +180,63 @@ class ClientAnalyzer:
         """
         Депозит Мультивалютный — оцениваем активность валютных операций.
         """
-        INTEREST_RATE = 0.145
-        if self.transfers_df.empty:
-            return 0.0
-
-        # fx_topups = self.transfers_df[self.transfers_df.type == "deposit_fx_topup_out"].amount.sum()
-        # fx_withdraws = self.transfers_df[self.transfers_df.type == "deposit_fx_withdraw_in"].amount.sum()
-        fx_ops = self.transfers_df[self.transfers_df.type.isin(["fx_buy", "fx_sell"])].shape[0]
-        is_travel_category = self.transfers_df['type'].isin(['deposit_fx_topup_out', 'deposit_fx_withdraw_in'])
-        # is_fx_currency = transactions_df['currency'].isin(['USD', 'EUR'])
-        relevant_spend = self.transfers_df[is_travel_category]['amount'].sum()
-        score = relevant_spend + fx_ops * 1000  # условный вес
-        # return s
-        # print(relevant_spend)
-        # print('rs', score * (1 + INTEREST_RATE))
-        return int(score * (1 + INTEREST_RATE))
+        return self.product_score('Депозит Мультивалютный')
 
     def calc_max_yield(self):
         """
         Депозит Сберегательный — проверяем один большой topup.
         """
-        INTEREST_RATE = 0.165
-        if self.transfers_df.empty:
-            return 0.0
-        is_savings = self.transfers_df['type'].isin(['deposit_topup_out'])
-        savings_sum = self.transfers_df[is_savings]['amount'].sum()
-        savings_count = self.transfers_df[is_savings].shape[0]
-        balance_stats = self.get_balance_statistics()
-        is_high_balance = self.client_profile['avg_monthly_balance_KZT'] > balance_stats['mean']
-        # print('f', savings_count, savings_sum)
-
-        return int(savings_count == 0 and is_high_balance)
+        return self.product_score('Депозит Сберегательный')
 
     def calc_saving_discipline(self):
         """
         Депозит Накопительный — оцениваем регулярность пополнений.
         """
-        INTEREST_RATE = 0.155
-        if self.transfers_df.empty:
-            return 0.0
-        is_savings = self.transfers_df['type'].isin(['deposit_topup_out'])
-        recurring_sum = self.transfers_df[is_savings].amount.sum()
-        recurring_count = self.transfers_df[is_savings].shape[0]
-        # print('r', recurring_count, recurring_sum)
-        if recurring_count > 1:
-            return int(recurring_sum * (1 + INTEREST_RATE) * (1 + 0.05 * recurring_count))
-        return 0.0
+        return self.product_score('Депозит Накопительный')
 
     def choose_best_deposit(self):
         """
         Сравнивает три депозита и возвращает лучший вариант для клиента.
         """
-        scores = {
-            "Депозит Сберегательный": self.calc_max_yield(),
-            "Депозит Накопительный": self.calc_saving_discipline(),
-            "Депозит Мультивалютный": self.calc_liquidity_score(),
-        }
+        scores = {p.name: self.product_score(p.name) for p in self.rules.stage('deposit').candidates}
         best_product = max(scores, key=scores.get)
         return {"scores": scores, "best_product": best_product}
 
-    def execute(self):
-        # ... (логика анализа) ...
+    def recommend(self) -> Tuple[str, Any]:
+        """
+        Выбирает продукт для клиента без отправки пуша и записи в файл.
+
+        Каскад этапов (доли переводов -> депозиты -> кэшбэк) задаётся в
+        product_rules.json и совпадает с пакетным режимом (batch_engine.py).
 
-        # ИЗМЕНЕНИЕ 3: В конце метода execute() используем self.output_filename
-        # для вызова write_to_csv
-        ratio_variables = {
-            'Обмен валют': self.calculate_currency_exchange_ratio(),
-            'Золотые слитки': self.calculate_gold_ratio(),
-            'Инвестиции': self.calculate_invest_ratio()
-        }
-        
-        max_key = max(ratio_variables, key=ratio_variables.get)
-        max_ratio = ratio_variables[max_key]
-        
-        if max_ratio > 0.3:
-            print(max_key)
-            row = send_push_notification(self.client_id, max_key, max_ratio)
-            write_to_csv(row, self.output_filename) # Передаем имя файла
-            return row
-        
-        dep_result = self.choose_best_deposit()
-        max_score_key = dep_result.get('best_product')
-        
-        if max_score_key and dep_result['scores'][max_score_key] > 0:
-            max_score = dep_result['scores'][max_score_key]
-            print(max_score_key)
-            row = send_push_notification(self.client_id, max_score_key, max_score)
+        Returns:
+            (название продукта, значение скора для мета-промпта)
+        """
+        product, value, _ = self.rules.choose(self.product_scores())
+        product = product[0]
+        print(product)
+        return product, self.rules.products[product].cast(value[0])
+
+    def execute(self, sink: ResultSink = None):
+        product, value = self.recommend()
+        row = send_push_notification(self.client_id, product, value)
+        if sink is not None:
+            sink.write(row)
+        else:
             write_to_csv(row, self.output_filename) # Передаем имя файла
-            return row
-            
-        cashbacks = {
-            "КАРТА ДЛЯ ПУТЕШЕСТВИЙ": self.calculate_travel_card_cashback(),
-            "ПРЕМИАЛЬНАЯ КАРТА": self.calculate_premium_card_cashback(),
-            # "КРЕДИТНАЯ КАРТА": self.calculate_credit_card_cashback()
-        }
-        
-        max_cashback_key = max(cashbacks, key=cashbacks.get)
-        max_cashback = cashbacks[max_cashback_key]
-        
-        print(max_cashback_key)
-        row = send_push_notification(self.client_id, max_cashback_key, max_cashback)
-        write_to_csv(row, self.output_filename) # Передаем имя файла
         return row
 
     def get_balance_statistics(self) -> Dict[str, float]:
-        balance_data = self.all_profiles['avg_monthly_balance_KZT']
-        stats = {
-            "mean": balance_data.mean(), "median": balance_data.median(),
-            "75%": balance_data.quantile(0.75), "85%": balance_data.quantile(0.85),
-            "95%": balance_data.quantile(0.95)
-        }
-        return stats
+        # Считается один раз на набор профилей и кэшируется в хранилище
+        return self.store.get_balance_statistics()
+
+def recommend_client(client_id: int, output_filename: str) -> Tuple[str, Any]:
+    """
+    Анализ одного клиента без пуша - для запуска в пуле потоков/процессов сервера.
+    """
+    # При заданном PROFILE_SLOW_MS медленные анализы сохраняются в out/profiles
+    with profiled(f'client_{client_id}'):
+        return ClientAnalyzer(client_id, output_filename).recommend()
 
 # --- Основной блок выполнения ---
 if __name__ == '__main__':
@@ -318,7 +244,25 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Анализ клиента по ID")
     parser.add_argument("-id", "--client_id", type=int, help="ID клиента для анализа")
+    parser.add_argument("--workers", type=int, default=1, help="Сколько пушей генерировать одновременно в пакетном режиме")
+    parser.add_argument("--executor", choices=["async", "thread", "process"], default="async", help="Способ параллельной генерации пушей")
+    parser.add_argument("--timeout", type=float, default=None, help="Таймаут на одного клиента, секунд")
+    parser.add_argument("--cache", choices=["on", "off", "refresh"], default=None, help="Кэш текстов пушей: on - использовать, off - обойти, refresh - перегенерировать")
+    parser.add_argument("--per-client", action="store_true", help="Пакетный режим через ClientAnalyzer для каждого клиента (без векторного движка)")
+    parser.add_argument("--output", default=None, help="Файл результатов пакетного режима: .csv, .parquet или .sqlite3")
+    parser.add_argument("--profile-slow-ms", type=float, default=None, help="Сохранять cProfile клиентов, обработанных дольше N мс (в out/profiles)")
+    parser.add_argument("--resume", action="store_true", help="Продолжить прерванный пакетный запуск по журналу: готовые клиенты не пересчитываются")
+    parser.add_argument("--retries", type=int, default=1, help="Сколько раз повторять клиентов с ошибкой в пакетном режиме")
+    parser.add_argument("--checkpoint", default=None, help="Журнал пакетного режима (по умолчанию <output>.checkpoint.jsonl)")
+    parser.add_argument("--profile-rate", type=float, default=None, help="Доля клиентов, которые профилируются (по умолчанию 0.1)")
     args = parser.parse_args()
+    if args.resume and (args.client_id or args.per_client):
+        parser.error("--resume работает только в векторном пакетном режиме")
+    if args.profile_slow_ms is not None:
+        configure_profiling(args.profile_slow_ms, args.profile_rate)
+    if args.cache:
+        from notifications import set_cache_mode
+        set_cache_mode(args.cache)
     
     output_dir = Path("out")
     output_dir.mkdir(exist_ok=True)
@@ -337,6 +281,7 @@ if __name__ == '__main__':
             # Передаем имя файла в конструктор
             analyzer = ClientAnalyzer(args.client_id, output_filename)
             analyzer.execute()
+            close_sink(output_filename)
             print(f"Результат сохранен в файл: {output_filename}")
         except Exception as e:
             print(f"Не удалось обработать клиента {args.client_id}: {e}")
@@ -344,18 +289,26 @@ if __name__ == '__main__':
     else:
         print("ID клиента не указан. Запуск анализа для всех клиентов (1-60).")
         # Используем общее имя файла для всех
-        output_filename = str(output_dir / "recommendations_append.csv")
-
-        # Очищаем файл ПЕРЕД началом цикла
-        if os.path.exists(output_filename):
-            os.remove(output_filename)
-        
-        for client_id in range(1, 61):
-            try:
-                # Передаем одно и то же имя файла для каждого клиента
-                analyzer = ClientAnalyzer(client_id, output_filename)
-                analyzer.execute()
-            except Exception as e:
-                print(f"Не удалось обработать клиента {client_id}: {e}")
+        output_filename = args.output or str(output_dir / "recommendations_append.csv")
+
+        # Файл не очищается: строки клиентов обновляются по client_code, а новый
+        # результат подменяет старый целиком только в конце запуска
+        if args.per_client:
+            with open_sink(output_filename, atomic=True) as sink:
+                for client_id in range(1, 61):
+                    try:
+                        # Передаем одно и то же имя файла для каждого клиента
+                        with profiled(f'client_{client_id}'):
+                            analyzer = ClientAnalyzer(client_id, output_filename)
+                            analyzer.execute(sink)
+                    except Exception as e:
+                        print(f"Не удалось обработать клиента {client_id}: {e}")
+            METRICS.print_summary()
+        else:
+            # Все скоры считаются сразу для всех клиентов (см. batch_engine.py)
+            from batch_engine import run_batch
+            run_batch(range(1, 61), output_filename, workers=args.workers,
+                      executor=args.executor, timeout=args.timeout,
+                      checkpoint=args.checkpoint, resume=args.resume, retries=args.retries)
         
         print(f"Обработка завершена. Результаты сохранены в файл: {output_filename}")
\ No newline at end of file
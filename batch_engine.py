@@ -0,0 +1,335 @@
+# batch_engine.py
+
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from checkpoint import DONE, FAILED, FALLBACK, Checkpoint, checkpoint_path
+from compact import CompactTable
+from data_store import ClientDataStore, get_store
+from metrics import METRICS, timer
+from result_sink import open_sink
+from rules import FeatureMatrix, RuleSet, load_rules
+
+
+# Как часто пул проверяет, какие задачи начались и не истёк ли их таймаут
+POOL_POLL_SECONDS = 0.05
+
+def load_batch_frames(client_ids: Iterable[int], store: ClientDataStore = None) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, List[int]]:
+    """
+    Собирает транзакции и переводы всех клиентов в два общих DataFrame
+    (в режиме compact хранилища - в две CompactTable).
+
+    Returns:
+        (профили, транзакции, переводы, список ID без данных)
+    """
+    store = store if store is not None else get_store()
+    profiles = store.get_profiles()
+    if store.compact:
+        transactions, transfers, missing = store.get_compact_tables(client_ids)
+    else:
+        transactions, transfers, missing = store.get_batch_frames(client_ids)
+    return profiles, transactions, transfers, missing
+
+
+def compute_scores(profiles: pd.DataFrame, transactions: pd.DataFrame, transfers: pd.DataFrame,
+                   client_ids: Iterable[int], rules: RuleSet = None) -> pd.DataFrame:
+    """
+    Считает скоры всех продуктов из product_rules.json сразу для всех клиентов.
+
+    Один groupby по (client_code, category) для транзакций и один по
+    (client_code, type) для переводов (FeatureMatrix); правила продуктов
+    затем только складывают столбцы матрицы. Колонки результата - продукты.
+    """
+    rules = rules if rules is not None else load_rules()
+    if isinstance(transactions, CompactTable):
+        matrix = FeatureMatrix.from_compact(profiles, transactions, transfers, client_ids)
+    else:
+        matrix = FeatureMatrix.from_frames(profiles, transactions, transfers, client_ids)
+    return pd.DataFrame(rules.score(matrix), index=matrix.index)
+
+
+def choose_products(scores: pd.DataFrame, rules: RuleSet = None) -> pd.DataFrame:
+    """
+    Тот же каскад этапов, что в ClientAnalyzer.recommend(), для всех клиентов сразу.
+    Возвращает DataFrame с колонками product, value и stage.
+    """
+    rules = rules if rules is not None else load_rules()
+    product, value, stage = rules.choose({name: scores[name].to_numpy() for name in scores.columns})
+    return pd.DataFrame({'product': product, 'value': value, 'stage': stage}, index=scores.index)
+
+
+def score_batch(client_ids: Iterable[int], store: ClientDataStore = None) -> Tuple[pd.DataFrame, List[int]]:
+    """
+    Скоры и выбранный продукт для всех клиентов за несколько групповых проходов.
+    """
+    client_ids = list(client_ids)
+    rules = load_rules()
+    with timer('batch.load_frames'):
+        profiles, transactions, transfers, missing = load_batch_frames(client_ids, store)
+    present = [c for c in client_ids if c not in set(missing)]
+    with timer('batch.compute_scores'):
+        scores = compute_scores(profiles, transactions, transfers, present, rules)
+    with timer('batch.choose_products'):
+        return scores.join(choose_products(scores, rules)), missing
+
+
+_task_starts = None
+
+
+def _init_pool_worker(starts):
+    global _task_starts
+    _task_starts = starts
+
+
+def _pool_job(index: int, client_id: int, product: str, value):
+    from notifications import send_push_notification
+
+    # Время старта видно родителю через общий массив (и для потоков, и для процессов)
+    _task_starts[index] = time.time()
+    return send_push_notification(client_id, product, value)
+
+
+def _push_with_pool(jobs: List[Tuple[int, str, Any]], workers: int, executor: str,
+                    timeout: Optional[float], on_result: Callable):
+    """
+    Пуши в пуле потоков или процессов; on_result вызывается строго по порядку клиентов.
+
+    Таймаут отсчитывается от момента, когда воркер начал задачу, а не от
+    начала ожидания, поэтому клиенты в очереди за зависшим не получают
+    таймаут. Завершения приходят через add_done_callback, а сроки начатых
+    задач лежат в куче, поэтому шаг опроса не перебирает все задачи. Если
+    все воркеры заняты зависшими задачами, оставшиеся клиенты не
+    запускаются и получают ошибку «не запущен» (их подхватит повтор).
+    Зависшие процессы завершаются при закрытии пула; поток остановить
+    нельзя - он дорабатывает в фоне и занимает воркер до выхода из процесса.
+    """
+    import heapq
+    import multiprocessing
+    import queue
+
+    workers = max(1, workers)
+    starts = multiprocessing.Array('d', len(jobs), lock=False)
+    pool_cls = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+    pool = pool_cls(max_workers=workers, initializer=_init_pool_worker, initargs=(starts,))
+    # Номера завершённых задач приходят из колбэков пула - опрашивать все futures не нужно
+    finished: queue.SimpleQueue = queue.SimpleQueue()
+    futures = []
+    for i, (client_id, product, value) in enumerate(jobs):
+        future = pool.submit(_pool_job, i, client_id, product, value)
+        future.add_done_callback(lambda _, i=i: finished.put(i))
+        futures.append(future)
+    # i -> (строка, ошибка)
+    outcomes: Dict[int, Tuple[Optional[Dict], Optional[str]]] = {}
+    # Куча (срок, i) начатых задач и задачи с таймаутом, которые ещё занимают воркер
+    deadlines: List[Tuple[float, int]] = []
+    hung: Set[int] = set()
+    # Пул берёт задачи в порядке отправки: все задачи левее next_start уже начаты или учтены
+    next_start = 0
+    emitted = 0
+    try:
+        while emitted < len(futures):
+            done = []
+            try:
+                done.append(finished.get(timeout=POOL_POLL_SECONDS if timeout is not None else None))
+                while True:
+                    done.append(finished.get_nowait())
+            except queue.Empty:
+                pass
+            for i in done:
+                hung.discard(i)
+                if i in outcomes:
+                    continue
+                try:
+                    outcomes[i] = (futures[i].result(), None)
+                except Exception as e:
+                    outcomes[i] = (None, str(e))
+
+            if timeout is not None:
+                while next_start < len(futures) and (starts[next_start] or next_start in outcomes):
+                    if next_start not in outcomes:
+                        heapq.heappush(deadlines, (starts[next_start] + timeout, next_start))
+                    next_start += 1
+                now = time.time()
+                while deadlines and deadlines[0][0] <= now:
+                    _, i = heapq.heappop(deadlines)
+                    if i not in outcomes:
+                        outcomes[i] = (None, f'таймаут {timeout} c')
+                        hung.add(i)
+
+                if len(hung) >= workers:
+                    # Свободных воркеров не осталось: не начатые задачи уже не начнутся
+                    for i in range(next_start, len(futures)):
+                        if i not in outcomes and not starts[i]:
+                            futures[i].cancel()
+                            outcomes[i] = (None, 'не запущен: все воркеры заняты зависшими задачами')
+
+            while emitted in outcomes:
+                row, error = outcomes[emitted]
+                client_id, product, _ = jobs[emitted]
+                on_result(client_id, product, row, error)
+                emitted += 1
+    finally:
+        stuck = any(not futures[i].done() for i in hung)
+        if stuck and executor == 'process':
+            # Публичного способа остановить воркер нет; следующий запуск создаёт новый пул
+            for process in list((getattr(pool, '_processes', None) or {}).values()):
+                process.terminate()
+        # Не ждём зависшие задачи - их результаты уже учтены как таймаут
+        pool.shutdown(wait=not stuck, cancel_futures=True)
+
+
+async def _push_async(jobs: List[Tuple[int, str, Any]], workers: int,
+                      timeout: Optional[float], on_result: Callable):
+    from notifications import asend_push_notification, get_llm_client
+
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def push(client_id: int, product: str, value):
+        async with semaphore:
+            return await asyncio.wait_for(asend_push_notification(client_id, product, value), timeout)
+
+    tasks = [(client_id, product, asyncio.create_task(push(client_id, product, value)))
+             for client_id, product, value in jobs]
+    try:
+        # Забираем результаты строго по порядку клиентов
+        for client_id, product, task in tasks:
+            try:
+                on_result(client_id, product, await task, None)
+            except asyncio.TimeoutError:
+                on_result(client_id, product, None, f'таймаут {timeout} c')
+            except Exception as e:
+                on_result(client_id, product, None, str(e))
+    finally:
+        client = get_llm_client()
+        if client is not None:
+            await client.aclose()
+
+
+def run_batch(client_ids: Iterable[int], output_filename: str, store: ClientDataStore = None,
+              workers: int = 1, executor: str = 'async', timeout: Optional[float] = None,
+              checkpoint: Optional[str] = None, resume: bool = False, retries: int = 1) -> Dict[str, Any]:
+    """
+    Пакетный режим: векторные скоры, затем параллельная генерация пушей.
+
+    Пуши (HTTP-запрос к Gemini) выполняются параллельно - через асинхронный
+    клиент или в пуле потоков/процессов. Строки из журнала, новые и
+    повторённые собираются вместе и в конце одним проходом в порядке
+    client_code пишутся во временный файл, который заменяет output_filename
+    (строки клиентов, которых нет в запуске, сохраняются).
+
+    Каждый результат сразу записывается в журнал (checkpoint.py). С resume=True
+    клиенты, уже готовые в журнале с тем же продуктом и значением, берутся из
+    него без запроса к Gemini; клиенты с ошибкой или шаблонным текстом
+    считаются заново. Клиенты с ошибкой или шаблонным текстом в текущем
+    запуске повторяются в конце, до retries раз; если шаблон так и не
+    заменился ответом Gemini, в результат пишется он.
+
+    Args:
+        workers: сколько клиентов обрабатывается одновременно.
+        executor: 'async', 'thread' или 'process'.
+        timeout: сколько секунд ждать результат одного клиента.
+        checkpoint: файл журнала (по умолчанию рядом с output_filename).
+        resume: продолжить по журналу прошлого запуска.
+        retries: сколько раз повторять клиентов с ошибкой или шаблонным текстом.
+
+    Returns:
+        dict: rows - записанные строки, failures - {client_id: причина},
+        fallbacks - клиенты с шаблонным текстом, resumed - сколько клиентов
+        взято из журнала.
+    """
+    from notifications import is_fallback
+
+    decisions, missing = score_batch(client_ids, store)
+    failures: Dict[int, str] = {client_id: 'нет данных' for client_id in missing}
+    products = load_rules().products
+    # Значение приводится к тому типу, который вернул бы recommend() (int для депозитов)
+    jobs = [(int(client_id), product, products[product].cast(value))
+            for client_id, product, value in zip(decisions.index, decisions['product'], decisions['value'])]
+    values = {client_id: value for client_id, _, value in jobs}
+
+    # client_id -> строка; пишутся все сразу по порядку клиентов после повторов
+    results: Dict[int, Dict] = {}
+    # Клиенты, у которых пока только шаблон вместо ответа Gemini
+    fallbacks: Set[int] = set()
+    resumed = 0
+
+    # Прерванный запуск не портит прошлый результат: файл подменяется при выходе из with
+    with Checkpoint(checkpoint or checkpoint_path(output_filename), resume) as journal, \
+            open_sink(output_filename, atomic=True) as sink:
+        def on_result(client_id: int, product: str, row: Optional[Dict], error: Optional[str]):
+            if error is not None:
+                journal.record(client_id, product, values[client_id], FAILED, error=error)
+                # Шаблон из прошлой попытки лучше, чем клиент без пуша
+                if client_id not in fallbacks:
+                    failures[client_id] = error
+                return
+            failures.pop(client_id, None)
+            results[client_id] = row
+            if is_fallback(product, row['push_notification']):
+                journal.record(client_id, product, values[client_id], FALLBACK, row)
+                fallbacks.add(client_id)
+                return
+            fallbacks.discard(client_id)
+            journal.record(client_id, product, values[client_id], DONE, row)
+            print(product)
+
+        pending = []
+        for client_id, product, value in jobs:
+            row = journal.completed(client_id, product, value) if resume else None
+            if row is None:
+                pending.append((client_id, product, value))
+            else:
+                results[client_id] = row
+                resumed += 1
+        if resume:
+            retried = set(journal.retry_queue()) & {client_id for client_id, _, _ in pending}
+            print(f"Из журнала {journal.path}: {resumed} клиентов, к обработке: {len(pending)} "
+                  f"(повтор после ошибки или шаблона: {len(retried)})")
+
+        for attempt in range(max(0, retries) + 1):
+            if not pending:
+                break
+            if attempt:
+                print(f"Повтор {attempt}: {len(pending)} клиентов с ошибкой или шаблонным текстом")
+            if executor == 'async':
+                asyncio.run(_push_async(pending, workers, timeout, on_result))
+            else:
+                _push_with_pool(pending, workers, executor, timeout, on_result)
+            pending = [job for job in pending if job[0] in failures or job[0] in fallbacks]
+
+        for client_id in sorted(fallbacks):
+            print(results[client_id]['product'])
+        rows = [results[client_id] for client_id in sorted(results)]
+        sink.write_many(rows)
+
+    print_failure_summary(failures, len(rows) - len(fallbacks), fallbacks)
+
+    print_cache_summary()
+    METRICS.print_summary()
+    return {'rows': rows, 'failures': failures, 'fallbacks': sorted(fallbacks), 'resumed': resumed}
+
+
+def print_failure_summary(failures: Dict[int, str], succeeded: int, fallbacks: Iterable[int] = ()):
+    """
+    Итог запуска: клиенты с шаблонным текстом вместо ответа Gemini
+    считаются отдельно от успешных - их стоит продолжить с --resume.
+    """
+    fallbacks = sorted(fallbacks)
+    print(f"Успешно: {succeeded}, с шаблонным текстом: {len(fallbacks)}, с ошибками: {len(failures)}")
+    for client_id in fallbacks:
+        print(f"  Клиент {client_id}: шаблонный текст")
+    for client_id, reason in sorted(failures.items()):
+        print(f"  Клиент {client_id}: {reason}")
+
+
+def print_cache_summary():
+    from notifications import get_push_cache
+
+    cache = get_push_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Кэш пушей: попаданий {stats['hits']}, промахов {stats['misses']}, записей {stats['entries']}")
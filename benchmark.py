@@ -0,0 +1,320 @@
+# benchmark.py
+
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+
+
+STUB_TEXT = "Тестовый пуш от локальной заглушки Gemini."
+
+# Базовые зависимости точки входа: их время измеряется в том же запуске и
+# вычитается, бюджет - запас на собственный код поверх них (pandas одна
+# импортируется ~400 мс и сильно гуляет от запуска к запуску)
+IMPORT_BASELINES = {'analyzer': ('pandas',), 'server': ('pandas', 'fastapi')}
+IMPORT_MARGIN_MS = {'analyzer': 150, 'server': 250}
+# Зависимости, которые грузятся только при первом использовании, а не при импорте
+LAZY_MODULES = ('dotenv', 'requests', 'httpx', 'llm_client', 'push_cache', 'pyarrow.parquet')
+
+
+class StubGeminiHandler(BaseHTTPRequestHandler):
+    """
+    Локальная заглушка Gemini: сразу отвечает фиксированным текстом.
+    """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'candidates': [{'content': {'parts': [{'text': STUB_TEXT}]}}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGeminiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+    Пиковый RSS процесса с начала работы, МБ (ru_maxrss: КБ в Linux, байты в macOS).
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def timed(results: Dict[str, Any], name: str, calls: int, fn: Callable):
+    """
+    Выполняет fn (без вывода в консоль) и записывает время этапа и пиковый RSS после него.
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        value = fn()
+        elapsed = time.perf_counter() - started
+    results[name] = {
+        'total_s': elapsed,
+        'calls': calls,
+        'per_call_ms': elapsed / calls * 1000 if calls else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    print(f"  {name:<44} {elapsed:8.3f} s  {results[name]['per_call_ms']:8.3f} ms/call  "
+          f"{results[name]['peak_rss_mb'] or 0:8.1f} MB peak")
+    return value
+
+
+def import_time(module: str, repeat: int = 3) -> Dict[str, Any]:
+    """
+    Время импорта module в чистом интерпретаторе и отложенные зависимости из
+    LAZY_MODULES, которые всё же загрузились. own_ms - время без базовых
+    зависимостей (IMPORT_BASELINES), измеренных в том же запуске; из repeat
+    запусков берётся лучший по own_ms.
+    """
+    code = f"import sys, {module}; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    baselines = IMPORT_BASELINES.get(module, ())
+    best, eager = None, []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        # Строка вида "import time: self | cumulative | module"; каждый модуль
+        # импортируется один раз, отступ - глубина вложенности
+        cumulative = {}
+        for line in proc.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                cumulative.setdefault(fields[2].strip(), int(fields[1]) / 1000)
+        total = cumulative.get(module)
+        baseline = sum(cumulative.get(name, 0.0) for name in baselines)
+        if total is not None and (best is None or total - baseline < best['own_ms']):
+            best = {'import_ms': total, 'baseline_ms': baseline, 'own_ms': total - baseline}
+        eager = [m for m in proc.stdout.strip().split(',') if m]
+    return {**(best or {'import_ms': None, 'baseline_ms': None, 'own_ms': None}),
+            'budget_ms': IMPORT_MARGIN_MS.get(module), 'eager': eager}
+
+
+def measure_imports(modules: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Проверка холодного старта: собственное время импорта точек входа
+    (без IMPORT_BASELINES) против запаса IMPORT_MARGIN_MS.
+    """
+    results = {}
+    for module in modules or list(IMPORT_MARGIN_MS):
+        result = results[module] = import_time(module)
+        over = result['budget_ms'] is not None and result['own_ms'] > result['budget_ms']
+        result['ok'] = not over and not result['eager']
+        status = 'OK' if result['ok'] else 'ПРЕВЫШЕН' if over else 'НЕ ЛЕНИВО'
+        baselines = ' + '.join(IMPORT_BASELINES.get(module, ())) or 'база'
+        print(f"  import {module:<37} {result['import_ms']:8.1f} ms  ({baselines} {result['baseline_ms']:.1f} ms, "
+              f"свой код {result['own_ms']:.1f} ms, запас {result['budget_ms']} ms)  {status}"
+              + (f"  загружены: {', '.join(result['eager'])}" if result['eager'] else ''))
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_http(data_dir: str, stub_url: str, n_clients: int, levels: List[int], requests_per_level: int,
+             output_filename: str, port: int = 8765) -> List[Dict[str, float]]:
+    """
+    Поднимает server.py в отдельном процессе на данных бенчмарка и гоняет load_test.
+    """
+    import asyncio
+    import httpx
+    import load_test
+
+    env = dict(os.environ, DATA_DIRECTORY=data_dir, MAX_CLIENT_ID=str(n_clients),
+               GEMINI_API='stub', GEMINI_API_URL=stub_url, PUSH_CACHE='off', OUTPUT_FILENAME=output_filename)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'server:app', '--port', str(port), '--log-level', 'warning'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f'http://127.0.0.1:{port}'
+    started = time.perf_counter()
+    try:
+        for _ in range(300):
+            try:
+                httpx.get(f'{url}/docs', timeout=1)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+        print(f"  запуск сервера до первого ответа: {time.perf_counter() - started:.2f} s")
+        return asyncio.run(load_test.run(url, levels, requests_per_level, n_clients))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def run_benchmark(data_dir: str, n_clients: int, http_levels: Optional[List[int]] = None,
+                  http_requests: int = 200, execute_limit: int = 1000, compact: bool = False) -> Dict[str, Any]:
+    stub = start_stub_server()
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}/'
+    # Модули читают настройки при импорте - поэтому импорт только после env
+    os.environ.update(DATA_DIRECTORY=data_dir, GEMINI_API='stub', GEMINI_API_URL=stub_url, PUSH_CACHE='off',
+                      DATA_STORE_COMPACT='on' if compact else 'off')
+
+    from analyzer import ClientAnalyzer
+    from batch_engine import score_batch
+    from data_store import ClientDataStore
+    from result_sink import close_sink
+    from rules import load_rules
+
+    client_ids = list(range(1, n_clients + 1))
+    stages: Dict[str, Any] = {}
+    store_mode = 'compact' if compact else 'lru'
+    print(f"Бенчмарк: {n_clients} клиентов из {data_dir}, хранилище {store_mode}")
+    imports = measure_imports()
+
+    store = ClientDataStore(data_dir, max_clients=n_clients, compact=compact)
+    timed(stages, 'load_cold', n_clients, lambda: store.warmup(client_ids))
+    timed(stages, 'load_warm', n_clients, lambda: store.warmup(client_ids))
+    data_bytes = store.memory_usage()
+    print(f"  данные клиентов в памяти: {data_bytes / 2**20:.1f} MB")
+
+    analyzers = timed(stages, 'analyzer_init', n_clients,
+                      lambda: [ClientAnalyzer(c, os.devnull, store) for c in client_ids])
+    timed(stages, 'features', n_clients,
+          lambda: [store.get_client_features(c) for c in client_ids])
+    for a in analyzers:
+        a.features  # агрегаты считаются один раз, дальше меряем только скореры
+    # Скореры правил считаются все сразу (rules.score); по продуктам - на готовых матрицах
+    timed(stages, 'scorer.product_scores', n_clients, lambda: [a.rules.score(a.feature_matrix()) for a in analyzers])
+    matrices = [a.feature_matrix() for a in analyzers]
+    for product in load_rules().products.values():
+        timed(stages, product.metric, n_clients,
+              lambda product=product: [product.evaluate(m) for m in matrices])
+    timed(stages, 'scorer.calculate_dep_savings_score', n_clients,
+          lambda: [a.calculate_dep_savings_score() for a in analyzers])
+    timed(stages, 'recommend', n_clients,
+          lambda: [ClientAnalyzer(c, os.devnull, store).recommend() for c in client_ids])
+
+    execute_ids = client_ids[:execute_limit]
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'recommendations.csv')
+        timed(stages, 'execute_end_to_end', len(execute_ids),
+              lambda: [ClientAnalyzer(c, output, store).execute() for c in execute_ids])
+        close_sink(output)
+
+    timed(stages, 'batch_engine.score_batch', n_clients, lambda: score_batch(client_ids, store))
+
+    result: Dict[str, Any] = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'clients': n_clients,
+            'data_dir': data_dir,
+            'store': store_mode,
+            'data_bytes': data_bytes,
+            'peak_rss_mb': peak_rss_mb(),
+        },
+        'imports': imports,
+        'stages': stages,
+    }
+    try:
+        import pandas
+        result['meta']['pandas'] = pandas.__version__
+    except ImportError:
+        pass
+
+    if http_levels:
+        print("  HTTP /process_id:")
+        with tempfile.TemporaryDirectory() as tmp:
+            result['http'] = run_http(data_dir, stub_url, n_clients, http_levels, http_requests,
+                                      os.path.join(tmp, 'recommendations.csv'))
+        import load_test
+        load_test.print_results(result['http'])
+
+    stub.shutdown()
+    return result
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]):
+    """
+    Печатает изменение времени этапов относительно прошлого запуска.
+    """
+    print(f"Сравнение с {baseline['meta'].get('git_revision')} ({baseline['meta'].get('timestamp')}):")
+    for name, stage in current['stages'].items():
+        old = baseline['stages'].get(name)
+        if not old or not old['per_call_ms']:
+            continue
+        ratio = stage['per_call_ms'] / old['per_call_ms']
+        print(f"  {name:<44} {old['per_call_ms']:8.3f} -> {stage['per_call_ms']:8.3f} ms/call  x{ratio:.2f}")
+    for module, stage in current.get('imports', {}).items():
+        old = baseline.get('imports', {}).get(module)
+        # Старые JSON без own_ms сравниваются по полному времени импорта
+        key = 'own_ms' if old and old.get('own_ms') and stage.get('own_ms') else 'import_ms'
+        if old and old[key]:
+            print(f"  import {module:<37} {old[key]:8.1f} -> {stage[key]:8.1f} ms  "
+                  f"x{stage[key] / old[key]:.2f}" + ('  (свой код)' if key == 'own_ms' else ''))
+    for key, unit, scale in (('data_bytes', 'MB', 2**20), ('peak_rss_mb', 'MB', 1)):
+        old, new = baseline['meta'].get(key), current['meta'].get(key)
+        if old and new:
+            print(f"  {key:<44} {old / scale:8.1f} -> {new / scale:8.1f} {unit}  x{new / old:.2f}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера рекомендаций")
+    parser.add_argument("-n", "--clients", type=int, default=None, help="Сгенерировать N синтетических клиентов")
+    parser.add_argument("--data-dir", default=None, help="Каталог с данными (по умолчанию case1 или синтетика)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--http", default=None, help="Уровни параллельности для HTTP, например 1,10,100")
+    parser.add_argument("--http-requests", type=int, default=200, help="Запросов на уровень HTTP")
+    parser.add_argument("--execute-limit", type=int, default=1000, help="Максимум клиентов для execute() с пушем")
+    parser.add_argument("--output", default=None, help="JSON с результатами (по умолчанию out/bench/...)")
+    parser.add_argument("--compare", default=None, help="JSON прошлого запуска для сравнения")
+    parser.add_argument("--compact", action="store_true", help="Хранилище в режиме compact (compact.py)")
+    parser.add_argument("--imports-only", action="store_true",
+                        help="Только проверка времени импорта; код выхода 1 при превышении бюджета")
+    args = parser.parse_args()
+
+    if args.imports_only:
+        sys.exit(0 if all(r['ok'] for r in measure_imports().values()) else 1)
+
+    if args.clients and not args.data_dir:
+        import synthetic_data
+        data_dir = os.path.join('out', 'bench_data', f'{args.clients}_{args.seed}')
+        if not os.path.exists(os.path.join(data_dir, 'clients.csv')):
+            print(f"Генерация {args.clients} клиентов в {data_dir}...")
+            synthetic_data.generate(args.clients, data_dir, seed=args.seed)
+        n_clients = args.clients
+    else:
+        data_dir = args.data_dir or 'case1'
+        import pandas as pd
+        n_clients = args.clients or int(pd.read_csv(os.path.join(data_dir, 'clients.csv'))['client_code'].max())
+
+    levels = [int(level) for level in args.http.split(',')] if args.http else None
+    result = run_benchmark(data_dir, n_clients, levels, args.http_requests, args.execute_limit, args.compact)
+
+    output = args.output or os.path.join('out', 'bench', f"benchmark_{result['meta']['timestamp'].replace(':', '-')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Результаты: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(result, json.load(f))
@@ -0,0 +1,101 @@
+# checkpoint.py
+
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+
+DONE, FALLBACK, FAILED = 'done', 'fallback', 'failed'
+
+
+def checkpoint_path(output_filename: str) -> str:
+    """
+    Журнал по умолчанию лежит рядом с файлом результатов.
+    """
+    return f'{output_filename}.checkpoint.jsonl'
+
+
+class Checkpoint:
+    """
+    Журнал пакетного запуска: по строке JSON на каждый результат клиента.
+
+    Запись дописывается и сбрасывается в файл сразу после пуша клиента,
+    поэтому после падения процесса или отказа Gemini в журнале остаются все
+    уже полученные тексты. Для клиента действует последняя запись; status:
+    'done' - готовая строка результата, 'fallback' - шаблонный текст вместо
+    ответа Gemini, 'failed' - ошибка. Два последних попадают в очередь повтора.
+
+    При resume=True прочитанные записи используются, а новые дописываются
+    в конец. При resume=False журнал начинается заново, а непустой журнал
+    прошлого запуска переносится в <path>.prev и удаляется, только когда
+    новый запуск завершился без исключения: прерванный повторно запуск без
+    --resume не теряет прогресс.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.previous: Optional[str] = None
+        self.entries: Dict[int, Dict[str, Any]] = self._read() if resume else {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if not resume and os.path.exists(path) and os.path.getsize(path):
+            self.previous = f'{path}.prev'
+            os.replace(path, self.previous)
+            print(f"Журнал {path} начат заново, прошлый сохранён в {self.previous} до конца запуска "
+                  f"(продолжить прошлый запуск: --resume)", file=sys.stderr)
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def _read(self) -> Dict[int, Dict[str, Any]]:
+        entries: Dict[int, Dict[str, Any]] = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла оборваться при падении процесса
+                    continue
+                entries[int(entry['client_code'])] = entry
+        return entries
+
+    def completed(self, client_id: int, product: str, value) -> Optional[Dict]:
+        """
+        Строка результата, если клиент уже готов с тем же продуктом и значением.
+        Если после изменения данных рекомендация другая, клиент считается заново.
+        """
+        entry = self.entries.get(client_id)
+        if entry and entry['status'] == DONE and entry['product'] == product and entry['value'] == value:
+            return entry['row']
+        return None
+
+    def record(self, client_id: int, product: str, value, status: str, row: Optional[Dict] = None,
+               error: Optional[str] = None):
+        previous = self.entries.get(client_id)
+        attempts = previous['attempts'] + 1 if previous and previous['status'] != DONE else 1
+        entry = {
+            'client_code': client_id, 'product': product, 'value': value, 'status': status,
+            'attempts': attempts, 'row': row, 'error': error, 'at': time.time(),
+        }
+        self.entries[client_id] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def retry_queue(self) -> List[int]:
+        """
+        Клиенты, чей последний результат - ошибка или шаблонный текст.
+        """
+        return sorted(c for c, entry in self.entries.items() if entry['status'] != DONE)
+
+    def close(self, completed: bool = True):
+        self._file.close()
+        if completed and self.previous is not None:
+            os.remove(self.previous)
+            self.previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(completed=exc_type is None)
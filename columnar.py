@@ -0,0 +1,167 @@
+# columnar.py
+
+import glob
+import importlib.util
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+
+PARQUET_DIRECTORY = 'parquet'
+ROW_GROUP_SIZE = 16_384
+
+# Колонки, которые нужны скорерам; name/product/status/city дублируют профиль
+COLUMNS = {
+    'transactions': ['client_code', 'date', 'category', 'amount', 'currency'],
+    'transfers': ['client_code', 'date', 'type', 'direction', 'amount', 'currency'],
+}
+CATEGORICAL = {
+    'transactions': ['category', 'currency'],
+    'transfers': ['type', 'direction', 'currency'],
+}
+CSV_PATTERN = re.compile(r'client_(\d+)_(transactions|transfers)_3m\.csv$')
+
+
+def available() -> bool:
+    # find_spec не импортирует пакет: pyarrow.parquet грузится только при открытии файла
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def _arrow():
+    """
+    Модули pyarrow (pa, pc, pq). Импорт отложен до первого Parquet-файла,
+    чтобы запуск на CSV не платил за pyarrow.parquet.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    return pa, pc, pq
+
+
+def parquet_path(data_dir: str, kind: str) -> str:
+    return os.path.join(data_dir, PARQUET_DIRECTORY, f'{kind}.parquet')
+
+
+def read_csv(path: str, kind: str) -> pd.DataFrame:
+    """
+    Читает CSV клиента в той же схеме, что и Parquet: нужные колонки,
+    категории вместо строк и дата как datetime64.
+    """
+    dtype = {column: 'category' for column in CATEGORICAL[kind]}
+    return pd.read_csv(path, usecols=COLUMNS[kind], dtype=dtype, parse_dates=['date'])[COLUMNS[kind]]
+
+
+class ColumnarTable:
+    """
+    Parquet-файл одного вида данных (транзакции или переводы), открытый через mmap.
+
+    Строки отсортированы по client_code; при открытии по колонке client_code
+    строится индекс client_code -> row groups, и клиент читается без скана файла.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        _, pc, pq = _arrow()
+        self._file = pq.ParquetFile(path, memory_map=True)
+        self._row_groups: Dict[int, List[int]] = {}
+        for i in range(self._file.metadata.num_row_groups):
+            codes = self._file.read_row_group(i, columns=['client_code'])['client_code']
+            for client_id in pc.unique(codes).to_pylist():
+                self._row_groups.setdefault(client_id, []).append(i)
+
+    def __contains__(self, client_id: int) -> bool:
+        return client_id in self._row_groups
+
+    def read_client(self, client_id: int, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        groups = self._row_groups.get(client_id)
+        if not groups:
+            raise KeyError(client_id)
+        table = self._file.read_row_groups(groups, columns=columns)
+        _, pc, _ = _arrow()
+        table = table.filter(pc.equal(table['client_code'], client_id))
+        return table.to_pandas()
+
+    def read_clients(self, client_ids: Iterable[int], columns: Optional[List[str]] = None) -> pd.DataFrame:
+        client_ids = [c for c in client_ids if c in self._row_groups]
+        groups = sorted({g for c in client_ids for g in self._row_groups[c]})
+        table = self._file.read_row_groups(groups, columns=columns)
+        pa, pc, _ = _arrow()
+        table = table.filter(pc.is_in(table['client_code'], value_set=pa.array(client_ids, type=table['client_code'].type)))
+        return table.to_pandas()
+
+
+_tables: Dict[str, ColumnarTable] = {}
+_tables_lock = threading.Lock()
+
+
+def open_table(data_dir: str, kind: str) -> Optional[ColumnarTable]:
+    """
+    Возвращает открытый Parquet-файл или None, если конвертация не делалась.
+    Файл переоткрывается, если его mtime изменился.
+    """
+    path = parquet_path(data_dir, kind)
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+    if not available():
+        return None
+    with _tables_lock:
+        table = _tables.get(path)
+        if table is None or table.mtime != mtime:
+            table = ColumnarTable(path)
+            _tables[path] = table
+        return table
+
+
+def convert(data_dir: str, row_group_size: int = ROW_GROUP_SIZE) -> Dict[str, int]:
+    """
+    Собирает client_*_{transactions,transfers}_3m.csv в два Parquet-файла,
+    отсортированных по client_code, со словарным кодированием категорий.
+    """
+    if not available():
+        raise RuntimeError("Для конвертации нужен pyarrow: pip install pyarrow")
+    pa, _, pq = _arrow()
+
+    files: Dict[str, List[tuple]] = {'transactions': [], 'transfers': []}
+    for path in glob.glob(os.path.join(data_dir, 'client_*_3m.csv')):
+        match = CSV_PATTERN.search(os.path.basename(path))
+        if match:
+            files[match.group(2)].append((int(match.group(1)), path))
+
+    os.makedirs(os.path.join(data_dir, PARQUET_DIRECTORY), exist_ok=True)
+    written = {}
+    for kind, paths in files.items():
+        frames = [read_csv(path, kind) for _, path in sorted(paths)]
+        if not frames:
+            continue
+        df = pd.concat(frames, ignore_index=True)
+        # Общий словарь категорий для всех клиентов
+        for column in CATEGORICAL[kind]:
+            df[column] = df[column].astype(str).astype('category')
+        df = df.sort_values('client_code', kind='stable')
+
+        out_path = parquet_path(data_dir, kind)
+        tmp_path = out_path + '.tmp'
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, tmp_path, row_group_size=row_group_size, compression='zstd')
+        os.replace(tmp_path, out_path)
+        written[kind] = len(df)
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Конвертация CSV клиентов в Parquet")
+    parser.add_argument("--data-dir", default="case1", help="Каталог с client_*_3m.csv")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, help="Строк в одной row group")
+    args = parser.parse_args()
+
+    result = convert(args.data_dir, args.row_group_size)
+    for kind, rows in result.items():
+        print(f"{kind}: {rows} строк -> {parquet_path(args.data_dir, kind)}")
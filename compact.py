@@ -0,0 +1,239 @@
+# compact.py
+
+import os
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import columnar
+from timeseries import TimeSeries, to_seconds
+
+
+# float32 вдвое компактнее; погрешность суммы ~1e-7 от величины операции
+AMOUNT_DTYPE = np.dtype(os.getenv('COMPACT_AMOUNT_DTYPE', 'float32'))
+DATE_DTYPE = np.dtype('datetime64[s]')
+
+
+def _code_dtype(n_categories: int) -> np.dtype:
+    return np.dtype(np.int8) if n_categories < 127 else np.dtype(np.int16 if n_categories < 32767 else np.int32)
+
+
+def _row_positions(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Номера строк для набора диапазонов [start, start + length) без цикла Python.
+    """
+    total = int(lengths.sum())
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(total, dtype=np.int64) + shift
+
+
+class CompactTable:
+    """
+    Транзакции или переводы многих клиентов в виде плоских numpy-массивов.
+
+    Строки отсортированы по client_code, а offsets (длина n + 1) задаёт
+    диапазон строк каждого клиента, поэтому срез клиента - это view без
+    копирования. Колонки профиля (name, product, status, city) не хранятся,
+    категории - коды int8/int16 со словарём, суммы - AMOUNT_DTYPE, дата -
+    секунды datetime64. mtimes - версия источника, из которого прочитан
+    каждый клиент (как в ClientDataStore._source).
+    """
+
+    def __init__(self, kind: str, client_codes: np.ndarray, offsets: np.ndarray, mtimes: np.ndarray,
+                 columns: Dict[str, np.ndarray], categories: Dict[str, List[str]]):
+        self.kind = kind
+        self.client_codes = client_codes
+        self.offsets = offsets
+        self.mtimes = mtimes
+        self.columns = columns
+        self.categories = categories
+
+    def __len__(self) -> int:
+        return len(self.client_codes)
+
+    def __contains__(self, client_id: int) -> bool:
+        return self.position(client_id) >= 0
+
+    def position(self, client_id: int) -> int:
+        # client_codes отсортированы: бинарный поиск вместо словаря на каждого клиента
+        i = int(np.searchsorted(self.client_codes, client_id))
+        return i if i < len(self.client_codes) and self.client_codes[i] == client_id else -1
+
+    @property
+    def rows(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.client_codes, self.offsets, self.mtimes, *self.columns.values()]
+        return sum(a.nbytes for a in arrays)
+
+    @classmethod
+    def empty(cls, kind: str) -> 'CompactTable':
+        return cls.from_frame(pd.DataFrame({c: [] for c in columnar.COLUMNS[kind]}), kind, {})
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, kind: str, mtimes: Dict[int, float]) -> 'CompactTable':
+        """
+        Строит таблицу из DataFrame в схеме columnar.COLUMNS (строки любых клиентов).
+
+        mtimes - версия источника каждого клиента; клиент из mtimes без строк
+        тоже попадает в таблицу (пустым диапазоном), чтобы не перечитываться.
+        """
+        df = df.sort_values('client_code', kind='stable')
+        codes = df['client_code'].to_numpy(dtype=np.int64)
+        client_codes = np.union1d(codes, np.fromiter(mtimes, dtype=np.int64, count=len(mtimes)))
+        offsets = np.append(np.searchsorted(codes, client_codes), len(codes)).astype(np.int64)
+
+        columns, categories = {}, {}
+        for column in columnar.COLUMNS[kind]:
+            if column == 'client_code':
+                continue
+            if column in columnar.CATEGORICAL[kind]:
+                values = df[column].astype('category').cat
+                categories[column] = [str(c) for c in values.categories]
+                columns[column] = values.codes.to_numpy().astype(_code_dtype(len(categories[column])))
+            elif column == 'date':
+                columns[column] = pd.to_datetime(df[column]).to_numpy().astype(DATE_DTYPE)
+            else:
+                columns[column] = df[column].to_numpy(dtype=AMOUNT_DTYPE)
+        client_mtimes = np.array([mtimes.get(int(c), np.nan) for c in client_codes], dtype=np.float64)
+        return cls(kind, client_codes, offsets, client_mtimes, columns, categories)
+
+    @classmethod
+    def concat(cls, tables: Sequence['CompactTable']) -> 'CompactTable':
+        """
+        Объединяет таблицы с общим словарём категорий. Если клиент есть в
+        нескольких таблицах, остаётся его версия из последней.
+        """
+        kind = tables[0].kind
+        categories, remaps = {}, {}
+        for column in tables[0].categories:
+            merged: Dict[str, int] = {}
+            remaps[column] = []
+            for table in tables:
+                for value in table.categories[column]:
+                    merged.setdefault(value, len(merged))
+                # Последний элемент -1 переводит код NaN (-1) сам в себя
+                remaps[column].append(np.array([merged[v] for v in table.categories[column]] + [-1], dtype=np.int64))
+            categories[column] = list(merged)
+
+        columns = {}
+        for column in tables[0].columns:
+            if column in categories:
+                dtype = _code_dtype(len(categories[column]))
+                parts = [remaps[column][i][t.columns[column]].astype(dtype) for i, t in enumerate(tables)]
+            else:
+                parts = [t.columns[column] for t in tables]
+            columns[column] = np.concatenate(parts)
+
+        lengths = np.concatenate([np.diff(t.offsets) for t in tables])
+        client_codes = np.concatenate([t.client_codes for t in tables])
+        mtimes = np.concatenate([t.mtimes for t in tables])
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        stacked = cls(kind, client_codes, offsets, mtimes, columns, categories)
+
+        # Последняя версия клиента побеждает, затем сортировка по client_code
+        _, last = np.unique(client_codes[::-1], return_index=True)
+        return stacked.take(len(client_codes) - 1 - last)
+
+    def take(self, positions: np.ndarray) -> 'CompactTable':
+        """
+        Новая таблица из клиентов с позициями positions (по возрастанию client_code).
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = self.offsets[positions]
+        lengths = self.offsets[positions + 1] - starts
+        rows = _row_positions(starts, lengths)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        columns = {name: values[rows] for name, values in self.columns.items()}
+        return CompactTable(self.kind, self.client_codes[positions], offsets, self.mtimes[positions],
+                            columns, self.categories)
+
+    def without(self, client_ids: Iterable[int]) -> 'CompactTable':
+        keep = ~np.isin(self.client_codes, np.fromiter(client_ids, dtype=np.int64))
+        return self.take(np.flatnonzero(keep))
+
+    def mtime(self, client_id: int) -> Optional[float]:
+        position = self.position(client_id)
+        return None if position < 0 else float(self.mtimes[position])
+
+    def slice(self, client_id: int) -> Dict[str, np.ndarray]:
+        """
+        Колонки одного клиента - view на общие массивы, без копирования.
+        """
+        position = self.position(client_id)
+        if position < 0:
+            raise KeyError(client_id)
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return {name: values[start:end] for name, values in self.columns.items()}
+
+    def to_frame(self, client_id: int) -> pd.DataFrame:
+        """
+        DataFrame клиента в схеме columnar.read_csv (суммы - float64).
+        """
+        columns = self.slice(client_id)
+        data = {'client_code': np.full(len(columns['amount']), client_id, dtype=np.int64)}
+        for name in columnar.COLUMNS[self.kind][1:]:
+            values = columns[name]
+            if name in self.categories:
+                data[name] = pd.Categorical.from_codes(values, self.categories[name])
+            elif name == 'date':
+                data[name] = values.astype('datetime64[us]')
+            else:
+                data[name] = values.astype(np.float64)
+        return pd.DataFrame(data)
+
+    def positions(self, client_ids: Sequence[int]) -> np.ndarray:
+        """
+        Позиции клиентов в таблице; -1 для отсутствующих.
+        """
+        client_ids = np.asarray(client_ids, dtype=np.int64)
+        positions = np.searchsorted(self.client_codes, client_ids)
+        found = positions < len(self.client_codes)
+        found[found] = self.client_codes[positions[found]] == client_ids[found]
+        return np.where(found, positions, -1)
+
+    def client_rows(self, client_ids: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Строки клиентов client_ids: (номер клиента в client_ids, номер строки в таблице).
+        """
+        positions = self.positions(client_ids)
+        present = positions >= 0
+        starts = np.where(present, self.offsets[np.maximum(positions, 0)], 0)
+        lengths = np.where(present, self.offsets[np.maximum(positions, 0) + 1] - starts, 0)
+        owner = np.repeat(np.arange(len(client_ids), dtype=np.int64), lengths)
+        return owner, _row_positions(starts, lengths)
+
+    def group_sums(self, client_ids: Sequence[int], column: str):
+        """
+        Суммы и количества строк по (клиент, значение column) для client_ids.
+
+        Один np.bincount по строкам выбранных клиентов, суммирование во float64.
+
+        Returns:
+            (словарь column, суммы [клиенты x значения], количества [клиенты x значения])
+        """
+        owner, rows = self.client_rows(client_ids)
+        values = self.columns[column][rows]
+        # Строки без значения (код -1) в группы не попадают, как в groupby
+        known = values >= 0
+        owner, values, rows = owner[known], values[known], rows[known]
+
+        names = self.categories[column]
+        keys = owner * len(names) + values
+        size = len(client_ids) * len(names)
+        amounts = self.columns['amount'][rows].astype(np.float64)
+        sums = np.bincount(keys, weights=amounts, minlength=size).reshape(len(client_ids), len(names))
+        counts = np.bincount(keys, minlength=size).reshape(len(client_ids), len(names))
+        return names, sums, counts
+
+    def time_series(self, client_ids: Sequence[int], column: str, weekly: bool = False,
+                    sums: bool = True) -> TimeSeries:
+        """
+        Временные агрегаты (timeseries.py) по column; даты уже хранятся секундами.
+        """
+        owner, rows = self.client_rows(client_ids)
+        return TimeSeries.build(owner, to_seconds(self.columns['date'][rows]), self.columns[column][rows],
+                                self.columns['amount'][rows], len(client_ids), self.categories[column], weekly, sums)
@@ -0,0 +1,428 @@
+# data_store.py
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+import columnar
+from compact import CompactTable
+from features import ClientFeatures, balance_statistics
+from fx import FxRates, load_rates
+from metrics import inc, timer
+
+
+# Каталог данных можно переопределить, например для синтетических данных бенчмарка
+DATA_DIRECTORY = os.getenv('DATA_DIRECTORY', 'case1')
+DEFAULT_MAX_CLIENTS = 256
+# Все клиенты резидентно в compact.py вместо LRU из DataFrame
+COMPACT = os.getenv('DATA_STORE_COMPACT', 'off') == 'on'
+COMPACT_CHUNK_SIZE = int(os.getenv('DATA_STORE_COMPACT_CHUNK', '5000'))
+# Повторяются в каждой строке профиля - храним как категории
+PROFILE_CATEGORICAL = ('status', 'city')
+
+
+class ClientDataStore:
+    """
+    Общее для процесса хранилище данных клиентов.
+
+    Профили (clients.csv) читаются один раз, транзакции и переводы - лениво
+    по клиенту с ограничением LRU. Каждая запись помнит mtime файла и
+    перечитывается, если файл изменился на диске.
+
+    Если данные сконвертированы в Parquet (columnar.py), клиент читается из
+    него через mmap; CSV используется, если Parquet нет или CSV новее.
+
+    В режиме compact (DATA_STORE_COMPACT=on) warmup() загружает клиентов в
+    две CompactTable на всё хранилище: агрегаты и пакетные скоры считаются
+    по срезам массивов, а LRU используется только для клиентов, чьи файлы
+    изменились после загрузки.
+
+    Суммы в валюте переводятся в тенге (fx.py) один раз при чтении, поэтому
+    кэш и компактные таблицы хранят уже нормализованные суммы и
+    сбрасываются, если меняется таблица курсов.
+    """
+
+    def __init__(self, data_dir: str = DATA_DIRECTORY, max_clients: int = DEFAULT_MAX_CLIENTS,
+                 compact: bool = COMPACT):
+        self.data_dir = data_dir
+        self.max_clients = max_clients
+        self.compact = compact
+        self.profiles_path = os.path.join(data_dir, 'clients.csv')
+        self._lock = threading.RLock()
+        self._profiles: Optional[pd.DataFrame] = None
+        self._profiles_mtime: Optional[float] = None
+        self._balance_stats: Optional[Dict[str, float]] = None
+        # client_id -> (источник транзакций, источник переводов, транзакции, переводы)
+        self._clients: "OrderedDict[int, Tuple[tuple, tuple, pd.DataFrame, pd.DataFrame]]" = OrderedDict()
+        # client_id -> блокировка чтения клиента с диска (одно чтение на клиента)
+        self._loading: Dict[int, threading.Lock] = {}
+        # (транзакции, переводы) - заменяются целиком одним присваиванием
+        self._compact: Optional[Tuple[CompactTable, CompactTable]] = None
+        self._rates_mtime: Optional[float] = None
+
+    def transactions_path(self, client_id: int) -> str:
+        return os.path.join(self.data_dir, f'client_{client_id}_transactions_3m.csv')
+
+    def transfers_path(self, client_id: int) -> str:
+        return os.path.join(self.data_dir, f'client_{client_id}_transfers_3m.csv')
+
+    def get_profiles(self) -> pd.DataFrame:
+        """
+        Возвращает все профили клиентов (индекс - client_code).
+        """
+        with self._lock:
+            self._refresh_profiles()
+            # Поверхностная копия: при copy-on-write изменения не попадут в кэш
+            return self._profiles.copy(deep=False)
+
+    def _refresh_profiles(self):
+        mtime = os.path.getmtime(self.profiles_path)
+        if self._profiles is None or self._profiles_mtime != mtime:
+            profiles = pd.read_csv(self.profiles_path).set_index('client_code')
+            for column in PROFILE_CATEGORICAL:
+                if column in profiles:
+                    profiles[column] = profiles[column].astype('category')
+            self._profiles = profiles
+            self._profiles_mtime = mtime
+            self._balance_stats = None
+
+    def get_balance_statistics(self) -> Dict[str, float]:
+        """
+        Статистики баланса по всем профилям - считаются один раз на версию clients.csv.
+        """
+        with self._lock:
+            self._refresh_profiles()
+            if self._balance_stats is None:
+                self._balance_stats = balance_statistics(self._profiles)
+            return dict(self._balance_stats)
+
+    def get_profile(self, client_id: int) -> pd.Series:
+        return self.get_profiles().loc[client_id]
+
+    def _source(self, client_id: int, kind: str) -> tuple:
+        """
+        Выбирает источник данных клиента: ('parquet', mtime) или ('csv', mtime).
+        """
+        csv_path = self.transactions_path(client_id) if kind == 'transactions' else self.transfers_path(client_id)
+        try:
+            csv_mtime = os.path.getmtime(csv_path)
+        except FileNotFoundError:
+            csv_mtime = None
+        table = columnar.open_table(self.data_dir, kind)
+        if table is not None and client_id in table and (csv_mtime is None or csv_mtime <= table.mtime):
+            return ('parquet', table.mtime)
+        if csv_mtime is None:
+            raise FileNotFoundError(csv_path)
+        return ('csv', csv_mtime)
+
+    def fingerprint(self, client_id: int) -> Tuple[tuple, tuple, tuple]:
+        """
+        Версия данных клиента: источники и mtime транзакций и переводов и
+        mtime таблицы курсов. Меняется, когда файл клиента (или Parquet)
+        переписан на диске или обновились курсы.
+        """
+        return (self._source(client_id, 'transactions'), self._source(client_id, 'transfers'),
+                ('fx', self._rates().mtime))
+
+    def profiles_mtime(self) -> float:
+        return os.path.getmtime(self.profiles_path)
+
+    def _rates(self) -> FxRates:
+        """
+        Таблица курсов; если она изменилась на диске, кэш данных сбрасывается -
+        суммы в нём пересчитаны по старым курсам.
+        """
+        rates = load_rates()
+        if rates.mtime != self._rates_mtime:
+            with self._lock:
+                if rates.mtime != self._rates_mtime:
+                    self._clients.clear()
+                    self._compact = None
+                    self._rates_mtime = rates.mtime
+        return rates
+
+    def _read(self, client_id: int, kind: str, source: tuple) -> pd.DataFrame:
+        if source[0] == 'parquet':
+            df = columnar.open_table(self.data_dir, kind).read_client(client_id)
+        else:
+            csv_path = self.transactions_path(client_id) if kind == 'transactions' else self.transfers_path(client_id)
+            df = columnar.read_csv(csv_path, kind)
+        return self._rates().to_kzt(df)
+
+    def _compact_tables(self, client_id: int, sources: Tuple[tuple, tuple]) -> Optional[Tuple[CompactTable, CompactTable]]:
+        """
+        Компактные таблицы, если в них актуальная версия данных клиента.
+        """
+        tables = self._compact
+        if tables is None:
+            return None
+        for table, source in zip(tables, sources):
+            if table.mtime(client_id) != source[1]:
+                return None
+        return tables
+
+    def get_client_frames(self, client_id: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Возвращает (транзакции, переводы) клиента из кэша или с диска.
+        """
+        self._rates()
+        transactions_source = self._source(client_id, 'transactions')
+        transfers_source = self._source(client_id, 'transfers')
+
+        tables = self._compact_tables(client_id, (transactions_source, transfers_source))
+        if tables is not None:
+            inc('data_store_lookups_total', result='compact')
+            return tables[0].to_frame(client_id), tables[1].to_frame(client_id)
+
+        sources = (transactions_source, transfers_source)
+        entry = self._cached(client_id, sources)
+        if entry is None:
+            with self._lock:
+                loading = self._loading.setdefault(client_id, threading.Lock())
+            # Диск читается вне общей блокировки: холодные загрузки разных
+            # клиентов идут параллельно, а один клиент читается один раз
+            with loading:
+                entry = self._cached(client_id, sources)
+                if entry is None:
+                    inc('data_store_lookups_total', result='miss')
+                    entry = (
+                        transactions_source,
+                        transfers_source,
+                        self._read(client_id, 'transactions', transactions_source),
+                        self._read(client_id, 'transfers', transfers_source),
+                    )
+                    with self._lock:
+                        self._clients[client_id] = entry
+                        self._clients.move_to_end(client_id)
+                        while len(self._clients) > self.max_clients:
+                            self._clients.popitem(last=False)
+                with self._lock:
+                    if self._loading.get(client_id) is loading:
+                        del self._loading[client_id]
+        return entry[2].copy(deep=False), entry[3].copy(deep=False)
+
+    def _cached(self, client_id: int, sources: Tuple[tuple, tuple]):
+        """
+        Запись LRU клиента, если она прочитана из тех же источников, иначе None.
+        """
+        with self._lock:
+            entry = self._clients.get(client_id)
+            if entry is None or (entry[0], entry[1]) != sources:
+                return None
+            self._clients.move_to_end(client_id)
+            inc('data_store_lookups_total', result='hit')
+            return entry
+
+    def get_client_features(self, client_id: int) -> ClientFeatures:
+        """
+        Агрегаты клиента; в режиме compact - прямо по срезам массивов, без DataFrame.
+        """
+        self._rates()
+        sources = (self._source(client_id, 'transactions'), self._source(client_id, 'transfers'))
+        tables = self._compact_tables(client_id, sources)
+        if tables is None:
+            return ClientFeatures(*self.get_client_frames(client_id))
+        inc('data_store_lookups_total', result='compact')
+        return ClientFeatures.from_compact(tables[0], tables[1], client_id)
+
+    def _read_compact(self, client_ids: List[int]) -> Tuple[CompactTable, CompactTable]:
+        """
+        Читает клиентов с диска (Parquet одним проходом, CSV по одному) минуя LRU.
+        """
+        tables = []
+        for kind in ('transactions', 'transfers'):
+            frames, bulk, mtimes = [], [], {}
+            for client_id in client_ids:
+                try:
+                    source = self._source(client_id, kind)
+                except FileNotFoundError:
+                    continue
+                mtimes[client_id] = source[1]
+                if source[0] == 'parquet':
+                    bulk.append(client_id)
+                else:
+                    frames.append(self._read(client_id, kind, source))
+            if bulk:
+                table = columnar.open_table(self.data_dir, kind)
+                frames.append(self._rates().to_kzt(table.read_clients(bulk, columns=columnar.COLUMNS[kind])))
+            df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columnar.COLUMNS[kind])
+            tables.append(CompactTable.from_frame(df, kind, mtimes))
+        return tables[0], tables[1]
+
+    def load_compact(self, client_ids: Optional[Iterable[int]] = None,
+                     chunk_size: int = COMPACT_CHUNK_SIZE) -> int:
+        """
+        Загружает клиентов (по умолчанию всех из clients.csv) в компактные
+        таблицы. Клиенты, уже загруженные с той же версией файлов, не
+        перечитываются. Читается пачками по chunk_size, чтобы в памяти не
+        было DataFrame всех клиентов сразу. Возвращает число клиентов в таблицах.
+        """
+        self._rates()
+        if client_ids is None:
+            client_ids = self.get_profiles().index
+        stale = []
+        for client_id in client_ids:
+            client_id = int(client_id)
+            try:
+                sources = (self._source(client_id, 'transactions'), self._source(client_id, 'transfers'))
+            except FileNotFoundError:
+                continue
+            if self._compact_tables(client_id, sources) is None:
+                stale.append(client_id)
+
+        if stale:
+            with timer('data_store.load_compact'):
+                chunks = [self._read_compact(stale[i:i + chunk_size]) for i in range(0, len(stale), chunk_size)]
+                with self._lock:
+                    old = [self._compact] if self._compact is not None else []
+                    parts = old + chunks
+                    self._compact = (CompactTable.concat([p[0] for p in parts]),
+                                     CompactTable.concat([p[1] for p in parts]))
+                    # Эти клиенты больше не нужны в LRU
+                    for client_id in stale:
+                        self._clients.pop(client_id, None)
+        return len(self._compact[0]) if self._compact is not None else 0
+
+    def get_compact_tables(self, client_ids: Iterable[int]) -> Tuple[CompactTable, CompactTable, List[int]]:
+        """
+        Компактные таблицы с актуальными данными client_ids (догружает
+        изменившихся клиентов) для пакетного подсчёта скоров.
+
+        Returns:
+            (транзакции, переводы, список ID без данных)
+        """
+        client_ids = list(client_ids)
+        profiles = self.get_profiles()
+        self.load_compact([c for c in client_ids if c in profiles.index])
+        tables = self._compact or (CompactTable.empty('transactions'), CompactTable.empty('transfers'))
+        missing = [c for c in client_ids
+                   if c not in profiles.index or c not in tables[0] or c not in tables[1]]
+        return tables[0], tables[1], missing
+
+    def get_batch_frames(self, client_ids: Iterable[int]) -> Tuple[pd.DataFrame, pd.DataFrame, List[int]]:
+        """
+        Транзакции и переводы многих клиентов одним DataFrame каждый.
+
+        Клиенты с актуальным Parquet читаются одним проходом по файлу, минуя
+        LRU; остальные - по одному через get_client_frames.
+
+        Returns:
+            (транзакции, переводы, список ID без данных)
+        """
+        profiles = self.get_profiles()
+        rates = self._rates()
+        bulk, single, missing = [], [], []
+        for client_id in client_ids:
+            if client_id not in profiles.index:
+                missing.append(client_id)
+                continue
+            try:
+                sources = (self._source(client_id, 'transactions'), self._source(client_id, 'transfers'))
+            except FileNotFoundError:
+                missing.append(client_id)
+                continue
+            if sources[0][0] == 'parquet' and sources[1][0] == 'parquet':
+                bulk.append(client_id)
+            else:
+                single.append(client_id)
+
+        transactions, transfers = [], []
+        if bulk:
+            transactions.append(rates.to_kzt(columnar.open_table(self.data_dir, 'transactions').read_clients(bulk)))
+            transfers.append(rates.to_kzt(columnar.open_table(self.data_dir, 'transfers').read_clients(bulk)))
+        for client_id in single:
+            tx, tr = self.get_client_frames(client_id)
+            transactions.append(tx)
+            transfers.append(tr)
+
+        def concat(frames: List[pd.DataFrame], kind: str) -> pd.DataFrame:
+            if not frames:
+                return pd.DataFrame(columns=columnar.COLUMNS[kind])
+            return pd.concat(frames, ignore_index=True)
+
+        return concat(transactions, 'transactions'), concat(transfers, 'transfers'), missing
+
+    def warmup(self, client_ids: Iterable[int]) -> int:
+        """
+        Заранее загружает профили и данные клиентов в кэш (в режиме compact -
+        в компактные таблицы). Возвращает число загруженных клиентов.
+        """
+        profiles = self.get_profiles()
+        if self.compact:
+            client_ids = [c for c in client_ids if c in profiles.index]
+            self.load_compact(client_ids)
+            return sum(1 for c in client_ids if c in self._compact[0]) if self._compact is not None else 0
+        loaded = 0
+        for client_id in client_ids:
+            try:
+                self.get_client_frames(client_id)
+                loaded += 1
+            except FileNotFoundError:
+                continue
+        return loaded
+
+    def invalidate(self, client_id: Optional[int] = None):
+        """
+        Сбрасывает кэш одного клиента или всего хранилища.
+        """
+        with self._lock:
+            if client_id is None:
+                self._clients.clear()
+                self._compact = None
+                self._profiles = None
+                self._profiles_mtime = None
+                self._balance_stats = None
+            else:
+                self._clients.pop(client_id, None)
+                if self._compact is not None:
+                    for table in self._compact:
+                        position = table.position(client_id)
+                        if position >= 0:
+                            # Версия NaN ни с чем не совпадает - клиент будет перечитан
+                            table.mtimes[position] = float('nan')
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {'cached_clients': len(self._clients), 'max_clients': self.max_clients}
+            if self._compact is not None:
+                stats['compact_clients'] = len(self._compact[0])
+                stats['compact_rows'] = self._compact[0].rows + self._compact[1].rows
+                stats['compact_bytes'] = self._compact[0].nbytes + self._compact[1].nbytes
+            return stats
+
+
+    def memory_usage(self) -> int:
+        """
+        Байты данных клиентов в памяти: DataFrame в LRU и компактные таблицы.
+        """
+        with self._lock:
+            frames = [df for entry in self._clients.values() for df in entry[2:]]
+            tables = self._compact or ()
+        return (sum(int(df.memory_usage(deep=True).sum()) for df in frames)
+                + sum(table.nbytes for table in tables))
+
+
+_stores: Dict[str, ClientDataStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(data_dir: str = DATA_DIRECTORY) -> ClientDataStore:
+    """
+    Возвращает общее хранилище для каталога данных (одно на процесс).
+    """
+    with _stores_lock:
+        store = _stores.get(data_dir)
+        if store is None:
+            store = ClientDataStore(data_dir)
+            _stores[data_dir] = store
+        return store
+
+
+def warmup(data_dir: str = DATA_DIRECTORY, client_ids: Iterable[int] = ()) -> int:
+    """
+    Прогрев общего хранилища; подходит как initializer для пула процессов.
+    """
+    return get_store(data_dir).warmup(client_ids)
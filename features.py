@@ -0,0 +1,136 @@
+# features.py
+
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from timeseries import TimeSeries, slope
+
+
+class ClientFeatures:
+    """
+    Агрегаты клиента, посчитанные за один групповой проход по его данным.
+
+    Все calculate_*/calc_* методы ClientAnalyzer читают отсюда вместо
+    того, чтобы заново фильтровать и суммировать DataFrame. spend_time и
+    transfer_time - временные ряды по месяцам и неделям (timeseries.py).
+    """
+
+    def __init__(self, transactions_df: pd.DataFrame, transfers_df: pd.DataFrame):
+        self.has_transactions = not transactions_df.empty
+        self.has_transfers = not transfers_df.empty
+
+        amounts = transactions_df['amount']
+        self.spend_by_category: pd.Series = transactions_df.groupby('category', observed=True)['amount'].sum()
+        self.total_spend = float(amounts.sum())
+        self.transaction_count = len(transactions_df)
+        self.amount_mean = float(amounts.mean()) if self.has_transactions else float('nan')
+        self.amount_std = float(amounts.std()) if self.has_transactions else float('nan')
+
+        grouped = transfers_df.groupby('type', observed=True)['amount']
+        self.transfer_sum_by_type: pd.Series = grouped.sum()
+        self.transfer_count_by_type: pd.Series = grouped.size()
+        self.total_transfers = float(transfers_df['amount'].sum())
+        self.spend_time = TimeSeries.from_frame(transactions_df, 'category')
+        self.transfer_time = TimeSeries.from_frame(transfers_df, 'type')
+        self._build_lookups()
+
+    @classmethod
+    def from_compact(cls, transactions: Any, transfers: Any, client_id: int) -> 'ClientFeatures':
+        """
+        Те же агрегаты по срезам compact.CompactTable, без построения DataFrame.
+        """
+        features = cls.__new__(cls)
+        amounts = _amounts(transactions, client_id)
+        transfer_amounts = _amounts(transfers, client_id)
+        features.has_transactions = len(amounts) > 0
+        features.has_transfers = len(transfer_amounts) > 0
+
+        categories, spend, spend_counts = transactions.group_sums([client_id], 'category')
+        features.spend_by_category = _group_series(categories, spend[0], spend_counts[0], 'category')
+        features.total_spend = float(amounts.sum())
+        features.transaction_count = len(amounts)
+        features.amount_mean = float(amounts.mean()) if features.has_transactions else float('nan')
+        features.amount_std = float(amounts.std(ddof=1)) if len(amounts) > 1 else float('nan')
+
+        types, sums, counts = transfers.group_sums([client_id], 'type')
+        features.transfer_sum_by_type = _group_series(types, sums[0], counts[0], 'type')
+        features.transfer_count_by_type = _group_series(types, counts[0], counts[0], 'type')
+        features.total_transfers = float(transfer_amounts.sum())
+        features.spend_time = transactions.time_series([client_id], 'category', weekly=True)
+        features.transfer_time = transfers.time_series([client_id], 'type', weekly=True)
+        features._build_lookups()
+        return features
+
+    def _build_lookups(self):
+        # Обычные dict: выборка по списку категорий без накладных расходов pandas
+        self._spend = {str(k): float(v) for k, v in self.spend_by_category.items()}
+        self._transfer_sum = {str(k): float(v) for k, v in self.transfer_sum_by_type.items()}
+        self._transfer_count = {str(k): int(v) for k, v in self.transfer_count_by_type.items()}
+
+    def spend(self, categories: Iterable[str]) -> float:
+        return sum(self._spend.get(c, 0.0) for c in categories)
+
+    def transfer_sum(self, types: Iterable[str]) -> float:
+        return sum(self._transfer_sum.get(t, 0.0) for t in types)
+
+    def transfer_count(self, types: Iterable[str]) -> int:
+        return sum(self._transfer_count.get(t, 0) for t in types)
+
+    @property
+    def monthly_spend(self) -> pd.DataFrame:
+        """
+        Траты по месяцам (строки) и категориям (столбцы).
+        """
+        return self.spend_time.client_frame()
+
+    @property
+    def weekly_spend(self) -> pd.DataFrame:
+        return self.spend_time.client_frame(weekly=True)
+
+    def spend_trends(self) -> pd.Series:
+        """
+        Наклон трат по месяцам для каждой категории, тенге в месяц.
+        """
+        monthly = self.monthly_spend
+        return pd.Series(slope(monthly.to_numpy().T), index=monthly.columns)
+
+    def recurrence(self, types: Iterable[str]) -> Dict[str, float]:
+        """
+        Регулярность переводов types: число, месяцы с переводом из месяцев
+        истории и коэффициент вариации интервалов между ними.
+        """
+        types = list(types)
+        series = self.transfer_time
+        return {
+            'count': self.transfer_count(types),
+            'active_months': int(series.active_months(types)[0]),
+            'months': int(series.client_months[0]),
+            'interval_cv': float(series.interval_cv(types)[0]),
+        }
+
+
+def _amounts(table: Any, client_id: int) -> np.ndarray:
+    if client_id not in table:
+        return np.empty(0)
+    return table.slice(client_id)['amount'].astype(np.float64)
+
+
+def _group_series(names: List[str], values: np.ndarray, counts: np.ndarray, index_name: str) -> pd.Series:
+    # Как groupby(observed=True): только значения, которые встречаются у клиента
+    present = counts > 0
+    return pd.Series(values[present], index=pd.Index(np.array(names, dtype=object)[present], name=index_name))
+
+
+def balance_statistics(profiles: pd.DataFrame) -> Dict[str, float]:
+    """
+    Статистики среднемесячного баланса по всем клиентам.
+    """
+    balance_data = profiles['avg_monthly_balance_KZT']
+    quantiles = balance_data.quantile([0.75, 0.85, 0.95])
+    return {
+        "mean": balance_data.mean(), "median": balance_data.median(),
+        "75%": quantiles[0.75], "85%": quantiles[0.85],
+        "95%": quantiles[0.95]
+    }
@@ -0,0 +1,105 @@
+# fx.py
+
+import os
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from metrics import inc, timer
+
+
+# Курсы: date,currency,rate - сколько тенге стоит единица валюты с этой даты
+FX_RATES_PATH = os.getenv('FX_RATES', 'fx_rates.csv')
+BASE_CURRENCY = 'KZT'
+
+
+class FxRates:
+    """
+    Таблица курсов к тенге, отсортированная по дате (для merge_asof).
+    """
+
+    def __init__(self, table: pd.DataFrame, path: Optional[str] = None, mtime: Optional[float] = None):
+        self.table = table.sort_values('date', kind='stable').reset_index(drop=True)
+        self.path = path
+        self.mtime = mtime
+        # Для операций раньше первой даты таблицы берётся самый ранний курс
+        self.first: Dict[str, float] = self.table.groupby('currency')['rate'].first().to_dict()
+
+    @property
+    def currencies(self):
+        return set(self.first) | {BASE_CURRENCY}
+
+    def to_kzt(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Переводит amount в тенге по курсу на дату операции.
+
+        Один merge_asof по дате для всех валютных строк (курс - последний,
+        опубликованный не позже даты). Если все строки в тенге, DataFrame
+        возвращается как есть. Колонка currency остаётся исходной валютой.
+        """
+        if df.empty or 'currency' not in df:
+            return df
+        foreign = (df['currency'] != BASE_CURRENCY).to_numpy(dtype=bool)
+        if not foreign.any():
+            return df
+
+        with timer('fx.to_kzt'):
+            positions = np.flatnonzero(foreign)
+            rows = pd.DataFrame({
+                'position': positions,
+                'date': df['date'].to_numpy()[positions].astype(self.table['date'].dtype),
+                'currency': df['currency'].to_numpy()[positions].astype(str),
+            }).sort_values('date', kind='stable')
+            merged = pd.merge_asof(rows, self.table, on='date', by='currency', direction='backward')
+            rate = merged['rate'].fillna(merged['currency'].map(self.first))
+
+            unknown = merged.loc[rate.isna(), 'currency'].unique()
+            if len(unknown):
+                raise ValueError(f"Нет курса к {BASE_CURRENCY} для {sorted(unknown)} в {self.path}")
+
+            amounts = df['amount'].to_numpy(dtype=np.float64, copy=True)
+            amounts[merged['position'].to_numpy()] *= rate.to_numpy()
+            inc('fx_converted_rows_total', len(positions))
+            return df.assign(amount=amounts)
+
+
+    def convert(self, amount: float, currency: Optional[str], date=None) -> float:
+        """
+        Одна сумма в тенге (например, событие incremental.py); без даты - по курсу на сейчас.
+        """
+        if not currency or currency == BASE_CURRENCY:
+            return amount
+        row = pd.DataFrame({'date': [pd.Timestamp(date) if date is not None else pd.Timestamp.now()],
+                            'currency': [currency], 'amount': [amount]})
+        return float(self.to_kzt(row)['amount'].iloc[0])
+
+
+_rates: Dict[str, FxRates] = {}
+_rates_lock = threading.Lock()
+
+
+def load_rates(path: str = FX_RATES_PATH) -> FxRates:
+    """
+    Курсы из CSV; читаются один раз и заново - при изменении файла.
+    Без файла таблица пустая: данные только в тенге проходят как есть.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        mtime = None
+    with _rates_lock:
+        rates = _rates.get(path)
+        if rates is None or rates.mtime != mtime:
+            if mtime is None:
+                table = pd.DataFrame({'date': pd.Series(dtype='datetime64[us]'),
+                                      'currency': pd.Series(dtype=str), 'rate': pd.Series(dtype=float)})
+            else:
+                table = pd.read_csv(path, parse_dates=['date'], dtype={'currency': str, 'rate': float})
+            rates = _rates[path] = FxRates(table, path, mtime)
+        return rates
+
+
+def to_kzt(df: pd.DataFrame, path: str = FX_RATES_PATH) -> pd.DataFrame:
+    return load_rates(path).to_kzt(df)
@@ -0,0 +1,269 @@
+# incremental.py
+
+import json
+import math
+import os
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional, TextIO
+
+import pandas as pd
+
+from data_store import ClientDataStore, get_store
+from features import ClientFeatures
+from fx import load_rates
+from timeseries import RunningTimeSeries, to_seconds
+
+
+class RunningFeatures:
+    """
+    Агрегаты клиента, обновляемые по одному событию.
+
+    Повторяет интерфейс ClientFeatures, поэтому ClientAnalyzer считает скоры
+    по ним без чтения истории. Суммы обновляются за O(1), среднее и дисперсия
+    сумм транзакций ведутся алгоритмом Уэлфорда (для
+    calculate_dep_savings_score). Временные ряды (spend_time, transfer_time)
+    ведутся RunningTimeSeries и тоже обновляются каждым событием, поэтому
+    проверка регулярности (rules._recurring_transfers) видит те же месяцы и
+    интервалы, что и ClientFeatures по истории с этими событиями.
+    """
+
+    def __init__(self):
+        self._spend: Dict[str, float] = {}
+        self._transfer_sum: Dict[str, float] = {}
+        self._transfer_count: Dict[str, int] = {}
+        self.total_spend = 0.0
+        self.total_transfers = 0.0
+        self.transaction_count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._spend_series = RunningTimeSeries()
+        self._transfer_series = RunningTimeSeries()
+
+    @classmethod
+    def from_frames(cls, transactions_df: pd.DataFrame, transfers_df: pd.DataFrame) -> 'RunningFeatures':
+        """
+        Начальное состояние из полной истории клиента (один проход при старте).
+        """
+        features = ClientFeatures(transactions_df, transfers_df)
+        state = cls()
+        state._spend = dict(features._spend)
+        state._transfer_sum = dict(features._transfer_sum)
+        state._transfer_count = dict(features._transfer_count)
+        state.total_spend = features.total_spend
+        state.total_transfers = features.total_transfers
+        state.transaction_count = features.transaction_count
+        state._spend_series = RunningTimeSeries.from_frame(transactions_df, 'category')
+        state._transfer_series = RunningTimeSeries.from_frame(transfers_df, 'type')
+        if state.transaction_count:
+            state._mean = features.amount_mean
+            std = features.amount_std if state.transaction_count > 1 else 0.0
+            state._m2 = std * std * (state.transaction_count - 1)
+        return state
+
+    def add_transaction(self, category: str, amount: float, seconds: int):
+        self._spend_series.add(category, seconds, amount)
+        self._spend[category] = self._spend.get(category, 0.0) + amount
+        self.total_spend += amount
+        self.transaction_count += 1
+        delta = amount - self._mean
+        self._mean += delta / self.transaction_count
+        self._m2 += delta * (amount - self._mean)
+
+    def add_transfer(self, transfer_type: str, amount: float, seconds: int):
+        self._transfer_series.add(transfer_type, seconds, amount)
+        self._transfer_sum[transfer_type] = self._transfer_sum.get(transfer_type, 0.0) + amount
+        self._transfer_count[transfer_type] = self._transfer_count.get(transfer_type, 0) + 1
+        self.total_transfers += amount
+
+    @property
+    def spend_time(self):
+        return self._spend_series.snapshot()
+
+    @property
+    def transfer_time(self):
+        return self._transfer_series.snapshot()
+
+    @property
+    def has_transactions(self) -> bool:
+        return self.transaction_count > 0
+
+    @property
+    def has_transfers(self) -> bool:
+        return sum(self._transfer_count.values()) > 0
+
+    @property
+    def amount_mean(self) -> float:
+        return self._mean if self.transaction_count else float('nan')
+
+    @property
+    def amount_std(self) -> float:
+        # ddof=1, как pandas.Series.std()
+        if self.transaction_count < 2:
+            return float('nan')
+        return math.sqrt(self._m2 / (self.transaction_count - 1))
+
+    @property
+    def spend_by_category(self) -> pd.Series:
+        return pd.Series(self._spend, dtype=float)
+
+    def spend(self, categories: Iterable[str]) -> float:
+        return sum(self._spend.get(c, 0.0) for c in categories)
+
+    def transfer_sum(self, types: Iterable[str]) -> float:
+        return sum(self._transfer_sum.get(t, 0.0) for t in types)
+
+    def transfer_count(self, types: Iterable[str]) -> int:
+        return sum(self._transfer_count.get(t, 0) for t in types)
+
+
+def parse_event(line: str) -> Optional[Dict[str, Any]]:
+    """
+    Разбирает строку JSONL в событие. Транзакция - объект с полем category,
+    перевод - с полем type (схема как в client_*_3m.csv). Пустая строка - None.
+
+    client_code приводится к int, amount - к конечному float. Некорректное
+    событие - ValueError с причиной, чтобы поток мог его пропустить.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        event = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"не JSON: {e}") from None
+    if not isinstance(event, dict) or 'client_code' not in event or 'amount' not in event:
+        raise ValueError("нужны поля client_code и amount")
+    if 'category' not in event and 'type' not in event:
+        raise ValueError("нужно поле category (транзакция) или type (перевод)")
+    for field, cast in (('client_code', int), ('amount', float)):
+        try:
+            event[field] = cast(event[field])
+        except (TypeError, ValueError):
+            raise ValueError(f"некорректное поле {field}={event[field]!r}") from None
+    if not math.isfinite(event['amount']):
+        raise ValueError(f"некорректное поле amount={event['amount']!r}")
+    currency = event.get('currency')
+    if currency is not None and not isinstance(currency, str):
+        raise ValueError(f"некорректная валюта currency={currency!r}")
+    return event
+
+
+def follow(f: TextIO, poll_interval: float = 0.5) -> Iterator[str]:
+    """
+    Читает файл как `tail -f`: отдаёт новые строки по мере дозаписи.
+    """
+    while True:
+        line = f.readline()
+        if line:
+            yield line
+        else:
+            time.sleep(poll_interval)
+
+
+class IncrementalScorer:
+    """
+    Держит RunningFeatures для каждого клиента и пересчитывает решение execute()
+    после каждого события.
+    """
+
+    def __init__(self, store: ClientDataStore = None, output_filename: Optional[str] = None):
+        self.store = store if store is not None else get_store()
+        self.output_filename = output_filename
+        self.states: Dict[int, RunningFeatures] = {}
+        self.decisions: Dict[int, str] = {}
+
+    def state(self, client_id: int) -> RunningFeatures:
+        state = self.states.get(client_id)
+        if state is None:
+            try:
+                transactions_df, transfers_df = self.store.get_client_frames(client_id)
+                state = RunningFeatures.from_frames(transactions_df, transfers_df)
+            except FileNotFoundError:
+                # Новый клиент без истории
+                state = RunningFeatures()
+            self.states[client_id] = state
+        return state
+
+    def recommend(self, client_id: int):
+        from analyzer import ClientAnalyzer
+
+        analyzer = ClientAnalyzer(client_id, self.output_filename, self.store, features=self.state(client_id))
+        return analyzer.recommend()
+
+    def apply(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Применяет событие и возвращает актуальное решение для клиента.
+        Событие клиента без профиля или в неизвестной валюте - ValueError,
+        состояние при этом не меняется.
+        """
+        client_id = int(event['client_code'])
+        if client_id not in self.states and client_id not in self.store.get_profiles().index:
+            # Без профиля (баланс, статус) скоры не считаются - как и в execute()
+            raise ValueError(f"клиента {client_id} нет в clients.csv")
+        # История уже в тенге (data_store), события приводим так же - до изменения
+        # состояния, чтобы неизвестная валюта или дата (ValueError) его не портили
+        date = pd.Timestamp(event['date']) if event.get('date') is not None else pd.Timestamp.now()
+        amount = load_rates().convert(float(event['amount']), event.get('currency'), date)
+        # Дата события - для временных рядов (месяц, неделя, интервалы)
+        seconds = int(to_seconds([date])[0])
+        if client_id not in self.states:
+            # Решение по истории до события - чтобы changed было честным
+            self.decisions[client_id] = self.recommend(client_id)[0]
+        state = self.state(client_id)
+        if 'category' in event:
+            state.add_transaction(str(event['category']), amount, seconds)
+        else:
+            state.add_transfer(str(event['type']), amount, seconds)
+
+        product, value = self.recommend(client_id)
+        changed = self.decisions.get(client_id) != product
+        self.decisions[client_id] = product
+        return {'client_code': client_id, 'product': product, 'value': value, 'changed': changed}
+
+    def push(self, decision: Dict[str, Any]) -> Dict:
+        from notifications import send_push_notification
+        from result_sink import get_sink
+
+        row = send_push_notification(decision['client_code'], decision['product'], decision['value'])
+        if self.output_filename:
+            get_sink(self.output_filename).write(row)
+        return row
+
+
+if __name__ == '__main__':
+    import argparse
+    import contextlib
+    import io
+
+    parser = argparse.ArgumentParser(description="Инкрементальный пересчёт рекомендаций по потоку событий")
+    parser.add_argument("source", nargs="?", default="-", help="JSONL-файл событий или '-' для stdin")
+    parser.add_argument("--follow", action="store_true", help="Читать файл как tail -f")
+    parser.add_argument("--push", action="store_true", help="Отправлять пуш, когда рекомендация изменилась")
+    parser.add_argument("--output", default=os.path.join("out", "recommendations_incremental.csv"), help="Файл для пушей")
+    args = parser.parse_args()
+
+    scorer = IncrementalScorer(output_filename=args.output)
+    source = sys.stdin if args.source == "-" else open(args.source, encoding="utf-8")
+    lines = follow(source) if args.follow else source
+    try:
+        for line in lines:
+            try:
+                event = parse_event(line)
+                if event is None:
+                    continue
+                # Логи загрузки ClientAnalyzer не смешиваем с выводом решений
+                with contextlib.redirect_stdout(io.StringIO()):
+                    decision = scorer.apply(event)
+            except Exception as e:
+                # Одно плохое событие не останавливает поток
+                print(f"Событие пропущено ({e}): {line.strip()[:200]}", file=sys.stderr, flush=True)
+                continue
+            print(json.dumps(decision, ensure_ascii=False), flush=True)
+            if args.push and decision['changed']:
+                scorer.push(decision)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if source is not sys.stdin:
+            source.close()
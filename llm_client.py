@@ -0,0 +1,170 @@
+# llm_client.py
+
+import asyncio
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from metrics import inc, timer
+
+if TYPE_CHECKING:
+    import httpx
+    import requests
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def build_payload(prompt: str) -> Dict[str, Any]:
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {"text": prompt}
+                ]
+            }
+        ]
+    }
+
+
+def parse_response(data: Dict[str, Any]) -> str:
+    # Gemini returns the result in response.json()['candidates'][0]['content']['parts'][0]['text']
+    return (
+        data.get('candidates', [{}])[0]
+            .get('content', {})
+            .get('parts', [{}])[0]
+            .get('text', '')
+    )
+
+
+class GeminiClient:
+    """
+    Gemini client with a persistent connection pool, a concurrency limit,
+    timeouts and exponential-backoff retries on 429/5xx.
+
+    Both `agenerate` (asyncio, httpx) and `generate` (blocking, requests.Session)
+    return None when the text could not be obtained, so the caller can fall
+    back to its template. httpx and requests are imported by the first call
+    that needs them, so a process only loads the library of the path it uses.
+    """
+
+    def __init__(self, api_url: str, max_concurrency: int = 8, timeout: float = 20.0,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0):
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # httpx.AsyncClient and asyncio.Semaphore are bound to an event loop
+        self._async_client: Optional['httpx.AsyncClient'] = None
+        self._async_semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._session: Optional['requests.Session'] = None
+        self._sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._session_lock = threading.Lock()
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_base * (2 ** attempt), self.backoff_max)
+        return delay * (0.5 + random.random() / 2)
+
+    # --- asyncio ---
+
+    def _ensure_async(self):
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._loop is not loop:
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._async_client, self._async_semaphore
+
+    async def agenerate(self, prompt: str) -> Optional[str]:
+        import httpx
+
+        client, semaphore = self._ensure_async()
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    with timer('llm_request'):
+                        response = await client.post(self.api_url, json=build_payload(prompt))
+                    inc('llm_requests_total', status=str(response.status_code))
+                    if response.status_code == 200:
+                        return parse_response(response.json())
+                    print(f"GEMINI API error: {response.status_code}")
+                    if response.status_code not in RETRY_STATUSES:
+                        return None
+                    retry_after = response.headers.get('Retry-After')
+                except httpx.HTTPError as e:
+                    inc('llm_requests_total', status='error')
+                    print(f"GEMINI API exception: {e!r}")
+                if attempt < self.max_retries:
+                    inc('llm_retries_total')
+                    await asyncio.sleep(self._backoff(attempt, retry_after))
+        return None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_semaphore = None
+            self._loop = None
+
+    # --- blocking ---
+
+    def _ensure_session(self) -> 'requests.Session':
+        import requests
+
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def generate(self, prompt: str) -> Optional[str]:
+        import requests
+
+        session = self._ensure_session()
+        with self._sync_semaphore:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    with timer('llm_request'):
+                        response = session.post(self.api_url, json=build_payload(prompt), timeout=self.timeout)
+                    inc('llm_requests_total', status=str(response.status_code))
+                    if response.status_code == 200:
+                        return parse_response(response.json())
+                    print(f"GEMINI API error: {response.status_code}")
+                    if response.status_code not in RETRY_STATUSES:
+                        return None
+                    retry_after = response.headers.get('Retry-After')
+                except requests.RequestException as e:
+                    inc('llm_requests_total', status='error')
+                    print(f"GEMINI API exception: {e!r}")
+                if attempt < self.max_retries:
+                    inc('llm_retries_total')
+                    time.sleep(self._backoff(attempt, retry_after))
+        return None
+
+    def close(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
@@ -0,0 +1,77 @@
+# load_test.py
+
+import asyncio
+import statistics
+import time
+from typing import Dict, List
+
+import httpx
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_level(url: str, concurrency: int, requests_per_level: int, max_id: int) -> Dict[str, float]:
+    """
+    Отправляет requests_per_level запросов к /process_id, держа concurrency одновременно.
+    """
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    counter = iter(range(requests_per_level))
+
+    async def worker(client: httpx.AsyncClient):
+        for i in counter:
+            started = time.perf_counter()
+            response = await client.post(f"{url}/process_id", json={"id": i % max_id + 1})
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "ok": statuses.get(200, 0),
+        "rejected_503": statuses.get(503, 0),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+async def run(url: str, levels: List[int], requests_per_level: int, max_id: int) -> List[Dict[str, float]]:
+    results = []
+    for concurrency in levels:
+        results.append(await run_level(url, concurrency, max(requests_per_level, concurrency), max_id))
+    return results
+
+
+def print_results(results: List[Dict[str, float]]):
+    print(f"{'conc':>5} {'reqs':>6} {'200':>6} {'503':>6} {'rps':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for r in results:
+        print(f"{r['concurrency']:>5} {r['requests']:>6} {r['ok']:>6} {r['rejected_503']:>6} "
+              f"{r['rps']:>8.1f} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /process_id")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Адрес сервера")
+    parser.add_argument("--levels", default="1,10,100", help="Уровни параллельности через запятую")
+    parser.add_argument("--requests", type=int, default=200, help="Запросов на каждый уровень")
+    parser.add_argument("--max-id", type=int, default=60, help="ID клиентов берутся из 1..max-id")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(',')]
+    print_results(asyncio.run(run(args.url, levels, args.requests, args.max_id)))
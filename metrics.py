@@ -0,0 +1,232 @@
+# metrics.py
+
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+
+# Границы корзин гистограммы, секунды (как в клиентах Prometheus)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# cProfile для медленных запросов: включается, если задан PROFILE_SLOW_MS
+PROFILE_SLOW_MS = os.getenv('PROFILE_SLOW_MS')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0.1'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join('out', 'profiles'))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class StageStats:
+    """
+    Накопленная статистика одного этапа: количество, сумма, максимум и гистограмма.
+    """
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class Metrics:
+    """
+    Реестр метрик процесса: таймеры этапов, счётчики и текущие значения.
+
+    Потокобезопасен. В режиме пула процессов у каждого процесса свой реестр,
+    поэтому /metrics показывает только то, что выполнялось в самом сервере.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, StageStats] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = StageStats()
+            stats.observe(seconds)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def set_counter(self, name: str, value: float, **labels: str):
+        """
+        Счётчик, который ведёт сам объект (например, BoundedPool.rejected):
+        значение только растёт, поэтому экспортируется как counter, а не gauge.
+        """
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] = value
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+    def stages(self) -> Dict[str, StageStats]:
+        with self._lock:
+            return dict(self._stages)
+
+    def counters(self) -> Dict[Tuple[str, Labels], float]:
+        with self._lock:
+            return dict(self._counters)
+
+    def render_prometheus(self) -> str:
+        """
+        Метрики в текстовом формате Prometheus (version 0.0.4).
+        """
+        with self._lock:
+            stages = sorted(self._stages.items())
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+
+        lines: List[str] = []
+        if stages:
+            lines.append('# HELP stage_duration_seconds Время выполнения этапа конвейера')
+            lines.append('# TYPE stage_duration_seconds histogram')
+            for stage, stats in stages:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {stats.count}')
+                lines.append(f'stage_duration_seconds_sum{{stage="{stage}"}} {stats.total:.6f}')
+                lines.append(f'stage_duration_seconds_count{{stage="{stage}"}} {stats.count}')
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            declared = set()
+            for (name, labels), value in items:
+                if name not in declared:
+                    lines.append(f'# TYPE {name} {kind}')
+                    declared.add(name)
+                lines.append(f'{name}{_format_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def print_summary(self, title: str = "Время по этапам"):
+        """
+        Таблица этапов для конца пакетного запуска.
+        """
+        stages = sorted(self.stages().items(), key=lambda item: -item[1].total)
+        if not stages:
+            return
+        print(f"{title}:")
+        print(f"  {'этап':<44} {'вызовов':>8} {'всего, с':>10} {'среднее, мс':>12} {'макс, мс':>10}")
+        for stage, stats in stages:
+            mean_ms = stats.total / stats.count * 1000 if stats.count else 0.0
+            print(f"  {stage:<44} {stats.count:>8} {stats.total:>10.3f} {mean_ms:>12.3f} {stats.max * 1000:>10.3f}")
+        counters = self.counters()
+        if counters:
+            print("Счётчики:")
+            for (name, labels), value in sorted(counters.items()):
+                print(f"  {name + _format_labels(labels):<44} {value:>8g}")
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def timer(stage: str):
+    """
+    Замеряет время блока и записывает его в этап stage (работает и вокруг await).
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.observe(stage, time.perf_counter() - started)
+
+
+def timed(stage: str):
+    """
+    Декоратор: замеряет каждый вызов функции как этап stage.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                METRICS.observe(stage, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def inc(name: str, value: float = 1, **labels: str):
+    METRICS.inc(name, value, **labels)
+
+
+# Одновременно может работать только один cProfile
+_profile_lock = threading.Lock()
+
+
+def configure_profiling(slow_ms: Optional[float], sample_rate: Optional[float] = None):
+    """
+    Включает (или выключает при slow_ms=None) профилирование медленных вызовов.
+    """
+    global PROFILE_SLOW_MS, PROFILE_SAMPLE_RATE
+    PROFILE_SLOW_MS = None if slow_ms is None else str(slow_ms)
+    if sample_rate is not None:
+        PROFILE_SAMPLE_RATE = sample_rate
+
+
+@contextmanager
+def profiled(label: str, slow_ms: Optional[float] = None):
+    """
+    Выборочно профилирует блок через cProfile и сохраняет .prof, если блок
+    выполнялся дольше slow_ms (по умолчанию PROFILE_SLOW_MS).
+
+    Профилируется доля PROFILE_SAMPLE_RATE вызовов и не больше одного блока
+    одновременно; остальные выполняются без накладных расходов.
+    """
+    threshold = slow_ms if slow_ms is not None else (float(PROFILE_SLOW_MS) if PROFILE_SLOW_MS else None)
+    if threshold is None or random.random() >= PROFILE_SAMPLE_RATE or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= threshold:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{label}_{time.strftime('%Y%m%d-%H%M%S')}_{int(elapsed_ms)}ms.prof")
+            profiler.dump_stats(path)
+            inc('profiles_saved_total')
+    finally:
+        _profile_lock.release()
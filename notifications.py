@@ -1,23 +1,141 @@
 # notifications.py
 
+import asyncio
+import atexit
 import os
-from typing import Dict
-from dotenv import load_dotenv
-import requests
-import pandas as pd
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
-# Load environment variables from .env
-load_dotenv()
-GEMINI_API_KEY = os.getenv('GEMINI_API')
-GEMINI_API_URL = os.getenv('GEMINI_API_URL')  # Replace with actual URL
+from metrics import inc, timed, timer
 
-def get_client_summary(client_id: int, data_dir: str = "case1") -> str:
+if TYPE_CHECKING:
+    from llm_client import GeminiClient
+
+CACHE_MODES = ('on', 'off', 'refresh')
+
+_settings = None
+_env_loaded = False
+_llm_client = None
+_push_cache = None
+_push_cache_pid = None
+
+
+def load_env():
+    """
+    Loads .env once. Entry points call it at startup (analyzer does on
+    import), before modules that read settings at import time: DATA_DIRECTORY,
+    OUTPUT_FILENAME, MAX_CLIENT_ID, ANALYSIS_WORKERS, RECOMMENDATION_INDEX.
+    Like python-dotenv, .env is looked up from this directory upwards;
+    dotenv itself is imported only when the file exists.
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, '.env')
+        if os.path.isfile(path):
+            from dotenv import load_dotenv
+
+            load_dotenv(path)
+            return
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return
+        directory = parent
+
+
+def get_settings() -> Dict[str, Any]:
+    """
+    Gemini and push cache settings, read once on first use rather than at
+    import time: the HTTP clients are only imported when a push is actually
+    generated.
+    """
+    global _settings
+    if _settings is None:
+        from push_cache import DEFAULT_CACHE_PATH
+
+        # No-op if the entry point has already loaded .env
+        load_env()
+        _settings = {
+            'api_key': os.getenv('GEMINI_API'),
+            'api_url': os.getenv('GEMINI_API_URL'),  # Replace with actual URL
+            'timeout': float(os.getenv('GEMINI_TIMEOUT', '20')),
+            'max_concurrency': int(os.getenv('GEMINI_MAX_CONCURRENCY', '8')),
+            'max_retries': int(os.getenv('GEMINI_MAX_RETRIES', '3')),
+            'cache_path': os.getenv('PUSH_CACHE_PATH', DEFAULT_CACHE_PATH),
+            'cache_ttl': float(os.getenv('PUSH_CACHE_TTL', str(7 * 24 * 3600))),
+            'cache_max_entries': int(os.getenv('PUSH_CACHE_MAX_ENTRIES', '100000')),
+        }
+    return _settings
+
+
+def get_llm_client():
+    """
+    Returns the shared Gemini client, or None when the API is not configured.
+    """
+    global _llm_client
+    settings = get_settings()
+    if not (settings['api_key'] and settings['api_url']):
+        return None
+    if _llm_client is None:
+        # Without a configured API the client module is never imported
+        from llm_client import GeminiClient
+
+        _llm_client = GeminiClient(
+            settings['api_url'],
+            max_concurrency=settings['max_concurrency'],
+            timeout=settings['timeout'],
+            max_retries=settings['max_retries'],
+        )
+    return _llm_client
+
+def get_cache_mode() -> str:
+    """
+    'on' - read and write the cache, 'refresh' - regenerate and overwrite,
+    'off' - bypass the cache entirely. Read from PUSH_CACHE so that process
+    pool workers inherit it.
+    """
+    get_settings()  # PUSH_CACHE may come from .env
+    mode = os.getenv('PUSH_CACHE', 'on')
+    return mode if mode in CACHE_MODES else 'on'
+
+
+def set_cache_mode(mode: str):
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode: {mode}")
+    os.environ['PUSH_CACHE'] = mode
+
+
+def get_push_cache():
+    """
+    Returns the on-disk push cache, or None when caching is off.
+    """
+    global _push_cache, _push_cache_pid
+    if get_cache_mode() == 'off':
+        return None
+    # SQLite connections must not be shared across fork()
+    if _push_cache is None or _push_cache_pid != os.getpid():
+        from push_cache import PushCache
+
+        settings = get_settings()
+        _push_cache = PushCache(settings['cache_path'], ttl=settings['cache_ttl'],
+                                max_entries=settings['cache_max_entries'])
+        # Writes the buffered access times of hits
+        atexit.register(_push_cache.close)
+        _push_cache_pid = os.getpid()
+    return _push_cache
+
+
+def get_client_summary(client_id: int, data_dir: Optional[str] = None) -> str:
     """
     Loads and summarizes client's transaction and transfer data for Gemini prompt.
     """
-    df = pd.read_csv(f'{data_dir}/clients.csv', index_col='client_code')
-    # print(df)
-    client_row = df.loc[client_id]
+    # data_store (and pandas with it) is imported on the first prompt, not with this module
+    from data_store import DATA_DIRECTORY, get_store
+
+    # Профили берутся из общего хранилища, а не перечитываются на каждый пуш
+    client_row = get_store(data_dir or DATA_DIRECTORY).get_profile(client_id)
     return client_row
     # import pandas as pd
     # transactions_path = os.path.join(data_dir, f"client_{client_id}_transactions_3m.csv")
@@ -56,66 +174,113 @@ def generate_meta_prompt(product_name: str, value):
         return f"На {product_name} клиент влил {value*100}% всех своих денег"
     
 
-def generate_personalized_text(client_id: int, product_name: str, value) -> str:
-    """
-    Uses GEMINI framework to generate personalized notification text for the user.
-    """
+def build_prompt(client_id: int, product_name: str, value) -> str:
     client_summary = get_client_summary(client_id)
-    prompt = (
+    return (
         f"Клиенту с ID {client_id} рекомендуется продукт: {product_name}. "
         f"Данные клиента: {client_summary}. Мета-данные: {generate_meta_prompt(product_name, value)}"
         "Сгенерируй персонализированный текст пуш-уведомления на русском языке, объясняющий выгоды выбранного продукта с учетом этих данных. ориентир 180–220 символов для пушей"
     )
 
-    if GEMINI_API_KEY and GEMINI_API_URL:
-        try:
-            response = requests.post(
-                GEMINI_API_URL,
-                json={
-                    "contents": [
-                        {
-                            "parts": [
-                                {"text": prompt}
-                            ]
-                        }
-                    ]
-                }
-            )
-            if response.status_code == 200:
-                data = response.json()
-                # Gemini returns the result in response.json()['candidates'][0]['content']['parts'][0]['text']
-                return (
-                    data.get('candidates', [{}])[0]
-                        .get('content', {})
-                        .get('parts', [{}])[0]
-                        .get('text', '')
-                )
-            else:
-                print(f"GEMINI API error: {response.status_code}")
-                return f"GEMINI API error: {response.status_code}"
-        except Exception as e:
-            print(f"GEMINI API exception: {e}")
-            return f"GEMINI API exception: {e}"
 
+def fallback_text(product_name: str) -> str:
     return f"Уважаемый клиент! Мы рекомендуем вам {product_name} — это лучший выбор для вас по результатам анализа ваших операций. Ознакомьтесь с преимуществами прямо сейчас!"
 
-def send_push_notification(client_id: int, product_name: str, scores: Dict[str, float]):
+
+def is_fallback(product_name: str, text: str) -> bool:
     """
-    Sends a push notification to the user about the suggested product.
+    True when the text is the template used instead of a configured
+    Gemini's answer (an outage), so the caller may regenerate it later.
     """
-    notification_text = generate_personalized_text(client_id, product_name, scores)
+    settings = get_settings()
+    return bool(settings['api_key'] and settings['api_url']) and text == fallback_text(product_name)
+
+
+def _cached_text(client: 'GeminiClient', prompt: str):
+    from push_cache import cache_key
+
+    key = cache_key(prompt, client.api_url)
+    cache = get_push_cache()
+    if cache is None or get_cache_mode() == 'refresh':
+        inc('push_cache_lookups_total', result='bypass')
+        return key, None
+    text = cache.get(key)
+    inc('push_cache_lookups_total', result='hit' if text else 'miss')
+    return key, text
+
+
+def _store_text(key: str, text: str):
+    # Template fallbacks are not cached, so the next run retries the API
+    cache = get_push_cache()
+    if cache is not None:
+        cache.put(key, text)
+
+
+@timed('generate_personalized_text')
+def generate_personalized_text(client_id: int, product_name: str, value) -> str:
+    """
+    Uses GEMINI framework to generate personalized notification text for the user.
+    Falls back to the template when the API is not configured or keeps failing.
+    """
+    client = get_llm_client()
+    if client is not None:
+        prompt = build_prompt(client_id, product_name, value)
+        key, text = _cached_text(client, prompt)
+        if text:
+            return text
+        text = client.generate(prompt)
+        if text:
+            _store_text(key, text)
+            return text
+    inc('push_fallback_total')
+    return fallback_text(product_name)
+
+
+async def agenerate_personalized_text(client_id: int, product_name: str, value) -> str:
+    """
+    Async version of generate_personalized_text, does not block the event loop.
+    """
+    with timer('generate_personalized_text'):
+        client = get_llm_client()
+        if client is not None:
+            prompt = build_prompt(client_id, product_name, value)
+            # SQLite reads and writes go to a thread so the event loop never blocks on disk
+            key, text = await asyncio.to_thread(_cached_text, client, prompt)
+            if text:
+                return text
+            text = await client.agenerate(prompt)
+            if text:
+                await asyncio.to_thread(_store_text, key, text)
+                return text
+        inc('push_fallback_total')
+        return fallback_text(product_name)
+
 
+def build_row(client_id: int, product_name: str, notification_text: str) -> Dict:
     print(f"[Push] Клиент {client_id}: {notification_text}")
-    print({
-        'client_code': client_id,
-        'product': product_name,
-        'push_notification': notification_text
-    })
-    return {
+    row = {
         'client_code': client_id,
         'product': product_name,
         'push_notification': notification_text
     }
+    print(row)
+    return row
+
+
+def send_push_notification(client_id: int, product_name: str, scores: Dict[str, float]):
+    """
+    Sends a push notification to the user about the suggested product.
+    """
+    notification_text = generate_personalized_text(client_id, product_name, scores)
+    return build_row(client_id, product_name, notification_text)
+
+
+async def asend_push_notification(client_id: int, product_name: str, scores: Dict[str, float]):
+    """
+    Async version of send_push_notification.
+    """
+    notification_text = await agenerate_personalized_text(client_id, product_name, scores)
+    return build_row(client_id, product_name, notification_text)
 
 # Example usage:
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+# push_cache.py
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+DEFAULT_CACHE_PATH = os.path.join('out', 'push_cache.sqlite3')
+EVICT_EVERY = 64
+# Access times of hits are kept in memory and written in one transaction
+TOUCH_FLUSH_EVERY = 256
+
+
+def cache_key(prompt: str, model_url: str) -> str:
+    """
+    Content-addressed key: sha256 of the model URL and the full prompt.
+    """
+    digest = hashlib.sha256()
+    digest.update(model_url.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(prompt.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class PushCache:
+    """
+    Persistent SQLite cache of generated push texts.
+
+    Entries older than `ttl` seconds are treated as misses; when the cache
+    grows beyond `max_entries` the least recently used entries are evicted.
+    A hit is a read only: its access time is buffered and written together
+    with the next put, or every TOUCH_FLUSH_EVERY hits, or on close().
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl: Optional[float] = 7 * 24 * 3600,
+                 max_entries: int = 100_000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._touched: Dict[str, float] = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS push_cache ("
+            " key TEXT PRIMARY KEY, text TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS push_cache_accessed ON push_cache(accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT text, created_at FROM push_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if found is None or (self.ttl is not None and now - found[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= TOUCH_FLUSH_EVERY:
+                self._flush_touches()
+                self._conn.commit()
+            self.hits += 1
+            return found[0]
+
+    def put(self, key: str, text: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO push_cache (key, text, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, text, now, now),
+            )
+            self._touched.pop(key, None)
+            self._flush_touches()
+            # Evict only every EVICT_EVERY puts: COUNT(*) scans the whole index
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 1:
+                self._evict(now)
+            self._conn.commit()
+
+    def _flush_touches(self):
+        if self._touched:
+            touched, self._touched = self._touched, {}
+            self._conn.executemany("UPDATE push_cache SET accessed_at = ? WHERE key = ?",
+                                   [(at, key) for key, at in touched.items()])
+
+    def _evict(self, now: float):
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM push_cache WHERE created_at < ?", (now - self.ttl,))
+        count = self._conn.execute("SELECT COUNT(*) FROM push_cache").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM push_cache WHERE key IN ("
+                " SELECT key FROM push_cache ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute("DELETE FROM push_cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM push_cache").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': size}
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._flush_touches()
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,252 @@
+# recommendation_index.py
+
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from data_store import ClientDataStore, get_store
+from metrics import inc, timer
+from rules import load_rules
+
+
+INDEX_PATH = os.getenv('RECOMMENDATION_INDEX_PATH', os.path.join('out', 'recommendation_index.json'))
+PUSH_CONCURRENCY = int(os.getenv('INDEX_PUSH_CONCURRENCY', '8'))
+
+
+class Snapshot:
+    """
+    Неизменяемая версия индекса: client_code -> продукт, скоры и текст пуша.
+
+    Новая версия собирается целиком и подменяет старую одним присваиванием,
+    поэтому читатели всегда видят согласованный снимок без блокировок.
+    """
+
+    __slots__ = ('version', 'built_at', 'entries', 'fingerprints', 'profiles_mtime', 'rules_mtime')
+
+    def __init__(self, version: int = 0, built_at: Optional[float] = None, entries: Dict[int, Dict] = None,
+                 fingerprints: Dict[int, list] = None, profiles_mtime: Optional[float] = None,
+                 rules_mtime: Optional[float] = None):
+        self.version = version
+        self.built_at = built_at
+        self.entries = entries or {}
+        self.fingerprints = fingerprints or {}
+        self.profiles_mtime = profiles_mtime
+        self.rules_mtime = rules_mtime
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'version': self.version, 'built_at': self.built_at,
+            'profiles_mtime': self.profiles_mtime, 'rules_mtime': self.rules_mtime,
+            'entries': list(self.entries.values()),
+            'fingerprints': {str(k): v for k, v in self.fingerprints.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Snapshot':
+        return cls(
+            data['version'], data['built_at'],
+            {int(entry['client_code']): entry for entry in data['entries']},
+            {int(k): v for k, v in data['fingerprints'].items()},
+            data.get('profiles_mtime'), data.get('rules_mtime'),
+        )
+
+
+def _fingerprint(store: ClientDataStore, client_id: int) -> Optional[list]:
+    try:
+        # JSON-совместимый вид, чтобы сравнивать с версией, прочитанной с диска
+        return [list(source) for source in store.fingerprint(client_id)]
+    except FileNotFoundError:
+        return None
+
+
+def _needs_push(entry: Dict) -> bool:
+    """
+    Текст записи - шаблон вместо ответа Gemini (индекс строился во время
+    сбоя API): при следующем refresh() он генерируется заново.
+    """
+    from notifications import is_fallback
+
+    return is_fallback(entry['product'], entry.get('push_notification'))
+
+
+class RecommendationIndex:
+    """
+    Заранее посчитанные рекомендации всех клиентов для ответа сервера за O(1).
+
+    refresh() пересчитывает только клиентов, у которых изменились файлы
+    (mtime источника в ClientDataStore), а при изменении clients.csv,
+    product_rules.json или таблицы курсов - всех. Скоры считаются векторно (batch_engine),
+    тексты пушей генерируются только для клиентов, у которых изменился
+    продукт или значение, и для тех, кому достался шаблонный текст из-за
+    сбоя Gemini. Каждая новая версия сохраняется на диск, чтобы
+    перезапуск сервера не начинал с пустого индекса.
+    """
+
+    def __init__(self, store: ClientDataStore = None, path: Optional[str] = INDEX_PATH,
+                 push_concurrency: int = PUSH_CONCURRENCY):
+        self.store = store if store is not None else get_store()
+        self.path = path
+        self.push_concurrency = max(1, push_concurrency)
+        self._snapshot = Snapshot()
+        self._refresh_lock = threading.Lock()
+        self.refreshing = False
+
+    @property
+    def snapshot(self) -> Snapshot:
+        return self._snapshot
+
+    def get(self, client_id: int) -> Optional[Dict]:
+        return self._snapshot.entries.get(client_id)
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            'version': snapshot.version, 'built_at': snapshot.built_at,
+            'clients': len(snapshot.entries), 'refreshing': self.refreshing,
+        }
+
+    def load(self) -> bool:
+        """
+        Читает последнюю сохранённую версию. Возвращает False, если её нет.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self._snapshot = Snapshot.from_dict(json.load(f))
+        except (ValueError, KeyError) as e:
+            print(f"Индекс {self.path} не прочитан: {e}")
+            return False
+        return True
+
+    def _save(self, snapshot: Snapshot):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def _detect(self, client_ids: Iterable[int], force: bool) -> Tuple[List[int], Dict[int, list], Dict[str, float]]:
+        """
+        Клиенты для пересчёта и новые отпечатки их данных.
+        """
+        old = self._snapshot
+        meta = {'profiles_mtime': self.store.profiles_mtime(), 'rules_mtime': load_rules().mtime}
+        # Средний баланс и правила влияют на всех клиентов
+        full = force or meta['profiles_mtime'] != old.profiles_mtime or meta['rules_mtime'] != old.rules_mtime
+        fingerprints, changed = {}, []
+        for client_id in client_ids:
+            fingerprint = _fingerprint(self.store, client_id)
+            if fingerprint is None:
+                continue
+            fingerprints[client_id] = fingerprint
+            if (full or old.fingerprints.get(client_id) != fingerprint or client_id not in old.entries
+                    or _needs_push(old.entries[client_id])):
+                changed.append(client_id)
+        return changed, fingerprints, meta
+
+    def _score(self, client_ids: List[int]) -> Dict[int, Dict]:
+        from batch_engine import score_batch
+
+        rules = load_rules()
+        decisions, _ = score_batch(client_ids, self.store)
+        entries = {}
+        for client_id, row in zip(decisions.index, decisions.to_dict('records')):
+            product = rules.products[row['product']]
+            entries[int(client_id)] = {
+                'client_code': int(client_id),
+                'product': product.name,
+                'value': product.cast(row['value']),
+                'stage': row['stage'],
+                'scores': {name: rules.products[name].cast(row[name]) for name in rules.products},
+            }
+        return entries
+
+    async def _fill_pushes(self, entries: Dict[int, Dict], old: Snapshot):
+        from notifications import asend_push_notification
+
+        semaphore = asyncio.Semaphore(self.push_concurrency)
+
+        async def push(entry: Dict):
+            previous = old.entries.get(entry['client_code'])
+            if (previous and previous['product'] == entry['product'] and previous['value'] == entry['value']
+                    and not _needs_push(previous)):
+                entry['push_notification'] = previous['push_notification']
+                return
+            async with semaphore:
+                row = await asend_push_notification(entry['client_code'], entry['product'], entry['value'])
+            entry['push_notification'] = row['push_notification']
+
+        await asyncio.gather(*(push(entry) for entry in entries.values()))
+
+    async def arefresh(self, client_ids: Iterable[int], force: bool = False) -> Dict[str, Any]:
+        """
+        Пересчитывает изменившихся клиентов и атомарно подменяет снимок.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return {'version': self._snapshot.version, 'recomputed': 0, 'skipped': 'уже обновляется'}
+        self.refreshing = True
+        try:
+            with timer('index.refresh'):
+                old = self._snapshot
+                changed, fingerprints, meta = await asyncio.to_thread(self._detect, list(client_ids), force)
+                removed = [client_id for client_id in old.entries if client_id not in fingerprints]
+                if not changed and not removed:
+                    return {'version': old.version, 'recomputed': 0}
+                entries = await asyncio.to_thread(self._score, changed) if changed else {}
+                # Профиль входит в промпт: после изменения clients.csv тексты генерируются заново
+                await self._fill_pushes(entries, old if meta['profiles_mtime'] == old.profiles_mtime else Snapshot())
+
+                merged = {k: v for k, v in old.entries.items() if k in fingerprints}
+                merged.update(entries)
+                snapshot = Snapshot(old.version + 1, time.time(), merged, fingerprints,
+                                    meta['profiles_mtime'], meta['rules_mtime'])
+                # Одно присваивание - читатели видят либо старую, либо новую версию
+                self._snapshot = snapshot
+                inc('index_recomputed_total', len(entries))
+                await asyncio.to_thread(self._save, snapshot)
+                return {'version': snapshot.version, 'recomputed': len(entries), 'removed': len(removed)}
+        finally:
+            self.refreshing = False
+            self._refresh_lock.release()
+
+    def refresh(self, client_ids: Iterable[int], force: bool = False) -> Dict[str, Any]:
+        """
+        Синхронная версия arefresh() для запуска вне сервера.
+        """
+        from notifications import get_llm_client
+
+        async def run():
+            try:
+                return await self.arefresh(client_ids, force)
+            finally:
+                # Асинхронный клиент привязан к этому event loop
+                client = get_llm_client()
+                if client is not None:
+                    await client.aclose()
+
+        return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    import argparse
+    import contextlib
+    import io
+
+    parser = argparse.ArgumentParser(description="Построение индекса рекомендаций всех клиентов")
+    parser.add_argument("--start", type=int, default=1)
+    parser.add_argument("--end", type=int, default=60)
+    parser.add_argument("--force", action="store_true", help="Пересчитать всех клиентов")
+    parser.add_argument("--output", default=INDEX_PATH, help="Файл индекса")
+    args = parser.parse_args()
+
+    index = RecommendationIndex(path=args.output)
+    index.load()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = index.refresh(range(args.start, args.end + 1), force=args.force)
+    print(f"Индекс {args.output}: {result}")
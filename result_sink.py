@@ -0,0 +1,409 @@
+# result_sink.py
+
+import abc
+import atexit
+import contextlib
+import csv
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from metrics import timer
+
+try:
+    import fcntl
+except ImportError:  # Windows - блокировка файла недоступна, пишет один процесс
+    fcntl = None
+
+
+FIELDS = ['client_code', 'product', 'push_notification']
+FLUSH_ROWS = int(os.getenv('SINK_FLUSH_ROWS', '64'))
+FLUSH_SECONDS = float(os.getenv('SINK_FLUSH_SECONDS', '1.0'))
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
+
+def _tmp_path(path: Path) -> Path:
+    return path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path):
+    """
+    Межпроцессная блокировка файла результатов (flock на соседнем .lock-файле):
+    несколько воркеров uvicorn пишут один CSV по очереди.
+    """
+    if fcntl is None:
+        yield
+        return
+    with path.with_name(f'.{path.name}.lock').open('a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class ResultSink(abc.ABC):
+    """
+    Приёмник строк-рекомендаций с буфером и upsert по client_code.
+
+    Строки копятся в памяти и сбрасываются пачкой - каждые flush_every строк
+    или flush_interval секунд (проверяется при записи) и при commit().
+    write(row, flush=False) только кладёт строку в буфер и не ждёт диска:
+    так пишет event loop сервера, а сбрасывает фоновая задача (flush_all).
+    Буфер и запись на диск защищены разными блокировками, поэтому запись в
+    буфер не ждёт идущий сброс. При atomic=True результат становится виден
+    только после commit(), а abort() (или исключение внутри `with`) оставляет
+    старый результат как был.
+    """
+
+    def __init__(self, path: str, atomic: bool = False, flush_every: int = FLUSH_ROWS,
+                 flush_interval: float = FLUSH_SECONDS):
+        self.path = Path(path)
+        self.atomic = atomic
+        self.flush_every = max(1, flush_every)
+        self.flush_interval = flush_interval
+        self._pending: List[Dict] = []
+        self._last_flush = time.monotonic()
+        # _lock - буфер и флаг закрытия, _io_lock - запись на диск (по одной пачке)
+        self._lock = threading.Lock()
+        self._io_lock = threading.RLock()
+        self._closed = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, row: Dict, flush: bool = True):
+        self.write_many([row], flush)
+
+    def write_many(self, rows: Iterable[Dict], flush: bool = True):
+        with self._lock:
+            if self._closed:
+                raise ValueError(f"Приёмник {self.path} уже закрыт")
+            self._pending.extend(rows)
+            due = len(self._pending) >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval
+        if flush and due:
+            self.flush()
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+                self._last_flush = time.monotonic()
+            if rows:
+                with timer('sink.flush'):
+                    self._write_rows(rows)
+
+    def commit(self):
+        with self._io_lock:
+            with self._lock:
+                if self._closed:
+                    return
+                # Дальше write() бросает ошибку, а не теряет строку после последнего сброса
+                self._closed = True
+            self.flush()
+            with timer('sink.commit'):
+                self._commit()
+
+    def abort(self):
+        with self._io_lock:
+            with self._lock:
+                if self._closed:
+                    return
+                self._closed = True
+                self._pending = []
+            self._abort()
+
+    def close(self):
+        self.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    @abc.abstractmethod
+    def _write_rows(self, rows: List[Dict]):
+        """
+        Записывает пачку строк (вызывается под блокировкой записи приёмника).
+        """
+
+    def _commit(self):
+        pass
+
+    def _abort(self):
+        pass
+
+
+class CsvSink(ResultSink):
+    """
+    CSV с одной строкой на клиента.
+
+    Каждая пачка пишется под блокировкой файла (flock), и если файл
+    изменил другой процесс, он сначала перечитывается - поэтому несколько
+    воркеров сервера не затирают строки друг друга. Новые клиенты
+    дописываются в конец файла одной записью на пачку; если в пачке есть уже
+    записанный клиент, файл целиком переписывается во временный и атомарно
+    заменяется (os.replace) - O(N) на пачку, поэтому для частых обновлений
+    лучше SqliteSink. В режиме atomic строки пишутся во временный файл,
+    который заменяет основной при commit(); если строки шли не по возрастанию
+    client_code или в файле остались клиенты не из этого запуска, при
+    commit() файл один раз пересобирается в порядке client_code.
+    """
+
+    def __init__(self, path: str, atomic: bool = False, flush_every: int = FLUSH_ROWS,
+                 flush_interval: float = FLUSH_SECONDS):
+        super().__init__(path, atomic, flush_every, flush_interval)
+        # (mtime_ns, размер) файла, которому соответствует _rows
+        self._version: Optional[tuple] = None
+        self._rows: Dict[int, Dict] = self._read_existing()
+        self._written: Set[int] = set()
+        # Строки atomic-запуска пока шли строго по возрастанию client_code
+        self._ordered = True
+        self._last_code: Optional[int] = None
+        self._tmp: Optional[Path] = None
+        if atomic:
+            self._tmp = _tmp_path(self.path)
+            self._open_tmp()
+
+    def _file_version(self) -> Optional[tuple]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_existing(self) -> Dict[int, Dict]:
+        rows: Dict[int, Dict] = {}
+        self._version = self._file_version()
+        if self._version is not None and self._version[1] > 0:
+            with self.path.open(newline='', encoding='utf-8-sig') as f:
+                # Старые файлы могли содержать дубликаты - побеждает последняя строка
+                for row in csv.DictReader(f):
+                    rows[int(row['client_code'])] = {field: row.get(field) for field in FIELDS}
+        return rows
+
+    def _refresh(self):
+        # Файл менял другой процесс - наш снимок устарел
+        if self._file_version() != self._version:
+            self._rows = self._read_existing()
+
+    def _open_tmp(self):
+        with self._tmp.open('w', newline='', encoding='utf-8-sig') as f:
+            csv.DictWriter(f, fieldnames=FIELDS).writeheader()
+
+    def _append(self, target: Path, rows: List[Dict]):
+        new_file = not target.exists() or target.stat().st_size == 0
+        with target.open('a', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+    def _rewrite(self, target: Path, rows: Iterable[Dict]):
+        tmp = _tmp_path(target)
+        with tmp.open('w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp, target)
+
+    def _write_rows(self, rows: List[Dict]):
+        if self.atomic:
+            codes = [int(row['client_code']) for row in rows]
+            chain = ([self._last_code] if self._last_code is not None else []) + codes
+            self._ordered = self._ordered and all(a < b for a, b in zip(chain, chain[1:]))
+            self._last_code = codes[-1]
+            self._written.update(codes)
+            self._append(self._tmp, rows)
+            return
+        with _file_lock(self.path):
+            self._refresh()
+            updates = any(int(row['client_code']) in self._rows for row in rows)
+            for row in rows:
+                self._rows[int(row['client_code'])] = row
+            if updates:
+                self._rewrite(self.path, self._rows.values())
+            else:
+                self._append(self.path, _dedupe(rows))
+            self._version = self._file_version()
+
+    def _commit(self):
+        if not self.atomic:
+            return
+        with _file_lock(self.path):
+            # Строки, записанные другими процессами за время запуска, сохраняются
+            self._refresh()
+            kept = [row for code, row in self._rows.items() if code not in self._written]
+            if kept or not self._ordered:
+                # Повторы клиента (побеждает последняя строка) и чужие строки -
+                # в один файл по порядку client_code
+                with self._tmp.open(newline='', encoding='utf-8-sig') as f:
+                    rows = _dedupe(kept + list(csv.DictReader(f)))
+                self._rewrite(self._tmp, sorted(rows, key=lambda row: int(row['client_code'])))
+            os.replace(self._tmp, self.path)
+
+    def _abort(self):
+        if self._tmp is not None and self._tmp.exists():
+            self._tmp.unlink()
+
+
+class SqliteSink(ResultSink):
+    """
+    Таблица recommendations в SQLite с первичным ключом client_code.
+
+    Каждая пачка - одна транзакция с INSERT ... ON CONFLICT DO UPDATE. В
+    режиме atomic все пачки идут в одной транзакции до commit().
+    """
+
+    def __init__(self, path: str, atomic: bool = False, flush_every: int = FLUSH_ROWS,
+                 flush_interval: float = FLUSH_SECONDS):
+        super().__init__(path, atomic, flush_every, flush_interval)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS recommendations ("
+            " client_code INTEGER PRIMARY KEY, product TEXT NOT NULL,"
+            " push_notification TEXT, updated_at REAL NOT NULL)"
+        )
+        if atomic:
+            self._conn.execute("BEGIN")
+
+    def _write_rows(self, rows: List[Dict]):
+        now = time.time()
+        params = [(int(row['client_code']), row['product'], row.get('push_notification'), now) for row in rows]
+        if not self.atomic:
+            self._conn.execute("BEGIN")
+        self._conn.executemany(
+            "INSERT INTO recommendations (client_code, product, push_notification, updated_at)"
+            " VALUES (?, ?, ?, ?) ON CONFLICT(client_code) DO UPDATE SET"
+            " product = excluded.product, push_notification = excluded.push_notification,"
+            " updated_at = excluded.updated_at",
+            params,
+        )
+        if not self.atomic:
+            self._conn.execute("COMMIT")
+
+    def _commit(self):
+        if self.atomic:
+            self._conn.execute("COMMIT")
+        self._conn.close()
+
+    def _abort(self):
+        if self.atomic:
+            self._conn.execute("ROLLBACK")
+        self._conn.close()
+
+
+class ParquetSink(ResultSink):
+    """
+    Parquet-файл с одной строкой на клиента (нужен pyarrow).
+
+    Parquet нельзя дописывать, поэтому каждая пачка переписывает файл
+    целиком через временный и os.replace; в режиме atomic файл пишется
+    один раз при commit().
+    """
+
+    def __init__(self, path: str, atomic: bool = False, flush_every: int = FLUSH_ROWS,
+                 flush_interval: float = FLUSH_SECONDS):
+        import pyarrow.parquet as pq
+
+        super().__init__(path, atomic, flush_every, flush_interval)
+        self._rows: Dict[int, Dict] = {}
+        if self.path.exists():
+            for row in pq.read_table(self.path).to_pylist():
+                self._rows[int(row['client_code'])] = row
+
+    def _dump(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pylist([{field: row.get(field) for field in FIELDS} for row in self._rows.values()])
+        tmp = _tmp_path(self.path)
+        pq.write_table(table, tmp)
+        os.replace(tmp, self.path)
+
+    def _write_rows(self, rows: List[Dict]):
+        for row in rows:
+            self._rows[int(row['client_code'])] = row
+        if not self.atomic:
+            self._dump()
+
+    def _commit(self):
+        if self.atomic:
+            self._dump()
+
+
+def _dedupe(rows: List[Dict]) -> List[Dict]:
+    """
+    Оставляет последнюю строку каждого клиента, сохраняя порядок первого появления.
+    """
+    latest: Dict[int, Dict] = {}
+    for row in rows:
+        latest[int(row['client_code'])] = row
+    return list(latest.values())
+
+
+def open_sink(path: str, atomic: bool = False, **kwargs) -> ResultSink:
+    """
+    Открывает приёмник по расширению файла: .csv, .parquet или .sqlite/.sqlite3/.db.
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix in SQLITE_SUFFIXES:
+        return SqliteSink(path, atomic, **kwargs)
+    if suffix == '.parquet':
+        return ParquetSink(path, atomic, **kwargs)
+    return CsvSink(path, atomic, **kwargs)
+
+
+_sinks: Dict[str, ResultSink] = {}
+_sinks_pid: Optional[int] = None
+_sinks_lock = threading.Lock()
+
+
+def get_sink(path: str) -> ResultSink:
+    """
+    Общий для процесса приёмник файла path (без atomic): все запросы сервера
+    пишут через один объект, поэтому строки не перемешиваются.
+    """
+    global _sinks_pid
+    with _sinks_lock:
+        if _sinks_pid != os.getpid():
+            # После fork() буферы родителя не наши
+            _sinks.clear()
+            _sinks_pid = os.getpid()
+        key = os.path.abspath(path)
+        sink = _sinks.get(key)
+        if sink is None:
+            sink = _sinks[key] = open_sink(path)
+        return sink
+
+
+def flush_all():
+    with _sinks_lock:
+        sinks = list(_sinks.values()) if _sinks_pid == os.getpid() else []
+    for sink in sinks:
+        sink.flush()
+
+
+def close_sink(path: str):
+    with _sinks_lock:
+        sink = _sinks.pop(os.path.abspath(path), None) if _sinks_pid == os.getpid() else None
+    if sink is not None:
+        sink.close()
+
+
+def close_all():
+    with _sinks_lock:
+        sinks = list(_sinks.values()) if _sinks_pid == os.getpid() else []
+        _sinks.clear()
+    for sink in sinks:
+        sink.close()
+
+
+atexit.register(close_all)
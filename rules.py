@@ -0,0 +1,427 @@
+# rules.py
+
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from metrics import timer
+from timeseries import TimeSeries, to_seconds
+
+
+# Временной ряд или функция, которая строит его при первом обращении
+TimeSeriesSource = Optional[Union[TimeSeries, Callable[[], TimeSeries]]]
+
+# Правила продуктов: категории, ставки, пороги и порядок этапов
+RULES_PATH = os.getenv('PRODUCT_RULES', 'product_rules.json')
+
+
+class FeatureMatrix:
+    """
+    Агрегаты одного или многих клиентов в виде numpy-матриц.
+
+    Строка - клиент, столбцы - категории трат и типы переводов. Правила
+    только выбирают и складывают столбцы, поэтому новый продукт не
+    добавляет ещё одного прохода по транзакциям. spend_time и transfer_time
+    - помесячные ряды тех же клиентов (timeseries.py) или None, если дат нет.
+    Ряд можно передать функцией без аргументов: он строится при первом
+    обращении правила, так что пакет не держит ряды, которые правилам не нужны.
+    """
+
+    def __init__(self, index: pd.Index, categories: List[str], spend: np.ndarray,
+                 transfer_types: List[str], transfer_sum: np.ndarray, transfer_count: np.ndarray,
+                 total_spend: np.ndarray, total_transfers: np.ndarray,
+                 has_transactions: np.ndarray, has_transfers: np.ndarray,
+                 balance: np.ndarray, balance_mean: float,
+                 spend_time: TimeSeriesSource = None, transfer_time: TimeSeriesSource = None):
+        self.index = index
+        self._categories = {c: i for i, c in enumerate(categories)}
+        self._types = {t: i for i, t in enumerate(transfer_types)}
+        self._spend = spend
+        self._transfer_sum = transfer_sum
+        self._transfer_count = transfer_count
+        self.total_spend = total_spend
+        self.total_transfers = total_transfers
+        self.has_transactions = has_transactions
+        self.has_transfers = has_transfers
+        self.balance = balance
+        self.balance_mean = balance_mean
+        self._time_series = {'spend': spend_time, 'transfer': transfer_time}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _series(self, kind: str) -> Optional[TimeSeries]:
+        series = self._time_series[kind]
+        if callable(series):
+            series = self._time_series[kind] = series()
+        return series
+
+    @property
+    def spend_time(self) -> Optional[TimeSeries]:
+        return self._series('spend')
+
+    @property
+    def transfer_time(self) -> Optional[TimeSeries]:
+        return self._series('transfer')
+
+    @classmethod
+    def from_frames(cls, profiles: pd.DataFrame, transactions: pd.DataFrame, transfers: pd.DataFrame,
+                    client_ids: Iterable[int], balance_mean: Optional[float] = None) -> 'FeatureMatrix':
+        """
+        Один groupby по (client_code, category) и один по (client_code, type) на весь пакет.
+        """
+        index = pd.Index(list(client_ids), name='client_code')
+        spend = transactions.groupby(['client_code', 'category'], observed=True)['amount'].sum().unstack(fill_value=0.0)
+        spend = spend.reindex(index, fill_value=0.0)
+        transfer_agg = transfers.groupby(['client_code', 'type'], observed=True)['amount'].agg(['sum', 'count'])
+        transfer_sum = transfer_agg['sum'].unstack(fill_value=0.0).reindex(index, fill_value=0.0)
+        transfer_count = transfer_agg['count'].unstack(fill_value=0).reindex(index, fill_value=0)
+        transaction_totals = transactions.groupby('client_code')['amount'].agg(['sum', 'size']).reindex(index, fill_value=0)
+        transfer_totals = transfers.groupby('client_code')['amount'].agg(['sum', 'size']).reindex(index, fill_value=0)
+
+        balances = profiles['avg_monthly_balance_KZT']
+        return cls(
+            index,
+            [str(c) for c in spend.columns], spend.to_numpy(dtype=float),
+            [str(t) for t in transfer_sum.columns], transfer_sum.to_numpy(dtype=float),
+            transfer_count.reindex(columns=transfer_sum.columns, fill_value=0).to_numpy(dtype=float),
+            transaction_totals['sum'].to_numpy(dtype=float), transfer_totals['sum'].to_numpy(dtype=float),
+            transaction_totals['size'].to_numpy() > 0, transfer_totals['size'].to_numpy() > 0,
+            balances.reindex(index).to_numpy(dtype=float),
+            float(balances.mean()) if balance_mean is None else balance_mean,
+            # Правилам хватает количеств по месяцам и интервалов - без сумм (sums=False)
+            lambda: _frame_time_series(transactions, 'category', index),
+            lambda: _frame_time_series(transfers, 'type', index),
+        )
+
+    @classmethod
+    def from_compact(cls, profiles: pd.DataFrame, transactions: Any, transfers: Any,
+                     client_ids: Iterable[int], balance_mean: Optional[float] = None) -> 'FeatureMatrix':
+        """
+        То же по compact.CompactTable: np.bincount по кодам категорий вместо groupby.
+        """
+        index = pd.Index(list(client_ids), name='client_code')
+        categories, spend, spend_count = transactions.group_sums(index, 'category')
+        transfer_types, transfer_sum, transfer_count = transfers.group_sums(index, 'type')
+
+        balances = profiles['avg_monthly_balance_KZT']
+        return cls(
+            index,
+            categories, spend,
+            transfer_types, transfer_sum, transfer_count.astype(float),
+            spend.sum(axis=1), transfer_sum.sum(axis=1),
+            spend_count.sum(axis=1) > 0, transfer_count.sum(axis=1) > 0,
+            balances.reindex(index).to_numpy(dtype=float),
+            float(balances.mean()) if balance_mean is None else balance_mean,
+            lambda: transactions.time_series(index, 'category', sums=False),
+            lambda: transfers.time_series(index, 'type', sums=False),
+        )
+
+    @classmethod
+    def from_features(cls, client_id: int, features: Any, balance: float, balance_mean: float) -> 'FeatureMatrix':
+        """
+        Матрица из одной строки по ClientFeatures (или RunningFeatures из incremental.py).
+        """
+        categories = list(features._spend)
+        transfer_types = list(features._transfer_sum)
+        return cls(
+            pd.Index([client_id], name='client_code'),
+            categories, np.array([[features._spend[c] for c in categories]], dtype=float),
+            transfer_types,
+            np.array([[features._transfer_sum[t] for t in transfer_types]], dtype=float),
+            np.array([[features._transfer_count.get(t, 0) for t in transfer_types]], dtype=float),
+            np.array([features.total_spend], dtype=float), np.array([features.total_transfers], dtype=float),
+            np.array([features.has_transactions]), np.array([features.has_transfers]),
+            np.array([balance], dtype=float), float(balance_mean),
+            getattr(features, 'spend_time', None), getattr(features, 'transfer_time', None),
+        )
+
+    def _columns(self, matrix: np.ndarray, positions: Dict[str, int], names: Tuple[str, ...]) -> np.ndarray:
+        columns = [positions[name] for name in names if name in positions]
+        if not columns:
+            return np.zeros(len(self.index))
+        return matrix[:, columns].sum(axis=1)
+
+    def spend(self, categories: Tuple[str, ...]) -> np.ndarray:
+        return self._columns(self._spend, self._categories, categories)
+
+    def transfer_sum(self, types: Tuple[str, ...]) -> np.ndarray:
+        return self._columns(self._transfer_sum, self._types, types)
+
+    def transfer_count(self, types: Tuple[str, ...]) -> np.ndarray:
+        return self._columns(self._transfer_count, self._types, types)
+
+
+def _frame_time_series(df: pd.DataFrame, column: str, index: pd.Index) -> TimeSeries:
+    """
+    Помесячные ряды пакета по общему DataFrame: одна сортировка на все
+    клиенты, только количества и интервалы (sums=False).
+    """
+    owner = index.get_indexer(df['client_code'])
+    rows = owner >= 0
+    codes, keys = pd.factorize(df[column], sort=True)
+    return TimeSeries.build(owner[rows], to_seconds(df['date'])[rows], codes[rows],
+                            df['amount'].to_numpy(dtype=float)[rows], len(index), keys, sums=False)
+
+
+Evaluator = Callable[[FeatureMatrix], np.ndarray]
+
+
+def _names(spec: Dict[str, Any], key: str) -> Tuple[str, ...]:
+    names = spec.get(key)
+    if not isinstance(names, list) or not names:
+        raise ValueError(f"Продукт {spec.get('product')!r}: нужен непустой список {key!r}")
+    return tuple(str(name) for name in names)
+
+
+def _transfer_share(spec: Dict[str, Any]) -> Evaluator:
+    """
+    Доля суммы переводов types во всех переводах клиента.
+    """
+    types = _names(spec, 'types')
+
+    def evaluate(m: FeatureMatrix) -> np.ndarray:
+        ok = m.has_transfers & (m.total_transfers != 0)
+        return np.where(ok, m.transfer_sum(types) / np.where(ok, m.total_transfers, 1.0), 0.0)
+    return evaluate
+
+
+def _idle_high_balance(spec: Dict[str, Any]) -> Evaluator:
+    """
+    1, если переводов types не было, а баланс выше среднего по клиентам.
+    """
+    types = _names(spec, 'types')
+
+    def evaluate(m: FeatureMatrix) -> np.ndarray:
+        idle = (m.transfer_count(types) == 0) & (m.balance > m.balance_mean)
+        return np.where(m.has_transfers & idle, 1.0, 0.0)
+    return evaluate
+
+
+def _recurring_transfers(spec: Dict[str, Any]) -> Evaluator:
+    """
+    Сумма регулярных пополнений с процентом и бонусом за каждое пополнение.
+
+    Пополнения считаются регулярными, если их не меньше min_count, они были
+    в доле не меньше min_month_coverage месяцев истории клиента и (если
+    задан max_interval_cv) интервалы между ними достаточно равномерны.
+    """
+    types = _names(spec, 'types')
+    rate, bonus = float(spec['rate']), float(spec.get('bonus_per_transfer', 0.0))
+    min_count = int(spec.get('min_count', 1))
+    min_coverage = float(spec.get('min_month_coverage', 0.0))
+    max_cv = float(spec['max_interval_cv']) if spec.get('max_interval_cv') is not None else None
+
+    def evaluate(m: FeatureMatrix) -> np.ndarray:
+        count = m.transfer_count(types)
+        value = np.trunc(m.transfer_sum(types) * (1 + rate) * (1 + bonus * count))
+        regular = m.has_transfers & (count >= min_count)
+        # Матрица без временных рядов (features без spend_time/transfer_time) - только количество
+        if m.transfer_time is not None:
+            if min_coverage:
+                regular &= m.transfer_time.month_coverage(types) >= min_coverage
+            if max_cv is not None:
+                regular &= m.transfer_time.interval_cv(types) <= max_cv
+        return np.where(regular, value, 0.0)
+    return evaluate
+
+
+def _transfer_activity(spec: Dict[str, Any]) -> Evaluator:
+    """
+    Сумма переводов types плюс вес за каждую операцию count_types, с процентом.
+    """
+    types = _names(spec, 'types')
+    count_types = tuple(spec.get('count_types', ()))
+    weight, rate = float(spec.get('count_weight', 0.0)), float(spec['rate'])
+
+    def evaluate(m: FeatureMatrix) -> np.ndarray:
+        value = np.trunc((m.transfer_sum(types) + m.transfer_count(count_types) * weight) * (1 + rate))
+        return np.where(m.has_transfers, value, 0.0)
+    return evaluate
+
+
+def _category_cashback(spec: Dict[str, Any]) -> Evaluator:
+    """
+    Кэшбэк rate от трат в categories.
+    """
+    categories = _names(spec, 'categories')
+    rate = float(spec['rate'])
+    require_spend = bool(spec.get('require_spend', True))
+
+    def evaluate(m: FeatureMatrix) -> np.ndarray:
+        value = m.spend(categories) * rate
+        if require_spend:
+            value = np.where(m.has_transactions & (m.total_spend != 0), value, 0.0)
+        return value
+    return evaluate
+
+
+def _tiered_balance_cashback(spec: Dict[str, Any]) -> Evaluator:
+    """
+    Процент от баланса по ступеням tiers плюс кэшбэк от трат в categories, не больше cap.
+    """
+    categories = _names(spec, 'categories')
+    bounds = [float(bound) for bound, _ in spec['tiers']]
+    tier_rates = [float(rate) for _, rate in spec['tiers']]
+    top_rate, rate = float(spec['top_rate']), float(spec['rate'])
+    cap = float(spec['cap']) if spec.get('cap') is not None else np.inf
+
+    def evaluate(m: FeatureMatrix) -> np.ndarray:
+        balance = np.trunc(m.balance)
+        balance_rate = np.select([balance < bound for bound in bounds], tier_rates, top_rate)
+        return np.minimum(balance * balance_rate + rate * m.spend(categories), cap)
+    return evaluate
+
+
+EVALUATORS: Dict[str, Callable[[Dict[str, Any]], Evaluator]] = {
+    'transfer_share': _transfer_share,
+    'idle_high_balance': _idle_high_balance,
+    'recurring_transfers': _recurring_transfers,
+    'transfer_activity': _transfer_activity,
+    'category_cashback': _category_cashback,
+    'tiered_balance_cashback': _tiered_balance_cashback,
+}
+
+
+class Product:
+    def __init__(self, name: str, evaluate: Evaluator, stage: str, integer: bool,
+                 enabled: bool = True, scorer: Optional[str] = None):
+        self.name = name
+        self.evaluate = evaluate
+        self.stage = stage
+        self.integer = integer
+        self.enabled = enabled
+        self.scorer = scorer
+        # Этап метрик: имя метода-скорера ClientAnalyzer, если оно задано
+        self.metric = f'scorer.{scorer or name}'
+
+    def cast(self, value: float):
+        """
+        Значение для мета-промпта: int для целочисленных скоров (депозиты).
+        """
+        return int(value) if self.integer else float(value)
+
+
+class Stage:
+    def __init__(self, name: str, threshold: Optional[float], products: List[Product]):
+        self.name = name
+        self.threshold = threshold
+        self.products = products
+
+    @property
+    def candidates(self) -> List[Product]:
+        return [p for p in self.products if p.enabled]
+
+
+class RuleSet:
+    """
+    Скомпилированные правила: каскад этапов по приоритету.
+
+    Этап выбирает продукт с максимальным скором (при равенстве - первый
+    в конфиге), если этот скор больше threshold; этап с threshold null
+    выбирается всегда и должен быть последним.
+    """
+
+    def __init__(self, stages: List[Stage], path: Optional[str] = None, mtime: Optional[float] = None):
+        self.stages = stages
+        self.path = path
+        self.mtime = mtime
+        self.products: Dict[str, Product] = {p.name: p for stage in stages for p in stage.products}
+        self.by_scorer: Dict[str, Product] = {p.scorer: p for p in self.products.values() if p.scorer}
+
+    def stage(self, name: str) -> Stage:
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def score(self, matrix: FeatureMatrix) -> Dict[str, np.ndarray]:
+        """
+        Скоры всех продуктов (включая отключённые) для всех строк матрицы.
+        """
+        scores = {}
+        for name, product in self.products.items():
+            # Время каждого продукта отдельно - и для одного клиента, и для пакета
+            with timer(product.metric):
+                scores[name] = product.evaluate(matrix)
+        return scores
+
+    def choose(self, scores: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Возвращает (продукт, значение, этап) для каждой строки.
+        """
+        n = len(next(iter(scores.values()))) if scores else 0
+        rows = np.arange(n)
+        product = np.empty(n, dtype=object)
+        value = np.zeros(n)
+        stage_name = np.empty(n, dtype=object)
+        decided = np.zeros(n, dtype=bool)
+        for stage in self.stages:
+            candidates = stage.candidates
+            if not candidates:
+                continue
+            matrix = np.column_stack([scores[p.name] for p in candidates])
+            # argmax берёт первый максимум - как max(dict, key=dict.get)
+            best = matrix.argmax(axis=1)
+            best_value = matrix[rows, best]
+            take = ~decided
+            if stage.threshold is not None:
+                take &= best_value > stage.threshold
+            product[take] = np.array([p.name for p in candidates], dtype=object)[best[take]]
+            value[take] = best_value[take]
+            stage_name[take] = stage.name
+            decided |= take
+        return product, value, stage_name
+
+
+def compile_rules(config: Dict[str, Any], path: Optional[str] = None, mtime: Optional[float] = None) -> RuleSet:
+    """
+    Проверяет конфиг и превращает каждое правило в векторную функцию.
+    """
+    stages = []
+    seen = set()
+    for stage_spec in config.get('stages', []):
+        name = stage_spec['name']
+        threshold = stage_spec.get('threshold')
+        products = []
+        for spec in stage_spec.get('products', []):
+            product_name = spec.get('product')
+            if not product_name or product_name in seen:
+                raise ValueError(f"Этап {name!r}: пустое или повторное имя продукта {product_name!r}")
+            kind = spec.get('kind')
+            if kind not in EVALUATORS:
+                raise ValueError(f"Продукт {product_name!r}: неизвестный kind {kind!r}, доступны {sorted(EVALUATORS)}")
+            seen.add(product_name)
+            products.append(Product(
+                product_name, EVALUATORS[kind](spec), name,
+                integer=bool(spec.get('integer', stage_spec.get('integer', False))),
+                enabled=bool(spec.get('enabled', True)), scorer=spec.get('scorer'),
+            ))
+        stages.append(Stage(name, None if threshold is None else float(threshold), products))
+
+    active = [stage for stage in stages if stage.candidates]
+    if not active or active[-1].threshold is not None:
+        raise ValueError("Последний этап с продуктами должен иметь threshold: null")
+    return RuleSet(stages, path, mtime)
+
+
+_rules: Dict[str, RuleSet] = {}
+_rules_lock = threading.Lock()
+
+
+def load_rules(path: str = RULES_PATH) -> RuleSet:
+    """
+    Правила из JSON-файла; компилируются один раз и заново - при изменении файла.
+    """
+    mtime = os.path.getmtime(path)
+    with _rules_lock:
+        rules = _rules.get(path)
+        if rules is None or rules.mtime != mtime:
+            with open(path, encoding='utf-8') as f:
+                rules = compile_rules(json.load(f), path, mtime)
+            _rules[path] = rules
+        return rules
@@ -1,12 +1,65 @@
+import asyncio
+import json
+import os
+from typing import List, Literal, Optional
+
 from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, model_validator
 from fastapi.middleware.cors import CORSMiddleware
 
-from analyzer import ClientAnalyzer
+from analyzer import recommend_client, write_to_csv
+from data_store import DATA_DIRECTORY, get_store, warmup
+from metrics import METRICS, inc, timer
+from notifications import asend_push_notification, get_llm_client
+from recommendation_index import RecommendationIndex
+from result_sink import FLUSH_SECONDS, close_all, flush_all
+from worker_pool import BoundedPool, PoolSaturated
+
+# .env уже загружен при импорте analyzer (notifications.load_env)
+OUTPUT_FILENAME = os.getenv('OUTPUT_FILENAME', "out/recommendations_append.csv")
+MIN_CLIENT_ID = 1
+MAX_CLIENT_ID = int(os.getenv('MAX_CLIENT_ID', '60'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '10000'))
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '4'))
+ANALYSIS_QUEUE_DEPTH = int(os.getenv('ANALYSIS_QUEUE_DEPTH', '64'))
+ANALYSIS_EXECUTOR = os.getenv('ANALYSIS_EXECUTOR', 'thread')
+RETRY_AFTER_SECONDS = 1
+# on - отвечать из заранее посчитанного индекса, обновляя его раз в INDEX_REFRESH_SECONDS
+RECOMMENDATION_INDEX = os.getenv('RECOMMENDATION_INDEX', 'off') == 'on'
+INDEX_REFRESH_SECONDS = float(os.getenv('INDEX_REFRESH_SECONDS', '60'))
 
 class Item(BaseModel):
     id: int
 
+
+class BatchItem(BaseModel):
+    ids: Optional[List[int]] = None
+    start: Optional[int] = None
+    end: Optional[int] = None
+    format: Literal["ndjson", "sse"] = "ndjson"
+
+    def bounds(self):
+        start = MIN_CLIENT_ID if self.start is None else self.start
+        end = MAX_CLIENT_ID if self.end is None else self.end
+        return start, end
+
+    @model_validator(mode='after')
+    def check_size(self):
+        # Размер проверяется до построения списка: {"end": 10**12} не должен занять память
+        start, end = self.bounds()
+        size = len(self.ids) if self.ids is not None else end - start + 1
+        if size > MAX_BATCH_SIZE:
+            raise ValueError(f"Не больше {MAX_BATCH_SIZE} ID в одном пакете")
+        return self
+
+    def client_ids(self) -> List[int]:
+        if self.ids is not None:
+            return list(dict.fromkeys(self.ids))
+        start, end = self.bounds()
+        return list(range(start, end + 1))
+
 app = FastAPI()
 origins = ["*"]
 
@@ -18,17 +71,161 @@ app.add_middleware(
     allow_methods=["*"], 
     allow_headers=["*"], 
 )
-@app.post("/process_id")
-async def process_id(item: Item):
-    print(f"Получен ID: {item.id}")
-    
 
-    if item.id >= 1 and item.id <= 60:
+
+# pandas и расчёт скоров выполняются здесь, а не в event loop
+analysis_pool = BoundedPool(
+    ANALYSIS_WORKERS, ANALYSIS_QUEUE_DEPTH, kind=ANALYSIS_EXECUTOR,
+    # Каждый процесс пула прогревает своё хранилище
+    initializer=warmup if ANALYSIS_EXECUTOR == 'process' else None,
+    initargs=(DATA_DIRECTORY, range(MIN_CLIENT_ID, MAX_CLIENT_ID + 1)),
+)
+
+
+recommendation_index = RecommendationIndex() if RECOMMENDATION_INDEX else None
+
+
+async def refresh_index():
+    # Первый проход строит индекс (или досчитывает сохранённый), дальше - только изменения
+    while True:
+        try:
+            result = await recommendation_index.arefresh(range(MIN_CLIENT_ID, MAX_CLIENT_ID + 1))
+            if result.get('recomputed'):
+                print(f"Индекс рекомендаций: {result}")
+        except Exception as e:
+            print(f"Ошибка обновления индекса: {e!r}")
+        await asyncio.sleep(INDEX_REFRESH_SECONDS)
+
+
+async def flush_results():
+    # Строки копятся в буфере приёмника; раз в SINK_FLUSH_SECONDS сбрасываем их на диск
+    while True:
+        await asyncio.sleep(FLUSH_SECONDS)
+        await asyncio.to_thread(flush_all)
+
+
+@app.on_event("startup")
+async def start_analysis_pool():
+    analysis_pool.start()
+    app.state.flush_task = asyncio.create_task(flush_results())
+    if recommendation_index is not None:
+        recommendation_index.load()
+        app.state.index_task = asyncio.create_task(refresh_index())
+    if ANALYSIS_EXECUTOR != 'process':
+        loaded = await asyncio.to_thread(get_store().warmup, range(MIN_CLIENT_ID, MAX_CLIENT_ID + 1))
+        print(f"Прогрев: загружены данные {loaded} клиентов")
+
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    analysis_pool.shutdown()
+    app.state.flush_task.cancel()
+    if recommendation_index is not None:
+        app.state.index_task.cancel()
+    close_all()
+    client = get_llm_client()
+    if client is not None:
+        await client.aclose()
+
+
+async def analyze_client(client_id: int, wait: bool = False) -> dict:
+    """
+    Общий путь анализа для /process_id и /process_batch.
+
+    При wait=False и заполненном пуле бросает PoolSaturated.
+    """
+    if client_id >= MIN_CLIENT_ID and client_id <= MAX_CLIENT_ID:
+        entry = recommendation_index.get(client_id) if recommendation_index is not None else None
+        if entry is not None:
+            # Готовый ответ из индекса: ни анализа, ни запроса к Gemini
+            row = {'client_code': client_id, 'product': entry['product'], 'push_notification': entry['push_notification']}
+            # Только буфер: на диск строки сбрасывает flush_results, не event loop
+            write_to_csv(row, OUTPUT_FILENAME, flush=False)
+            inc('requests_total', status='index')
+            return {"status": "success", "received_id": client_id, "row": row,
+                    "index_version": recommendation_index.snapshot.version}
         try:
-            ca = ClientAnalyzer(item.id)
-            row = ca.execute()
-            return {"status": "success", "received_id": item.id, "row": row}
+            with timer('request.analyze_client'):
+                with timer('request.analysis'):
+                    product, value = await analysis_pool.run(recommend_client, client_id, OUTPUT_FILENAME, wait=wait)
+                # Запрос к Gemini не блокирует event loop
+                row = await asend_push_notification(client_id, product, value)
+                write_to_csv(row, OUTPUT_FILENAME, flush=False)
+            inc('requests_total', status='success')
+            return {"status": "success", "received_id": client_id, "row": row}
+        except PoolSaturated:
+            inc('requests_total', status='rejected')
+            raise
         except:
-            return {"status": "fail", "received_id": item.id, "reason": "Ошибка при обработке информации"}
+            inc('requests_total', status='fail')
+            return {"status": "fail", "received_id": client_id, "reason": "Ошибка при обработке информации"}
     
-    return {"status": "fail","received_id": item.id, "reason": "ID клиента должен быть в диапазоне 1-60"}
\ No newline at end of file
+    inc('requests_total', status='invalid_id')
+    return {"status": "fail","received_id": client_id, "reason": f"ID клиента должен быть в диапазоне {MIN_CLIENT_ID}-{MAX_CLIENT_ID}"}
+
+
+@app.post("/process_id")
+async def process_id(item: Item):
+    print(f"Получен ID: {item.id}")
+    try:
+        return await analyze_client(item.id)
+    except PoolSaturated:
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+            content={"status": "fail", "received_id": item.id, "reason": "Сервер перегружен, повторите позже"},
+        )
+
+
+async def stream_batch(client_ids: List[int], fmt: str):
+    """
+    Отдаёт результаты по мере готовности, не более BATCH_CONCURRENCY клиентов одновременно.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(client_id: int) -> dict:
+        async with semaphore:
+            # Пакет не получает 503 - ждёт свободного места в пуле
+            return await analyze_client(client_id, wait=True)
+
+    tasks = [asyncio.create_task(run(client_id)) for client_id in client_ids]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = json.dumps(await next_done, ensure_ascii=False)
+            yield f"data: {result}\n\n" if fmt == "sse" else result + "\n"
+        if fmt == "sse":
+            yield "event: done\ndata: {}\n\n"
+    finally:
+        # Клиент отключился - не тратим вызовы Gemini на оставшиеся ID
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/process_batch")
+async def process_batch(item: BatchItem):
+    # Пакет больше MAX_BATCH_SIZE отклоняется ещё при разборе тела (422, BatchItem.check_size)
+    client_ids = item.client_ids()
+    print(f"Получен пакет из {len(client_ids)} ID")
+    media_type = "text/event-stream" if item.format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_batch(client_ids, item.format), media_type=media_type)
+
+
+@app.get("/index")
+async def index_status():
+    """
+    Состояние индекса рекомендаций: версия, время сборки, число клиентов.
+    """
+    if recommendation_index is None:
+        return {"enabled": False}
+    return {"enabled": True, **recommendation_index.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Таймеры этапов и счётчики в текстовом формате Prometheus.
+    """
+    METRICS.set_gauge('analysis_pool_in_flight', analysis_pool.in_flight)
+    METRICS.set_gauge('analysis_pool_capacity', analysis_pool.capacity)
+    METRICS.set_counter('analysis_pool_rejected_total', analysis_pool.rejected)
+    return PlainTextResponse(METRICS.render_prometheus(), media_type="text/plain; version=0.0.4")
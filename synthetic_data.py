@@ -0,0 +1,124 @@
+# synthetic_data.py
+
+import os
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from columnar import CSV_PATTERN
+
+
+PERIOD_START = pd.Timestamp('2025-06-01 08:00:00')
+PERIOD_END = pd.Timestamp('2025-08-31 22:00:00')
+AMOUNT_NOISE = 0.25  # сигма логнормального шума для сумм
+
+
+def load_templates(template_dir: str) -> Dict[str, pd.DataFrame]:
+    """
+    Читает образцы клиентов (case1): профили, транзакции и переводы.
+    """
+    profiles = pd.read_csv(os.path.join(template_dir, 'clients.csv'))
+    frames = {'transactions': [], 'transfers': []}
+    for name in sorted(os.listdir(template_dir)):
+        match = CSV_PATTERN.search(name)
+        if match:
+            frames[match.group(2)].append(pd.read_csv(os.path.join(template_dir, name)))
+    return {
+        'profiles': profiles,
+        'transactions': pd.concat(frames['transactions'], ignore_index=True),
+        'transfers': pd.concat(frames['transfers'], ignore_index=True),
+    }
+
+
+def _resample(template: pd.DataFrame, template_ids: np.ndarray, profiles: pd.DataFrame,
+              rows_per_client: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Для каждого синтетического клиента берёт строки его клиента-образца с
+    возвращением, добавляет шум к суммам и случайные даты внутри периода.
+    """
+    template = template.sort_values('client_code', kind='stable').reset_index(drop=True)
+    codes = template['client_code'].to_numpy()
+    unique, starts, counts = np.unique(codes, return_index=True, return_counts=True)
+    position = {code: i for i, code in enumerate(unique)}
+
+    n_clients = len(template_ids)
+    block = np.array([position.get(code, -1) for code in template_ids])
+    has_rows = block >= 0
+    client_index = np.repeat(np.arange(n_clients)[has_rows], rows_per_client)
+    block = np.repeat(block[has_rows], rows_per_client)
+    rows = starts[block] + (rng.random(len(block)) * counts[block]).astype(np.int64)
+
+    df = template.iloc[rows].reset_index(drop=True)
+    df['client_code'] = profiles['client_code'].to_numpy()[client_index]
+    for column in ('name', 'status', 'city'):
+        df[column] = profiles[column].to_numpy()[client_index]
+    df['amount'] = np.round(df['amount'].to_numpy() * rng.lognormal(0.0, AMOUNT_NOISE, len(df)), 2)
+
+    span = int((PERIOD_END - PERIOD_START).total_seconds())
+    dates = PERIOD_START + pd.to_timedelta(rng.integers(0, span, len(df)), unit='s')
+    df['date'] = dates
+    df = df.sort_values(['client_code', 'date'], kind='stable').reset_index(drop=True)
+    df['date'] = df['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    return df
+
+
+def generate(n_clients: int, out_dir: str, template_dir: str = 'case1', seed: int = 0,
+             rows_per_client: int = 300) -> Dict[str, int]:
+    """
+    Генерирует n_clients клиентов в схеме case1: clients.csv и
+    client_{id}_{transactions,transfers}_3m.csv.
+
+    Каждый клиент копирует «архетип» случайного клиента-образца (набор
+    категорий и типов переводов, валюты, порядок сумм) с шумом, поэтому
+    продукты распределяются примерно как на реальных данных.
+    """
+    rng = np.random.default_rng(seed)
+    templates = load_templates(template_dir)
+    base = templates['profiles']
+
+    picks = rng.integers(0, len(base), n_clients)
+    profiles = base.iloc[picks].reset_index(drop=True)
+    template_ids = profiles['client_code'].to_numpy()
+    profiles['client_code'] = np.arange(1, n_clients + 1)
+    profiles['age'] = np.clip(profiles['age'].to_numpy() + rng.integers(-3, 4, n_clients), 18, 80)
+    balance = profiles['avg_monthly_balance_KZT'].to_numpy() * rng.lognormal(0.0, AMOUNT_NOISE, n_clients)
+    profiles['avg_monthly_balance_KZT'] = balance.astype(np.int64)
+
+    os.makedirs(out_dir, exist_ok=True)
+    profiles.to_csv(os.path.join(out_dir, 'clients.csv'), index=False, encoding='utf-8-sig')
+
+    written = {'clients': n_clients}
+    for kind in ('transactions', 'transfers'):
+        df = _resample(templates[kind], template_ids, profiles, rows_per_client, rng)
+        # Один to_csv на все строки, затем нарезка по клиентам - в разы быстрее to_csv на каждый файл
+        header = ','.join(df.columns) + '\n'
+        lines = df.to_csv(index=False, header=False, lineterminator='\n').splitlines(keepends=True)
+        client_ids, starts = np.unique(df['client_code'].to_numpy(), return_index=True)
+        bounds = list(starts[1:]) + [len(lines)]
+        for client_id, start, end in zip(client_ids, starts, bounds):
+            path = os.path.join(out_dir, f'client_{client_id}_{kind}_3m.csv')
+            with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+                f.write(header)
+                f.writelines(lines[start:end])
+        written[kind] = len(df)
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Генератор синтетических клиентов в схеме case1")
+    parser.add_argument("-n", "--clients", type=int, default=1000, help="Количество клиентов")
+    parser.add_argument("--out", default=os.path.join("out", "synthetic"), help="Каталог для данных")
+    parser.add_argument("--template", default="case1", help="Каталог с клиентами-образцами")
+    parser.add_argument("--rows", type=int, default=300, help="Строк на клиента в каждом файле")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--parquet", action="store_true", help="Сразу сконвертировать в Parquet")
+    args = parser.parse_args()
+
+    result = generate(args.clients, args.out, args.template, args.seed, args.rows)
+    print(f"Сгенерировано: {result} -> {args.out}")
+    if args.parquet:
+        import columnar
+        print(columnar.convert(args.out))
@@ -0,0 +1,16 @@
+# tests/conftest.py
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # Пути по умолчанию (case1, product_rules.json) заданы относительно корня репозитория
+    monkeypatch.chdir(ROOT)
+    return ROOT
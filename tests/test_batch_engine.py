@@ -0,0 +1,104 @@
+# tests/test_batch_engine.py
+
+import csv
+
+import pytest
+
+import batch_engine
+import notifications
+
+
+CLIENTS = range(1, 61)
+
+
+def read_codes(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return [int(row['client_code']) for row in csv.DictReader(f)]
+
+
+@pytest.fixture
+def flaky_push(monkeypatch):
+    """
+    Пуш без Gemini: клиенты из fail падают с ошибкой, клиенты из
+    template в первой попытке получают шаблонный текст, остальные - ответ.
+    """
+    settings = dict(notifications.get_settings(), api_key='test', api_url='http://127.0.0.1:9/')
+    monkeypatch.setattr(notifications, '_settings', settings)
+    state = {'fail': set(), 'template': set(), 'calls': {}}
+
+    def send(client_id, product, value):
+        calls = state['calls'][client_id] = state['calls'].get(client_id, 0) + 1
+        if client_id in state['fail']:
+            raise RuntimeError('Gemini недоступен')
+        if client_id in state['template'] and calls == 1:
+            text = notifications.fallback_text(product)
+        else:
+            text = f'Ответ для клиента {client_id}'
+        return {'client_code': client_id, 'product': product, 'push_notification': text}
+
+    monkeypatch.setattr(notifications, 'send_push_notification', send)
+    return state
+
+
+def test_resume_and_fallback_retry_keep_client_order(tmp_path, flaky_push):
+    output = str(tmp_path / 'recommendations.csv')
+
+    # Первый запуск: клиент 5 падает, у части клиентов шаблон до повтора
+    flaky_push['fail'] = {5}
+    flaky_push['template'] = {1, 4, 7, 13, 60}
+    first = batch_engine.run_batch(CLIENTS, output, executor='thread', workers=4, retries=1)
+    assert set(first['failures']) == {5}
+    assert first['fallbacks'] == []
+    assert read_codes(output) == [c for c in CLIENTS if c != 5]
+
+    # Продолжение: клиент 5 считается заново и сначала тоже получает шаблон
+    flaky_push['fail'] = set()
+    flaky_push['template'] = {5}
+    flaky_push['calls'] = {}
+    second = batch_engine.run_batch(CLIENTS, output, executor='thread', workers=4, resume=True, retries=1)
+    assert second['resumed'] == 59
+    assert flaky_push['calls'] == {5: 2}
+    assert read_codes(output) == list(CLIENTS)
+    assert [row['client_code'] for row in second['rows']] == list(CLIENTS)
+
+
+def test_unrecovered_fallback_is_written_in_order(tmp_path, flaky_push):
+    output = str(tmp_path / 'recommendations.csv')
+    flaky_push['template'] = {2, 30}
+    # Без повторов шаблон остаётся в результате, но на своём месте
+    result = batch_engine.run_batch(CLIENTS, output, executor='thread', workers=4, retries=0)
+    assert result['fallbacks'] == [2, 30]
+    assert read_codes(output) == list(CLIENTS)
+
+
+def test_pool_timeout_counts_from_task_start(monkeypatch):
+    import time
+
+    def send(client_id, product, value):
+        time.sleep(1.0 if client_id == 1 else 0.05)
+        return {'client_code': client_id, 'product': product, 'push_notification': 'ok'}
+
+    monkeypatch.setattr(notifications, 'send_push_notification', send)
+    results = []
+    jobs = [(client_id, 'Кредитная карта', 0) for client_id in range(1, 21)]
+    batch_engine._push_with_pool(jobs, workers=2, executor='thread', timeout=0.5,
+                                 on_result=lambda *result: results.append(result))
+    # Очередь за зависшим клиентом 1 ждёт дольше таймаута, но таймаут получает только он
+    assert [r[0] for r in results] == list(range(1, 21))
+    assert results[0][3] == 'таймаут 0.5 c'
+    assert all(error is None for _, _, _, error in results[1:])
+
+
+@pytest.mark.parametrize('compact', [False, True], ids=['frames', 'compact'])
+def test_score_batch_matches_per_client_recommend(compact):
+    from analyzer import ClientAnalyzer
+    from data_store import ClientDataStore
+    from rules import load_rules
+
+    store = ClientDataStore('case1', compact=compact)
+    decisions, missing = batch_engine.score_batch(CLIENTS, store)
+    assert missing == []
+    products = load_rules().products
+    for client_id, product, value in zip(decisions.index, decisions['product'], decisions['value']):
+        expected = ClientAnalyzer(int(client_id), None, store).recommend()
+        assert (product, products[product].cast(value)) == pytest.approx(expected), client_id
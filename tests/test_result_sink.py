@@ -0,0 +1,73 @@
+# tests/test_result_sink.py
+
+import csv
+
+import pytest
+
+from result_sink import CsvSink
+
+
+def row(client_id, product='Кредитная карта', text='пуш'):
+    return {'client_code': client_id, 'product': product, 'push_notification': text}
+
+
+def read(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return [(int(r['client_code']), r['product'], r['push_notification']) for r in csv.DictReader(f)]
+
+
+def test_upsert_replaces_client_row(tmp_path):
+    path = tmp_path / 'out.csv'
+    with CsvSink(str(path), flush_every=1) as sink:
+        sink.write(row(1))
+        sink.write(row(2))
+        sink.write(row(1, text='новый пуш'))
+    assert read(path) == [(1, 'Кредитная карта', 'новый пуш'), (2, 'Кредитная карта', 'пуш')]
+
+
+def test_write_without_flush_only_buffers(tmp_path):
+    path = tmp_path / 'out.csv'
+    sink = CsvSink(str(path), flush_every=1, flush_interval=0)
+    sink.write(row(1), flush=False)
+    assert not path.exists()
+    sink.close()
+    assert read(path) == [(1, 'Кредитная карта', 'пуш')]
+    with pytest.raises(ValueError):
+        sink.write(row(2))
+
+
+def test_atomic_commit_replaces_file_in_client_order(tmp_path):
+    path = tmp_path / 'out.csv'
+    with CsvSink(str(path)) as sink:
+        sink.write_many([row(1), row(3), row(5)])
+    before = read(path)
+
+    sink = CsvSink(str(path), atomic=True, flush_every=1)
+    sink.write_many([row(4), row(3, text='новый пуш'), row(2)])
+    # До commit() файл прежний
+    assert read(path) == before
+    # Строка другого процесса, записанная во время запуска, сохраняется
+    with CsvSink(str(path)) as other:
+        other.write(row(6))
+    sink.commit()
+
+    assert read(path) == [
+        (1, 'Кредитная карта', 'пуш'), (2, 'Кредитная карта', 'пуш'), (3, 'Кредитная карта', 'новый пуш'),
+        (4, 'Кредитная карта', 'пуш'), (5, 'Кредитная карта', 'пуш'), (6, 'Кредитная карта', 'пуш'),
+    ]
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == '.tmp'] == []
+
+
+def test_atomic_abort_keeps_old_file(tmp_path):
+    path = tmp_path / 'out.csv'
+    with CsvSink(str(path)) as sink:
+        sink.write(row(1))
+
+    with pytest.raises(RuntimeError):
+        with CsvSink(str(path), atomic=True, flush_every=1) as sink:
+            sink.write(row(1, text='новый пуш'))
+            sink.write(row(2))
+            raise RuntimeError('запуск прерван')
+
+    assert read(path) == [(1, 'Кредитная карта', 'пуш')]
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == '.tmp'] == []
@@ -0,0 +1,20 @@
+# tests/test_server.py
+
+import pytest
+
+fastapi_testclient = pytest.importorskip('fastapi.testclient')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('PUSH_CACHE', 'off')
+    import server
+
+    return fastapi_testclient.TestClient(server.app)
+
+
+@pytest.mark.parametrize('body', [{'start': 1, 'end': 10 ** 12}, {'ids': list(range(10_001))}])
+def test_oversized_batch_is_rejected_before_building_ids(client, body):
+    response = client.post('/process_batch', json=body)
+    assert response.status_code == 422
+    assert 'Не больше' in response.text
@@ -0,0 +1,58 @@
+# tests/test_timeseries.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from timeseries import RunningTimeSeries, TimeSeries
+
+FIELDS = ('months', 'monthly_sum', 'monthly_count', 'client_months', 'interval_stats',
+          'weeks', 'weekly_sum', 'weekly_count')
+
+
+def random_frame(rng, n):
+    dates = pd.Timestamp('2025-05-20') + pd.to_timedelta(rng.integers(0, 120 * 86400, n), unit='s')
+    types = rng.choice(['deposit_topup_out', 'fx_buy', 'p2p_out'], n).astype(object)
+    types[0] = np.nan
+    return pd.DataFrame({'date': dates, 'type': types, 'amount': rng.integers(100, 100_000, n).astype(float)})
+
+
+def assert_same(expected: TimeSeries, actual: TimeSeries):
+    assert actual.keys == expected.keys
+    for field in FIELDS:
+        np.testing.assert_allclose(getattr(actual, field), getattr(expected, field), err_msg=field)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_snapshot_matches_from_frame_with_events(seed):
+    rng = np.random.default_rng(seed)
+    history, events = random_frame(rng, 40), random_frame(rng, 15)
+    running = RunningTimeSeries.from_frame(history, 'type')
+    assert_same(TimeSeries.from_frame(history, 'type'), running.snapshot())
+
+    # События приходят не по порядку дат - интервалы пересчитываются по соседям
+    for date, key, amount in events.dropna().itertuples(index=False):
+        running.add(key, int(date.timestamp()), amount)
+    full = pd.concat([history, events.dropna()], ignore_index=True)
+    assert_same(TimeSeries.from_frame(full, 'type'), running.snapshot())
+
+
+def test_empty_snapshot_has_no_recurrence():
+    series = RunningTimeSeries().snapshot()
+    assert series.month_coverage(['deposit_topup_out'])[0] == 0.0
+    assert np.isnan(series.interval_cv(['deposit_topup_out'])[0])
+
+
+def test_counts_only_build_matches_full_gates():
+    rng = np.random.default_rng(3)
+    frame = random_frame(rng, 200).dropna()
+    codes, keys = pd.factorize(frame['type'], sort=True)
+    owner = rng.integers(0, 5, len(frame))
+    seconds = frame['date'].to_numpy().astype('datetime64[s]').astype(np.int64)
+    args = (owner, seconds, codes, frame['amount'].to_numpy(), 5, keys)
+    full, lean = TimeSeries.build(*args), TimeSeries.build(*args, sums=False)
+    names = ['deposit_topup_out', 'fx_buy']
+    np.testing.assert_array_equal(lean.month_coverage(names), full.month_coverage(names))
+    np.testing.assert_array_equal(lean.interval_cv(names), full.interval_cv(names))
+    with pytest.raises(ValueError):
+        lean.monthly(names)
@@ -0,0 +1,336 @@
+# timeseries.py
+
+import bisect
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+SECONDS_PER_DAY = 86_400
+# 1970-01-01 - четверг: сдвиг на 3 дня даёт недели, начинающиеся с понедельника
+EPOCH_WEEKDAY = 3
+
+
+def to_seconds(dates) -> np.ndarray:
+    """
+    Даты (datetime64 любой точности, Series или строки) в int64 секунды Unix.
+    """
+    values = dates.to_numpy() if isinstance(dates, pd.Series) else np.asarray(dates)
+    if values.dtype.kind != 'M':
+        values = pd.to_datetime(values).to_numpy()
+    return values.astype('datetime64[s]').astype(np.int64)
+
+
+def month_of(seconds: np.ndarray) -> np.ndarray:
+    """
+    Номер календарного месяца от 1970-01 (0 - январь 1970).
+    """
+    return seconds.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+
+
+def week_of(seconds: np.ndarray) -> np.ndarray:
+    """
+    Номер недели (с понедельника) от начала эпохи.
+    """
+    return (seconds // SECONDS_PER_DAY + EPOCH_WEEKDAY) // 7
+
+
+def slope(series: np.ndarray) -> np.ndarray:
+    """
+    Наклон МНК-прямой по последней оси (изменение за один период).
+    """
+    n = series.shape[-1]
+    if n < 2:
+        return np.zeros(series.shape[:-1])
+    x = np.arange(n) - (n - 1) / 2
+    return series @ x / (x @ x)
+
+
+def _window(periods: np.ndarray) -> np.ndarray:
+    if not len(periods):
+        return np.zeros(0, dtype=np.int64)
+    return np.arange(periods.min(), periods.max() + 1)
+
+
+def _sort_order(owner: np.ndarray, codes: np.ndarray, seconds: np.ndarray, n_keys: int) -> np.ndarray:
+    """
+    Порядок строк по (клиент, ключ, дата). Три ключа упаковываются в один
+    int64 - argsort по нему в несколько раз быстрее np.lexsort.
+    """
+    if not len(seconds):
+        return np.zeros(0, dtype=np.int64)
+    start = seconds.min()
+    span = int(seconds.max() - start) + 1
+    groups = (int(owner.max()) + 1) * max(n_keys, 1)
+    if groups * span >= 2 ** 62:
+        return np.lexsort((seconds, codes, owner))
+    return np.argsort((owner * n_keys + codes) * span + (seconds - start))
+
+
+class TimeSeries:
+    """
+    Временные агрегаты одного вида данных (транзакции или переводы) для
+    одного или многих клиентов.
+
+    Строится за одну сортировку строк по (клиент, ключ, дата): из неё
+    bincount-ами получаются суммы и количества по (клиент, месяц, ключ) и,
+    по желанию, по неделям, а соседние строки с тем же ключом дают
+    интервалы между повторяющимися операциями. Окно месяцев и недель общее
+    для всех клиентов; client_months - сколько месяцев покрывает история
+    самого клиента (от первой до последней операции).
+
+    Массивы плотные: клиенты x месяцы x ключи. Для пакета на сотни тысяч
+    клиентов build(sums=False) строит только то, что нужно проверкам
+    регулярности (количества в int32 и интервалы) - без сумм и недель.
+    """
+
+    def __init__(self, keys: List[str], months: np.ndarray, monthly_sum: np.ndarray, monthly_count: np.ndarray,
+                 client_months: np.ndarray, interval_stats: np.ndarray, weeks: Optional[np.ndarray] = None,
+                 weekly_sum: Optional[np.ndarray] = None, weekly_count: Optional[np.ndarray] = None):
+        self.keys = keys
+        self._positions = {key: i for i, key in enumerate(keys)}
+        self.months = months
+        self.monthly_sum = monthly_sum
+        self.monthly_count = monthly_count
+        self.client_months = client_months
+        # [клиент, ключ, (число интервалов, сумма дней, сумма квадратов дней)]
+        self.interval_stats = interval_stats
+        self.weeks = weeks
+        self.weekly_sum = weekly_sum
+        self.weekly_count = weekly_count
+
+    @classmethod
+    def build(cls, owner: np.ndarray, seconds: np.ndarray, codes: np.ndarray, amounts: np.ndarray,
+              n_clients: int, keys: Sequence[str], weekly: bool = False, sums: bool = True) -> 'TimeSeries':
+        """
+        owner - номер клиента (0..n_clients-1) для каждой строки, seconds -
+        дата в секундах, codes - номер ключа в keys (категория или тип).
+        sums=False - без сумм по периодам (monthly_sum is None), количества
+        в int32: month_coverage, active_months и interval_cv работают,
+        monthly/trend/client_frame - нет.
+        """
+        keys = [str(key) for key in keys]
+        known = codes >= 0
+        owner, seconds, codes = owner[known], seconds[known], codes[known].astype(np.int64)
+        amounts = amounts[known].astype(np.float64)
+        order = _sort_order(owner, codes, seconds, n_keys=len(keys))
+        owner, seconds, codes, amounts = owner[order], seconds[order], codes[order], amounts[order]
+        n_keys = len(keys)
+
+        def resample(periods: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            window = _window(periods)
+            size = n_clients * len(window) * n_keys
+            bins = (owner * len(window) + (periods - (window[0] if len(window) else 0))) * n_keys + codes
+            shape = (n_clients, len(window), n_keys)
+            counts = np.bincount(bins, minlength=size).reshape(shape)
+            if not sums:
+                return window, None, counts.astype(np.int32)
+            return window, np.bincount(bins, weights=amounts, minlength=size).reshape(shape), counts
+
+        month = month_of(seconds)
+        months, monthly_sum, monthly_count = resample(month)
+
+        # Строки отсортированы по клиенту: окно клиента - min/max месяца в его сегменте
+        client_months = np.zeros(n_clients, dtype=np.int64)
+        if len(owner):
+            starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]])
+            first = np.minimum.reduceat(month, starts)
+            last = np.maximum.reduceat(month, starts)
+            client_months[owner[starts]] = last - first + 1
+
+        # Интервалы между соседними операциями одного клиента с одним ключом
+        same = (owner[1:] == owner[:-1]) & (codes[1:] == codes[:-1])
+        gaps = (seconds[1:] - seconds[:-1])[same] / SECONDS_PER_DAY
+        gap_bins = (owner[1:] * n_keys + codes[1:])[same]
+        size = n_clients * n_keys
+        interval_stats = np.stack([
+            np.bincount(gap_bins, minlength=size).astype(np.float64),
+            np.bincount(gap_bins, weights=gaps, minlength=size),
+            np.bincount(gap_bins, weights=gaps * gaps, minlength=size),
+        ], axis=-1).reshape(n_clients, n_keys, 3)
+
+        weeks = weekly_sum = weekly_count = None
+        if weekly and sums:
+            weeks, weekly_sum, weekly_count = resample(week_of(seconds))
+        return cls(keys, months, monthly_sum, monthly_count, client_months, interval_stats,
+                   weeks, weekly_sum, weekly_count)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, column: str, weekly: bool = True) -> 'TimeSeries':
+        """
+        Временные агрегаты одного клиента по его DataFrame (колонки date, column, amount).
+        """
+        codes, keys = pd.factorize(df[column], sort=True)
+        return cls.build(np.zeros(len(df), dtype=np.int64), to_seconds(df['date']), codes,
+                         df['amount'].to_numpy(dtype=np.float64), 1, keys, weekly)
+
+    def _columns(self, names: Sequence[str]) -> List[int]:
+        return [self._positions[name] for name in names if name in self._positions]
+
+    def _require_sums(self):
+        if self.monthly_sum is None:
+            raise ValueError("Суммы по периодам не считались (sums=False)")
+
+    def monthly(self, names: Sequence[str]) -> np.ndarray:
+        """
+        Суммы по месяцам [клиент, месяц] для ключей names.
+        """
+        self._require_sums()
+        return self.monthly_sum[:, :, self._columns(names)].sum(axis=2)
+
+    def weekly(self, names: Sequence[str]) -> np.ndarray:
+        if self.weekly_sum is None:
+            raise ValueError("Недельные окна не считались (weekly=False)")
+        return self.weekly_sum[:, :, self._columns(names)].sum(axis=2)
+
+    def active_months(self, names: Sequence[str]) -> np.ndarray:
+        """
+        Сколько месяцев у клиента была хотя бы одна операция с ключами names.
+        """
+        return (self.monthly_count[:, :, self._columns(names)].sum(axis=2) > 0).sum(axis=1)
+
+    def month_coverage(self, names: Sequence[str]) -> np.ndarray:
+        """
+        Доля месяцев истории клиента, в которых были операции names (0..1).
+        """
+        months = self.client_months
+        return np.where(months > 0, self.active_months(names) / np.maximum(months, 1), 0.0)
+
+    def interval_cv(self, names: Sequence[str]) -> np.ndarray:
+        """
+        Коэффициент вариации интервалов (дней) между повторами операций
+        names: около 0 - равномерный график, NaN - меньше двух операций.
+        Интервалы считаются внутри каждого ключа и объединяются.
+        """
+        stats = self.interval_stats[:, self._columns(names), :].sum(axis=1)
+        count, total, squares = stats[:, 0], stats[:, 1], stats[:, 2]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            std = np.sqrt(np.maximum(squares / count - mean * mean, 0.0))
+            return np.where(count > 0, std / mean, np.nan)
+
+    def trend(self, names: Sequence[str], weekly: bool = False) -> np.ndarray:
+        """
+        Наклон сумм по месяцам (или неделям) - на сколько тенге в период растут операции names.
+        """
+        return slope(self.weekly(names) if weekly else self.monthly(names))
+
+    def client_frame(self, position: int = 0, weekly: bool = False) -> pd.DataFrame:
+        """
+        Суммы одного клиента: строки - месяцы (или недели с понедельника),
+        столбцы - ключи, которые встречаются у клиента.
+        """
+        self._require_sums()
+        if weekly:
+            index = pd.to_datetime(self.weeks * 7 - EPOCH_WEEKDAY, unit='D')
+            sums, counts = self.weekly_sum[position], self.weekly_count[position]
+        else:
+            index = pd.PeriodIndex(self.months.astype('datetime64[M]'), freq='M')
+            sums, counts = self.monthly_sum[position], self.monthly_count[position]
+        present = counts.sum(axis=0) > 0
+        return pd.DataFrame(sums[:, present], index=index, columns=np.array(self.keys, dtype=object)[present])
+
+
+def _month_number(seconds: int) -> int:
+    moment = time.gmtime(seconds)
+    return (moment.tm_year - 1970) * 12 + moment.tm_mon - 1
+
+
+class RunningTimeSeries:
+    """
+    Временные агрегаты одного клиента, обновляемые по одной операции
+    (incremental.py).
+
+    Держит суммы и количества по (месяц, ключ) и (неделя, ключ) и для
+    каждого ключа отсортированный список дат: новая дата вставляется
+    bisect-ом, а статистики интервалов поправляются только для соседей, так
+    что операции могут приходить и не по порядку. Интервалы копятся в целых
+    секундах - без накопления ошибки округления. snapshot() собирает
+    TimeSeries, равный TimeSeries.from_frame по истории с этими операциями.
+    """
+
+    def __init__(self):
+        self._monthly: Dict[Tuple[int, str], List[float]] = {}
+        self._weekly: Dict[Tuple[int, str], List[float]] = {}
+        self._dates: Dict[str, List[int]] = {}
+        # ключ -> [число интервалов, сумма секунд, сумма квадратов секунд]
+        self._intervals: Dict[str, List[int]] = {}
+        self._month_range: Optional[Tuple[int, int]] = None
+        self._snapshot: Optional[TimeSeries] = None
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, column: str) -> 'RunningTimeSeries':
+        series = cls()
+        known = df[column].notna().to_numpy()
+        seconds = to_seconds(df['date'])[known]
+        keys = df[column].astype(str).to_numpy()[known]
+        amounts = df['amount'].to_numpy(dtype=np.float64)[known]
+        # По возрастанию даты вставка в списки дат - добавление в конец
+        for i in np.argsort(seconds, kind='stable'):
+            series.add(keys[i], int(seconds[i]), float(amounts[i]))
+        return series
+
+    def add(self, key: str, seconds: int, amount: float):
+        for table, period in ((self._monthly, _month_number(seconds)),
+                              (self._weekly, (seconds // SECONDS_PER_DAY + EPOCH_WEEKDAY) // 7)):
+            cell = table.setdefault((period, key), [0.0, 0])
+            cell[0] += amount
+            cell[1] += 1
+        month = _month_number(seconds)
+        first, last = self._month_range or (month, month)
+        self._month_range = (min(first, month), max(last, month))
+
+        dates = self._dates.setdefault(key, [])
+        stats = self._intervals.setdefault(key, [0, 0, 0])
+        i = bisect.bisect_right(dates, seconds)
+        previous = dates[i - 1] if i else None
+        following = dates[i] if i < len(dates) else None
+        if previous is not None and following is not None:
+            self._gap(stats, following - previous, -1)
+        if previous is not None:
+            self._gap(stats, seconds - previous, 1)
+        if following is not None:
+            self._gap(stats, following - seconds, 1)
+        dates.insert(i, seconds)
+        self._snapshot = None
+
+    @staticmethod
+    def _gap(stats: List[int], gap: int, sign: int):
+        stats[0] += sign
+        stats[1] += sign * gap
+        stats[2] += sign * gap * gap
+
+    def snapshot(self) -> TimeSeries:
+        """
+        TimeSeries одного клиента (с недельными окнами); кэшируется до следующей операции.
+        """
+        if self._snapshot is not None:
+            return self._snapshot
+        keys = sorted(self._dates)
+        if not keys:
+            empty = np.zeros(0, dtype=np.int64)
+            self._snapshot = TimeSeries.build(empty, empty, empty, np.zeros(0), 1, [], weekly=True)
+            return self._snapshot
+        positions = {key: k for k, key in enumerate(keys)}
+
+        def resample(table: Dict[Tuple[int, str], List[float]]):
+            periods = np.array([period for period, _ in table], dtype=np.int64)
+            window = np.arange(periods.min(), periods.max() + 1)
+            sums = np.zeros((1, len(window), len(keys)))
+            counts = np.zeros((1, len(window), len(keys)), dtype=np.int64)
+            for (period, key), (total, count) in table.items():
+                sums[0, period - window[0], positions[key]] = total
+                counts[0, period - window[0], positions[key]] = count
+            return window, sums, counts
+
+        months, monthly_sum, monthly_count = resample(self._monthly)
+        weeks, weekly_sum, weekly_count = resample(self._weekly)
+        first, last = self._month_range
+        interval_stats = np.array([[[self._intervals[key][0], self._intervals[key][1] / SECONDS_PER_DAY,
+                                     self._intervals[key][2] / SECONDS_PER_DAY ** 2] for key in keys]],
+                                  dtype=np.float64)
+        self._snapshot = TimeSeries(keys, months, monthly_sum, monthly_count, np.array([last - first + 1]),
+                                    interval_stats, weeks, weekly_sum, weekly_count)
+        return self._snapshot
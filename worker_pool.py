@@ -0,0 +1,61 @@
+# worker_pool.py
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+
+class PoolSaturated(Exception):
+    """
+    Все воркеры заняты и очередь заполнена.
+    """
+
+
+class BoundedPool:
+    """
+    Пул потоков или процессов для синхронной работы из async-кода.
+
+    Одновременно принимается не больше workers + queue_depth задач: сверх
+    этого `run(..., wait=False)` сразу бросает PoolSaturated (сервер отвечает
+    503), а `run(..., wait=True)` ждёт свободного места.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, kind: str = 'thread',
+                 initializer: Optional[Callable] = None, initargs: Tuple = ()):
+        self.workers = max(1, workers)
+        self.queue_depth = max(0, queue_depth)
+        self.kind = kind
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor: Optional[Executor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.rejected = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_depth
+
+    def start(self):
+        pool_cls = ProcessPoolExecutor if self.kind == 'process' else ThreadPoolExecutor
+        self._executor = pool_cls(max_workers=self.workers, initializer=self._initializer, initargs=self._initargs)
+        self._slots = asyncio.Semaphore(self.capacity)
+
+    async def run(self, fn: Callable, *args, wait: bool = False) -> Any:
+        if self._executor is None:
+            self.start()
+        if not wait and self._slots.locked():
+            self.rejected += 1
+            raise PoolSaturated()
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, fn, *args)
+            finally:
+                self.in_flight -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None